@@ -1,14 +1,36 @@
 import traceback
+import bisect
 import requests
 import json
 import urllib
+import re
+import logging
+import queue
+import threading
+import os
+import hashlib
+import sqlite3
+import struct
+import zlib
+import uuid
+import random
+import itertools
 
 import time
+import datetime
+from typing import Any
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from zoneinfo import ZoneInfo
-from datetime import datetime, timedelta, timezone
+from datetime import timedelta, timezone
+from requests.adapters import HTTPAdapter
 
 #---- END of import
 
+logger = logging.getLogger("ArcGISPythonUtility")
+
 class UTILS:
   @staticmethod
   def split_camel_case(text):
@@ -16,7 +38,146 @@ class UTILS:
 
   @staticmethod
   def chunk_array(array, chunk_size=100):
-    return [lst[i:i + size] for i in range(0, len(lst), size)]
+    return [array[i:i + chunk_size] for i in range(0, len(array), chunk_size)]
+
+  @staticmethod
+  def features_to_dataframe(features:list):
+    """
+    Returns the attributes of the features as a `pandas.DataFrame`, one column per field. Requires `pandas`.
+
+    :param features: `list` of features (`{"attributes": {...}, ...}`).
+    :return: pandas.DataFrame
+    """
+    import pandas as pd
+    return pd.DataFrame.from_records([feature["attributes"] for feature in features])
+
+  SECRET_PATTERN = re.compile(r'(?i)("?(?:token|access_token|refresh_token|password|client_secret)"?\s*[:=]\s*"?)[^"&\s,}]+')
+
+  @staticmethod
+  def redact(text:str)->str:
+    """
+    Masks token, password and client secret values in a URL, form body or JSON text.
+    """
+    return UTILS.SECRET_PATTERN.sub(r"\1***", text)
+
+  @staticmethod
+  def get_endpoint_class(url:str)->str:
+    """
+    Returns the kind of REST operation of the URL, used to group request metrics: `token`, `query`, `applyEdits`,
+    `version`, `utilityNetwork`, `metadata` or `other`.
+    """
+    path = url.split("?", 1)[0].rstrip("/").lower()
+    if path.endswith("/generatetoken") or path.endswith("/oauth2/token") or path.endswith("/token"):
+      return "token"
+    if "/versionmanagementserver" in path:
+      return "version"
+    if "/utilitynetworkserver" in path:
+      return "utilityNetwork"
+    if path.endswith("/query") or path.endswith("/queryrelatedrecords"):
+      return "query"
+    if path.endswith("/applyedits"):
+      return "applyEdits"
+    if re.search(r"/(featureserver|mapserver)(/\d+)?$", path):
+      return "metadata"
+    return "other"
+
+  @staticmethod
+  def is_query_url(url:str)->bool:
+    """
+    Returns `True` for the `query` operation URL of a layer, e.g. `.../FeatureServer/0/query`.
+    """
+    return re.search(r"/(FeatureServer|MapServer)/\d+/query/?$", url, flags=re.IGNORECASE) is not None
+
+  @staticmethod
+  def get_layer_url(url:str)->str:
+    """
+    Returns the layer URL of a layer operation URL, e.g. `.../FeatureServer/0/query` -> `.../FeatureServer/0`.
+
+    :param url: Layer URL or URL of an operation on the layer.
+    :return: Layer URL
+    """
+    url = url.rstrip("/")
+    return re.sub(r"/(query|applyEdits|queryRelatedRecords|updateAttachments)$", "", url, flags=re.IGNORECASE)
+
+  @staticmethod
+  def iter_ordered(func, items, max_workers:int=4, in_flight:int=None):
+    """
+    Calls `func(item)` for every item on a thread pool and yields the results in the order of `items`.
+    No more than `in_flight` calls are pending or waiting to be consumed at a time, so memory stays bounded.
+
+    :param func: Function called with one item.
+    :param items: Iterable of items.
+    :param max_workers: Number of threads.
+    :param in_flight: Maximum number of submitted but not yet yielded results. Default `max_workers`.
+    :return: Generator of results.
+    """
+    in_flight = max(in_flight or max_workers, 1)
+    pending = deque()
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      try:
+        for item in items:
+          pending.append(executor.submit(func, item))
+          if len(pending) >= in_flight:
+            yield pending.popleft().result()
+        while pending:
+          yield pending.popleft().result()
+      finally:
+        # Consumer stopped early or a call failed: do not start what is still queued.
+        for future in pending:
+          future.cancel()
+
+  @staticmethod
+  def iter_prefetched(iterable, prefetch:int=2):
+    """
+    Iterates `iterable` on a background thread and yields its items, reading up to `prefetch` items ahead.
+    Exceptions raised by the iterable are raised in the consumer.
+
+    :param iterable: Iterable to read ahead, e.g. a generator of pages.
+    :param prefetch: Number of items read ahead. With `0` the iterable is consumed directly.
+    :return: Generator of items.
+    """
+    if prefetch <= 0:
+      yield from iterable
+      return
+
+    buffer = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry)->bool:
+      while not stop.is_set():
+        try:
+          buffer.put(entry, timeout=0.1)
+          return True
+        except queue.Full:
+          continue
+      return False
+
+    def producer():
+      try:
+        for item in iterable:
+          if not put((item, None)):
+            return
+        put((done, None))
+      except BaseException as ex:
+        put((done, ex))
+
+    worker = threading.Thread(target=producer, daemon=True)
+    worker.start()
+    try:
+      while True:
+        item, error = buffer.get()
+        if item is done:
+          if error is not None:
+            raise error
+          return
+        yield item
+    finally:
+      stop.set()
+      # Unblock the producer if it waits on a full buffer.
+      while not buffer.empty():
+        buffer.get_nowait()
 
   @staticmethod
   def getConfigValue(configs, key, default=None):
@@ -52,6 +213,19 @@ class UTILS:
 
     return eastern_time.strftime("%Y-%m-%d %H:%M:%S")
 
+  @staticmethod
+  def get_datetime_string_from_epoch(epoch_ms:int, time_zone:str="UTC")->str:
+    """
+    Returns the epoch time in milliseconds (ESRI date value) in the given time zone,
+    formatted as 'YYYY-MM-DD HH:MM:SS' for use in ESRI REST API queries.
+
+    :param epoch_ms: Milliseconds since 1970-01-01 UTC
+    :param time_zone: IANA time zone name, e.g. 'America/New_York'. Default 'UTC'
+    :return: Formatted datetime string
+    """
+    utc_time = datetime.datetime.fromtimestamp(epoch_ms / 1000, timezone.utc)
+    return utc_time.astimezone(ZoneInfo(time_zone)).strftime("%Y-%m-%d %H:%M:%S")
+
   @staticmethod
   def safe_to_int(value: str | int)->int:
     """
@@ -66,18 +240,889 @@ class UTILS:
     except (ValueError, TypeError):
       return -1
 
+class requestMetrics:
+  """
+    In-process counters and latency histograms of the HTTP requests, fed by the `httpTransport` hook.
+    Cheap enough to stay enabled: one lock and a few dictionary updates per request.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    buckets:tuple=None           Upper bounds (seconds) of the latency histogram. Default `requestMetrics.BUCKETS`.
+    =====================        =====================================================================================
+
+    .. code-block:: python
+      >>> print(esri.metrics.to_prometheus())
+      arcgis_requests_total{endpoint="query",method="POST",status="200"} 412
+  """
+  BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+  def __init__(self, buckets:tuple=None) -> None:
+    self._buckets = tuple(buckets or requestMetrics.BUCKETS)
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._histograms = {}
+
+  def observe(self, event:dict, response=None):
+    """
+    `httpTransport` hook: counts the request event.
+    """
+    endpoint = event["endpoint"]
+    status = str(event["status"]) if event["status"] is not None else event.get("error") or "error"
+    with self._lock:
+      self._add(("requests", (("endpoint", endpoint), ("method", event["method"]), ("status", status))), 1)
+      self._add(("request_bytes_sent", (("endpoint", endpoint),)), event["bytesSent"])
+      self._add(("request_bytes_received", (("endpoint", endpoint),)), event["bytesReceived"])
+      if event.get("retries"):
+        self._add(("request_retries", (("endpoint", endpoint),)), 1)
+      histogram = self._histograms.get(endpoint)
+      if histogram is None:
+        histogram = self._histograms[endpoint] = [[0] * (len(self._buckets) + 1), 0.0]
+      histogram[0][bisect.bisect_left(self._buckets, event["latency"])] += 1
+      histogram[1] += event["latency"]
+
+  def increment(self, name:str, value:float=1, **labels):
+    """
+    Adds `value` to the counter `name` with `labels`, e.g. `increment("query_cache_hits", endpoint="query")`.
+    """
+    with self._lock:
+      self._add((name, tuple(sorted((key, str(label)) for key, label in labels.items()))), value)
+
+  def _add(self, key:tuple, value:float):
+    self._counters[key] = self._counters.get(key, 0) + value
+
+  def snapshot(self)->dict:
+    """
+    Returns `{"counters": {...}, "latency": {endpoint: {"count", "sum", "buckets"}}}`.
+    """
+    with self._lock:
+      counters = {f"{name}{{{','.join(f'{k}={v}' for k, v in labels)}}}": value for (name, labels), value in self._counters.items()}
+      latency = {endpoint: {"count": sum(counts), "sum": total, "buckets": dict(zip([*map(str, self._buckets), "+Inf"], counts))}
+                 for endpoint, (counts, total) in self._histograms.items()}
+    return {"counters": counters, "latency": latency}
+
+  def to_prometheus(self, prefix:str="arcgis")->str:
+    """
+    Returns the metrics in the Prometheus text exposition format.
+    """
+    format_labels = lambda labels: "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+    lines = []
+    with self._lock:
+      counters = sorted(self._counters.items())
+      histograms = sorted((endpoint, list(counts), total) for endpoint, (counts, total) in self._histograms.items())
+    typed = set()
+    for (name, labels), value in counters:
+      if name not in typed:
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        typed.add(name)
+      lines.append(f"{prefix}_{name}_total{format_labels(labels)} {int(value) if float(value).is_integer() else value}")
+    if histograms:
+      lines.append(f"# TYPE {prefix}_request_duration_seconds histogram")
+    for endpoint, counts, total in histograms:
+      cumulative = 0
+      for bound, count in zip([*map(str, self._buckets), "+Inf"], counts):
+        cumulative += count
+        lines.append(f'{prefix}_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+      lines.append(f'{prefix}_request_duration_seconds_sum{{endpoint="{endpoint}"}} {total:.6f}')
+      lines.append(f'{prefix}_request_duration_seconds_count{{endpoint="{endpoint}"}} {cumulative}')
+    return "\n".join(lines) + "\n"
+
+  def write_prometheus(self, path:str, prefix:str="arcgis"):
+    """
+    Writes `to_prometheus()` to `path` atomically, e.g. for the node_exporter textfile collector.
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+      f.write(self.to_prometheus(prefix))
+    os.replace(temp_path, path)
+
+  def reset(self):
+    with self._lock:
+      self._counters.clear()
+      self._histograms.clear()
+
+class jsonLinesTrace:
+  """
+    `httpTransport` hook writing one JSON line per request event (`METRICS_TRACE_PATH`).
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    path:str                     File the events are appended to.
+    ---------------------        -------------------------------------------------------------------------------------
+    sample_rate:float=1          Share of the requests written. Failed requests are always written.
+    =====================        =====================================================================================
+  """
+  def __init__(self, path:str, sample_rate:float=1) -> None:
+    self._sampleRate = sample_rate
+    self._lock = threading.Lock()
+    self._file = open(path, "a", encoding="UTF-8", buffering=1)
+
+  def __call__(self, event:dict, response=None):
+    failed = event.get("error") or (event["status"] or 0) >= 400
+    if not failed and self._sampleRate < 1 and random.random() >= self._sampleRate:
+      return
+    line = json.dumps(dict(event, time=datetime.datetime.now(timezone.utc).isoformat()))
+    with self._lock:
+      self._file.write(line + "\n")
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+class payloadLogger:
+  """
+    `httpTransport` hook logging the response bodies at `level`, cut at `max_bytes` and with secrets masked (`UTILS.redact`).
+    Nothing is read or formatted unless the logger is enabled for `level` and the request is sampled.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    max_bytes:int=2048           Bytes of the body written to the log (`PAYLOAD_LOG_MAX_BYTES`).
+    ---------------------        -------------------------------------------------------------------------------------
+    sample_rate:float=1          Share of the responses logged (`PAYLOAD_LOG_SAMPLE`). Failed responses are always logged.
+    ---------------------        -------------------------------------------------------------------------------------
+    level:int=logging.DEBUG      Log level of the body.
+    =====================        =====================================================================================
+  """
+  def __init__(self, max_bytes:int=2048, sample_rate:float=1, level:int=logging.DEBUG) -> None:
+    self._maxBytes = max_bytes
+    self._sampleRate = sample_rate
+    self._level = level
+
+  def __call__(self, event:dict, response=None):
+    if response is None or not logger.isEnabledFor(self._level):
+      return
+    if response.ok and self._sampleRate < 1 and random.random() >= self._sampleRate:
+      return
+    content = response.content or b""
+    body = UTILS.redact(content[:self._maxBytes].decode("UTF-8", errors="replace"))
+    more = f" ... ({len(content)} bytes)" if len(content) > self._maxBytes else ""
+    logger.log(self._level, f"{event['method']} {event['url']} {event['status']}: {body}{more}")
+
+class hostRateLimiter:
+  """
+    Token bucket per host shared by all threads: at most `rate` requests per second to the same host, with bursts of `burst`.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    rate:float                   Requests per second per host.
+    ---------------------        -------------------------------------------------------------------------------------
+    burst:int=None               Requests that may be sent at once after an idle period. Default `rate` (at least 1).
+    =====================        =====================================================================================
+  """
+  def __init__(self, rate:float, burst:int=None) -> None:
+    if rate <= 0:
+      raise Exception(f"Invalid rate {rate}.")
+    self.rate = float(rate)
+    self.burst = float(burst or max(1, int(rate)))
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+  def acquire(self, url:str)->float:
+    """
+    Blocks until a request to the host of `url` is allowed and returns the seconds waited.
+    """
+    host = urllib.parse.urlsplit(url).netloc.lower()
+    waited = 0.0
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        tokens, last = self._buckets.get(host, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+          self._buckets[host] = (tokens - 1, now)
+          return waited
+        self._buckets[host] = (tokens, now)
+        delay = (1 - tokens) / self.rate
+      time.sleep(delay)
+      waited += delay
+
+class resiliencePolicy:
+  """
+    Retry, circuit breaker and hedging rules of `httpTransport`.
+
+    A request is retried with exponential backoff and full jitter (`HTTP_BACKOFF * 2^attempt`, at most `HTTP_BACKOFF_MAX`,
+    or the server's `Retry-After`) when it failed on the connection, got a retryable HTTP status, or an HTTP 200 with an
+    ArcGIS JSON `error` of a retryable code. Only idempotent requests are retried after they may have reached the server:
+    GET, and POST to `query`, `metadata`, `token` and `utilityNetwork` endpoints; other POST (`applyEdits`, version
+    actions ...) are retried on 429 / 503 only.
+
+    After `HTTP_CIRCUIT_FAILURES` consecutive failures of a host its circuit opens: requests to it fail at once for
+    `HTTP_CIRCUIT_RESET` seconds, then one request is let through and closes the circuit again if it succeeds.
+
+    With `HTTP_HEDGE_PERCENTILE` (e.g. `0.95`) a query page still running after that percentile of the recent query
+    latencies is sent a second time, when one of the pooled connections of the host is free, and the first response wins.
+
+    =====================            =====================================================================================
+    **Config Keys**                  **Description**
+    ---------------------            -------------------------------------------------------------------------------------
+    HTTP_RETRIES=3                   Retries per request, `0` disables them.
+    ---------------------            -------------------------------------------------------------------------------------
+    HTTP_BACKOFF=0.5                 Seconds of the first backoff.
+    ---------------------            -------------------------------------------------------------------------------------
+    HTTP_BACKOFF_MAX=30              Longest backoff in seconds.
+    ---------------------            -------------------------------------------------------------------------------------
+    HTTP_RETRY_STATUSES              Retryable HTTP statuses, default `429,500,502,503,504`.
+    ---------------------            -------------------------------------------------------------------------------------
+    HTTP_RETRY_ERROR_CODES           Retryable ArcGIS JSON `error.code`, default `429,500,502,503,504`.
+    ---------------------            -------------------------------------------------------------------------------------
+    HTTP_CIRCUIT_FAILURES=5          Consecutive failures opening the circuit of a host, `0` disables it.
+    ---------------------            -------------------------------------------------------------------------------------
+    HTTP_CIRCUIT_RESET=30            Seconds the circuit stays open.
+    ---------------------            -------------------------------------------------------------------------------------
+    HTTP_HEDGE_PERCENTILE=0          Latency percentile after which a query page is hedged, `0` disables hedging.
+    ---------------------            -------------------------------------------------------------------------------------
+    HTTP_HEDGE_MIN_SAMPLES=20        Query latencies needed before hedging starts (last 200 are kept).
+    =====================            =====================================================================================
+  """
+  IDEMPOTENT_ENDPOINTS = ("query", "metadata", "token", "utilityNetwork")
+
+  def __init__(self, configs=None) -> None:
+    configs = configs or {}
+    codes = lambda key, default: {int(code) for code in str(UTILS.getConfigValue(configs, key, default)).split(",") if code.strip()}
+    self.retries = int(UTILS.getConfigValue(configs, "HTTP_RETRIES", 3))
+    self.backoff = float(UTILS.getConfigValue(configs, "HTTP_BACKOFF", 0.5))
+    self.backoffMax = float(UTILS.getConfigValue(configs, "HTTP_BACKOFF_MAX", 30))
+    self.retryStatuses = codes("HTTP_RETRY_STATUSES", "429,500,502,503,504")
+    self.retryErrorCodes = codes("HTTP_RETRY_ERROR_CODES", "429,500,502,503,504")
+    self.circuitFailures = int(UTILS.getConfigValue(configs, "HTTP_CIRCUIT_FAILURES", 5))
+    self.circuitReset = float(UTILS.getConfigValue(configs, "HTTP_CIRCUIT_RESET", 30))
+    self.hedgePercentile = float(UTILS.getConfigValue(configs, "HTTP_HEDGE_PERCENTILE", 0))
+    self.hedgeMinSamples = int(UTILS.getConfigValue(configs, "HTTP_HEDGE_MIN_SAMPLES", 20))
+    self._circuits = {}
+    self._latencies = {}
+    self._lock = threading.Lock()
+
+  def is_idempotent(self, method:str, url:str)->bool:
+    return method.upper() in ("GET", "HEAD", "OPTIONS") or UTILS.get_endpoint_class(url) in resiliencePolicy.IDEMPOTENT_ENDPOINTS
+
+  def retry_reason(self, response:requests.Response, idempotent:bool)->str:
+    """
+      Returns why the response should be retried (`"http_503"`, `"arcgis_500"` ...), `None` when it is final.
+    """
+    status = response.status_code
+    if status in self.retryStatuses:
+      return f"http_{status}" if idempotent or status in (429, 503) else None
+    if status == 200 and idempotent:
+      code = resiliencePolicy.arcgis_error_code(response.content)
+      if code in self.retryErrorCodes:
+        return f"arcgis_{code}"
+    return None
+
+  @staticmethod
+  def arcgis_error_code(content:bytes):
+    """
+      Returns `error.code` of an ArcGIS JSON error body, `None` for other bodies (only small JSON bodies with `"error"` are parsed).
+    """
+    if not content or len(content) > 65536 or content.lstrip()[:1] != b"{" or b'"error"' not in content[:128]:
+      return None
+    try:
+      return (json.loads(content).get("error") or {}).get("code")
+    except (ValueError, AttributeError):
+      return None
+
+  def delay(self, attempt:int, response:requests.Response=None)->float:
+    """
+    Backoff before retry `attempt + 1`: `Retry-After` when the server sent it, full jitter otherwise.
+    """
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.strip().isdigit():
+      return min(self.backoffMax, float(retry_after))
+    return random.uniform(0, min(self.backoffMax, self.backoff * 2 ** attempt))
+
+  # ---- Circuit breaker
+
+  @staticmethod
+  def _host(url:str)->str:
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+  def check_circuit(self, url:str):
+    """
+      Raises when the circuit of the host is open. Once `HTTP_CIRCUIT_RESET` has passed, one caller gets through (half-open).
+    """
+    if self.circuitFailures <= 0:
+      return
+    host = resiliencePolicy._host(url)
+    with self._lock:
+      circuit = self._circuits.get(host)
+      if circuit is None or circuit["openedAt"] is None:
+        return
+      remaining = circuit["openedAt"] + self.circuitReset - time.monotonic()
+      if remaining <= 0 and not circuit["probing"]:
+        circuit["probing"] = True
+        return
+    raise Exception(f"Circuit open for {host} after {circuit['failures']} consecutive failures, retry in {max(remaining, 0):.0f} s.")
+
+  def record(self, url:str, success:bool)->bool:
+    """
+      Records the outcome of a request to the host; returns `True` when this failure opened the circuit.
+    """
+    if self.circuitFailures <= 0:
+      return False
+    host = resiliencePolicy._host(url)
+    with self._lock:
+      circuit = self._circuits.setdefault(host, {"failures": 0, "openedAt": None, "probing": False})
+      if success:
+        circuit.update(failures=0, openedAt=None, probing=False)
+        return False
+      circuit["failures"] += 1
+      reopened = circuit["probing"] or (circuit["openedAt"] is None and circuit["failures"] >= self.circuitFailures)
+      if reopened:
+        circuit.update(openedAt=time.monotonic(), probing=False)
+      return reopened
+
+  # ---- Hedging
+
+  def observe_latency(self, endpoint:str, latency:float):
+    with self._lock:
+      self._latencies.setdefault(endpoint, deque(maxlen=200)).append(latency)
+
+  def hedge_delay(self, endpoint:str):
+    """
+      Seconds after which a request of the endpoint is hedged, `None` when hedging is off or not enough latencies were seen.
+    """
+    if self.hedgePercentile <= 0 or endpoint != "query":
+      return None
+    with self._lock:
+      latencies = sorted(self._latencies.get(endpoint) or ())
+    if len(latencies) < self.hedgeMinSamples:
+      return None
+    return latencies[min(len(latencies) - 1, int(self.hedgePercentile * len(latencies)))]
+
+class httpTransport:
+  """
+    Shared HTTP transport used by `restHelper.callRest` and `esriHelper.evaluate_url`.
+
+    A single `requests.Session` keeps pooled keep-alive connections per host, so consecutive
+    requests against the portal reuse the TCP/TLS connection instead of handshaking every time.
+
+    =====================        =====================================================================================
+    **Config Keys**              **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    HTTP_POOL_HOSTS=10           Number of hosts for which a connection pool is kept.
+    ---------------------        -------------------------------------------------------------------------------------
+    HTTP_POOL_SIZE=10            Maximum number of keep-alive connections kept per host.
+    ---------------------        -------------------------------------------------------------------------------------
+    HTTP_CONNECT_TIMEOUT=10      Seconds to wait for the TCP/TLS connection to be established.
+    ---------------------        -------------------------------------------------------------------------------------
+    HTTP_READ_TIMEOUT=120        Seconds to wait for the server to send the response.
+    ---------------------        -------------------------------------------------------------------------------------
+    METRICS_TRACE_PATH           JSON lines file of the request events (`jsonLinesTrace`). Not written when not set.
+    ---------------------        -------------------------------------------------------------------------------------
+    METRICS_TRACE_SAMPLE=1       Share of the requests written to `METRICS_TRACE_PATH`.
+    ---------------------        -------------------------------------------------------------------------------------
+    PAYLOAD_LOG_MAX_BYTES=2048   Bytes of the response bodies logged at DEBUG level (`payloadLogger`).
+    ---------------------        -------------------------------------------------------------------------------------
+    PAYLOAD_LOG_SAMPLE=1         Share of the response bodies logged at DEBUG level.
+    ---------------------        -------------------------------------------------------------------------------------
+    HTTP_RATE_LIMIT=0            Requests per second per host (`hostRateLimiter`), `0` for no limit.
+    ---------------------        -------------------------------------------------------------------------------------
+    HTTP_RATE_BURST              Burst of `HTTP_RATE_LIMIT`. Default the rate.
+    ---------------------        -------------------------------------------------------------------------------------
+    HTTP_RETRIES, ...            Retries, circuit breaker and hedging, see `resiliencePolicy`.
+    =====================        =====================================================================================
+
+    Every request produces an event passed to the hooks (`add_hook`):
+    `{"method", "endpoint", "url", "status", "latency", "bytesSent", "bytesReceived", "retries", "page", "error"}`,
+    `endpoint` being `UTILS.get_endpoint_class(url)`. `metrics` (`requestMetrics`) is always one of the hooks.
+    Every attempt is an event (`retries` > 0 for the retries, `hedged` for the hedge of a query page); retries are
+    also counted in `metrics` as `retries{endpoint, reason}`. A hedge is only sent when one of the `HTTP_POOL_SIZE`
+    connections of the host is free, otherwise it is skipped (`hedges_skipped`) instead of waiting for the pool.
+  """
+  def __init__(self, configs=None) -> None:
+    configs = configs or {}
+    self._poolHosts = int(UTILS.getConfigValue(configs, "HTTP_POOL_HOSTS", 10))
+    self._poolSize = int(UTILS.getConfigValue(configs, "HTTP_POOL_SIZE", 10))
+    self._connectTimeout = float(UTILS.getConfigValue(configs, "HTTP_CONNECT_TIMEOUT", 10))
+    self._readTimeout = float(UTILS.getConfigValue(configs, "HTTP_READ_TIMEOUT", 120))
+
+    self._session = requests.Session()
+    # pool_block keeps the number of open connections per host at HTTP_POOL_SIZE even when more threads are calling.
+    adapter = HTTPAdapter(pool_connections=self._poolHosts, pool_maxsize=self._poolSize, pool_block=True)
+    self._session.mount("https://", adapter)
+    self._session.mount("http://", adapter)
+    self._session.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+    rateLimit = float(UTILS.getConfigValue(configs, "HTTP_RATE_LIMIT", 0))
+    rateBurst = UTILS.getConfigValue(configs, "HTTP_RATE_BURST")
+    self.rate_limiter = hostRateLimiter(rateLimit, int(rateBurst) if rateBurst else None) if rateLimit > 0 else None
+    self.policy = resiliencePolicy(configs)
+    self._hedgeExecutor = None
+    self._hedgeLock = threading.Lock()
+    # One slot per pooled connection of a host: requests wait for a slot, hedges only take a free one.
+    self._connectionSlots = {}
+
+    self._hooks = []
+    self._metrics = requestMetrics()
+    self.add_hook(self._metrics.observe)
+    tracePath = UTILS.getConfigValue(configs, "METRICS_TRACE_PATH")
+    if tracePath:
+      self.add_hook(jsonLinesTrace(os.path.expanduser(tracePath), sample_rate=float(UTILS.getConfigValue(configs, "METRICS_TRACE_SAMPLE", 1))))
+    self.add_hook(payloadLogger(max_bytes=int(UTILS.getConfigValue(configs, "PAYLOAD_LOG_MAX_BYTES", 2048)),
+                                sample_rate=float(UTILS.getConfigValue(configs, "PAYLOAD_LOG_SAMPLE", 1))))
+
+  @property
+  def metrics(self)->requestMetrics:
+    """
+    Returns the `requestMetrics` of the requests sent through this transport.
+    """
+    return self._metrics
+
+  def add_hook(self, hook):
+    """
+    Registers `hook(event:dict, response)` called after every request (`response` is `None` when the request raised).
+    Hooks run on the calling thread; exceptions raised by a hook are logged and ignored.
+    """
+    self._hooks.append(hook)
+
+  def remove_hook(self, hook):
+    self._hooks.remove(hook)
+
+  @property
+  def timeout(self):
+    """
+    Returns the `(connect, read)` timeout tuple used for every request.
+    """
+    return (self._connectTimeout, self._readTimeout)
+
+  def request(self, method:str, url:str, trace:dict=None, idempotent:bool=None, rate_limiter:hostRateLimiter=None, **kwargs)->requests.Response:
+    """
+      Sends the request through the pooled session and returns the `requests.Response`, retried according to `policy`
+      (`resiliencePolicy`). The last response is returned when the retries are used up; connection errors are raised.
+
+      =====================    =====================================================================================
+      **Keys**                 **Description**
+      ---------------------    -------------------------------------------------------------------------------------
+      method:str               HTTP method, e.g. `"GET"` or `"POST"`.
+      ---------------------    -------------------------------------------------------------------------------------
+      url:str                  URL of the request.
+      ---------------------    -------------------------------------------------------------------------------------
+      trace:dict=None          Extra fields of the request event, e.g. `{"page": 3}` or `{"retries": 1}`.
+      ---------------------    -------------------------------------------------------------------------------------
+      idempotent:bool=None     Whether the request may be sent again after it reached the server. Default from the method and endpoint.
+      ---------------------    -------------------------------------------------------------------------------------
+      rate_limiter=None        `hostRateLimiter` of this request (every attempt), instead of the transport's `rate_limiter`.
+      ---------------------    -------------------------------------------------------------------------------------
+      kwargs                   Passed to `requests.Session.request` (`headers`, `data`, `json`, `verify` ...).
+      =====================    =====================================================================================
+
+      :returns:
+        HTTP reponse.
+    """
+    kwargs.setdefault("timeout", self.timeout)
+    policy = self.policy
+    if idempotent is None:
+      idempotent = policy.is_idempotent(method, url)
+    endpoint = UTILS.get_endpoint_class(url)
+    retried = (trace or {}).get("retries") or 0
+    attempt = 0
+    while True:
+      policy.check_circuit(url)
+      attempt_trace = dict(trace or {}, retries=retried + attempt) if attempt else trace
+      response = None
+      try:
+        response = self._send_hedged(method, url, attempt_trace, endpoint, rate_limiter=rate_limiter, **kwargs) if idempotent else self._send(method, url, attempt_trace, rate_limiter=rate_limiter, **kwargs)
+      except requests.RequestException as ex:
+        self._record(url, False)
+        # A connect timeout never reached the server, it is safe to send again.
+        if attempt >= policy.retries or not (idempotent or isinstance(ex, requests.ConnectTimeout)):
+          raise
+        reason = type(ex).__name__
+      else:
+        reason = policy.retry_reason(response, idempotent)
+        self._record(url, reason is None and response.status_code < 500)
+        if reason is None or attempt >= policy.retries:
+          return response
+      delay = policy.delay(attempt, response)
+      self._metrics.increment("retries", endpoint=endpoint, reason=reason)
+      logger.info(f"Retrying {method} {url.split('?', 1)[0]} in {delay:.2f} s ({reason}, retry {attempt + 1} of {policy.retries}).")
+      time.sleep(delay)
+      attempt += 1
+
+  def _record(self, url:str, success:bool):
+    if self.policy.record(url, success):
+      self._metrics.increment("circuit_opened", host=resiliencePolicy._host(url))
+      logger.warning(f"Circuit opened for {resiliencePolicy._host(url)} for {self.policy.circuitReset:.0f} s.")
+
+  def _connection_slot(self, url:str)->threading.BoundedSemaphore:
+    host = resiliencePolicy._host(url)
+    with self._hedgeLock:
+      slot = self._connectionSlots.get(host)
+      if slot is None:
+        slot = self._connectionSlots[host] = threading.BoundedSemaphore(self._poolSize)
+      return slot
+
+  def _send_hedged(self, method:str, url:str, trace:dict, endpoint:str, **kwargs)->requests.Response:
+    """
+      Sends the request; when it is still running after `policy.hedge_delay`, sends it a second time and returns the first response.
+      The hedge is skipped when no connection of the host is free: it would wait for the pool behind the requests it should overtake.
+    """
+    hedge_after = self.policy.hedge_delay(endpoint)
+    if hedge_after is None:
+      return self._send(method, url, trace, **kwargs)
+    with self._hedgeLock:
+      if self._hedgeExecutor is None:
+        self._hedgeExecutor = ThreadPoolExecutor(max_workers=self._poolSize * 2, thread_name_prefix="hedge")
+    primary = self._hedgeExecutor.submit(self._send, method, url, trace, **kwargs)
+    done, _ = wait([primary], timeout=hedge_after)
+    if done:
+      return primary.result()
+    hedge = self._hedgeExecutor.submit(self._send_hedge, method, url, dict(trace or {}, hedged=True), endpoint, **kwargs)
+    pending = {primary, hedge}
+    while pending:
+      done, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        if future.exception() is None and future.result() is not None:
+          if future is hedge:
+            self._metrics.increment("hedge_wins", endpoint=endpoint)
+          return future.result()
+    return primary.result()
+
+  def _send_hedge(self, method:str, url:str, trace:dict, endpoint:str, **kwargs)->requests.Response:
+    """
+      The second request of `_send_hedged`, only sent when a connection slot of the host is free. Returns `None` when skipped.
+    """
+    slot = self._connection_slot(url)
+    if not slot.acquire(blocking=False):
+      self._metrics.increment("hedges_skipped", endpoint=endpoint)
+      return None
+    self._metrics.increment("hedged_requests", endpoint=endpoint)
+    return self._send(method, url, trace, slot=slot, **kwargs)
+
+  def _send(self, method:str, url:str, trace:dict=None, slot:threading.BoundedSemaphore=None, rate_limiter:hostRateLimiter=None, **kwargs)->requests.Response:
+    """
+      One attempt: rate limit, connection slot, request and request event. `slot` is a connection slot already acquired for the attempt,
+      `rate_limiter` replaces the transport's one.
+    """
+    rate_limiter = rate_limiter or self.rate_limiter
+    if rate_limiter is not None:
+      rate_limiter.acquire(url)
+    if slot is None:
+      slot = self._connection_slot(url)
+      slot.acquire()
+    try:
+      return self._send_once(method, url, trace, **kwargs)
+    finally:
+      slot.release()
+
+  def _send_once(self, method:str, url:str, trace:dict=None, **kwargs)->requests.Response:
+    if not self._hooks:
+      start = time.perf_counter()
+      response = self._session.request(method, url, **kwargs)
+      if response.status_code == 200:
+        self.policy.observe_latency(UTILS.get_endpoint_class(url), time.perf_counter() - start)
+      return response
+
+    event = {"method": method, "endpoint": UTILS.get_endpoint_class(url), "url": url.split("?", 1)[0], "status": None, "latency": 0.0,
+             "bytesSent": 0, "bytesReceived": 0, "retries": 0, "page": None, "error": None}
+    if trace:
+      event.update(trace)
+    response = None
+    start = time.perf_counter()
+    try:
+      response = self._session.request(method, url, **kwargs)
+      return response
+    except Exception as ex:
+      event["error"] = type(ex).__name__
+      raise
+    finally:
+      event["latency"] = time.perf_counter() - start
+      if response is not None:
+        event["status"] = response.status_code
+        if response.status_code == 200:
+          self.policy.observe_latency(event["endpoint"], event["latency"])
+        body = response.request.body
+        event["bytesSent"] = len(body) if body else 0
+        try:
+          # Bytes on the wire (compressed), the decoded size otherwise.
+          event["bytesReceived"] = response.raw.tell() or len(response.content)
+        except Exception:
+          event["bytesReceived"] = len(response.content or b"")
+      for hook in self._hooks:
+        try:
+          hook(event, response)
+        except Exception:
+          logger.warning(f"Request hook failed: {traceback.format_exc()}")
+
+  def close(self):
+    if self._hedgeExecutor is not None:
+      self._hedgeExecutor.shutdown(wait=False)
+    self._session.close()
+
+class tokenCache:
+  """
+    Encrypted on-disk token cache, so short runs can reuse a token that is still valid instead of logging in again.
+
+    On Windows the file is encrypted with DPAPI for the current user. Elsewhere `cryptography` (Fernet) is used with the
+    key of the `ARCGIS_TOKEN_CACHE_KEY` environment variable (`Fernet.generate_key()`). Without either, nothing is persisted.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    path:str                     Folder where the token files are written.
+    =====================        =====================================================================================
+  """
+  def __init__(self, path:str) -> None:
+    self._path = path
+    self._lock = threading.Lock()
+
+  @property
+  def enabled(self)->bool:
+    return os.name == "nt" or bool(os.environ.get("ARCGIS_TOKEN_CACHE_KEY"))
+
+  def _file(self, key:str)->str:
+    return os.path.join(self._path, hashlib.sha256(key.encode("UTF-8")).hexdigest()[:32] + ".token")
+
+  def load(self, key:str):
+    """
+      Returns `(token, expiration)` stored for `key`, `None` when missing or unreadable.
+    """
+    if not self.enabled:
+      return None
+    try:
+      with open(self._file(key), "rb") as file:
+        data = json.loads(self._decrypt(file.read()))
+      if data.get("key") != key:
+        return None
+      return data["token"], datetime.datetime.fromtimestamp(data["expires"])
+    except Exception:
+      return None
+
+  def save(self, key:str, token:str, expiration:datetime.datetime):
+    if not self.enabled:
+      logger.warning("Token cache disabled: set ARCGIS_TOKEN_CACHE_KEY (and install 'cryptography') to persist tokens.")
+      return
+    data = json.dumps({"key": key, "token": token, "expires": expiration.timestamp()}).encode("UTF-8")
+    file_name = self._file(key)
+    with self._lock:
+      os.makedirs(self._path, exist_ok=True)
+      temp_name = f"{file_name}.{os.getpid()}.tmp"
+      with open(temp_name, "wb") as file:
+        file.write(self._encrypt(data))
+      os.chmod(temp_name, 0o600)
+      os.replace(temp_name, file_name)
+
+  def remove(self, key:str):
+    try:
+      os.remove(self._file(key))
+    except OSError:
+      pass
+
+  def _encrypt(self, data:bytes)->bytes:
+    if os.name == "nt":
+      return tokenCache._dpapi(data, True)
+    from cryptography.fernet import Fernet
+    return Fernet(os.environ["ARCGIS_TOKEN_CACHE_KEY"].encode("UTF-8")).encrypt(data)
+
+  def _decrypt(self, data:bytes)->bytes:
+    if os.name == "nt":
+      return tokenCache._dpapi(data, False)
+    from cryptography.fernet import Fernet
+    return Fernet(os.environ["ARCGIS_TOKEN_CACHE_KEY"].encode("UTF-8")).decrypt(data)
+
+  @staticmethod
+  def _dpapi(data:bytes, protect:bool)->bytes:
+    import ctypes
+    from ctypes import wintypes
+
+    class DATA_BLOB(ctypes.Structure):
+      _fields_ = [("cbData", wintypes.DWORD), ("pbData", ctypes.POINTER(ctypes.c_char))]
+
+    buffer = ctypes.create_string_buffer(data, len(data))
+    blob_in = DATA_BLOB(len(data), ctypes.cast(buffer, ctypes.POINTER(ctypes.c_char)))
+    blob_out = DATA_BLOB()
+    CRYPTPROTECT_UI_FORBIDDEN = 0x1
+    func = ctypes.windll.crypt32.CryptProtectData if protect else ctypes.windll.crypt32.CryptUnprotectData
+    if not func(ctypes.byref(blob_in), None, None, None, None, CRYPTPROTECT_UI_FORBIDDEN, ctypes.byref(blob_out)):
+      raise ctypes.WinError()
+    try:
+      return ctypes.string_at(blob_out.pbData, blob_out.cbData)
+    finally:
+      ctypes.windll.kernel32.LocalFree(blob_out.pbData)
+
+class tokenManager:
+  """
+    Thread-safe token holder shared by all workers.
+
+    - Single-flight: when the token is missing or expired, one caller requests a new one and the others wait for it.
+    - Proactive: a background timer refreshes the token `refresh_margin` seconds before it expires, and callers never get
+      a token expiring within the margin, so it does not expire in the middle of a request.
+    - Persisted: with a `tokenCache` the token is reused by the next process while it is valid.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    fetch                        Function returning `(token, expiration:datetime)`.
+    ---------------------        -------------------------------------------------------------------------------------
+    refresh_margin:float=300     Seconds before expiration when the token is refreshed.
+    ---------------------        -------------------------------------------------------------------------------------
+    background:bool=True         Refresh on a background timer instead of on the next `get()`.
+    ---------------------        -------------------------------------------------------------------------------------
+    cache:tokenCache=None        Optional on-disk cache.
+    ---------------------        -------------------------------------------------------------------------------------
+    cache_key:str=None           Identifies the token in the cache, e.g. portal URL and user name.
+    =====================        =====================================================================================
+  """
+  def __init__(self, fetch, refresh_margin:float=300, background:bool=True, cache:tokenCache=None, cache_key:str=None) -> None:
+    self._fetch = fetch
+    self._refreshMargin = timedelta(seconds=refresh_margin)
+    self._background = background
+    self._cache = cache if cache_key else None
+    self._cacheKey = cache_key
+    self._lock = threading.Lock()
+    self._timer = None
+    # (token, expiration) replaced as a whole, so readers without the lock always see a consistent pair.
+    self._current = None
+    # Recent tokens of this manager, callers may still hold one of them after a refresh.
+    self._issued = deque(maxlen=8)
+    if self._cache is not None:
+      self._current = self._cache.load(self._cacheKey)
+      if self._current is not None:
+        self._issued.append(self._current[0])
+        self._schedule(self._current[1])
+
+  def _is_fresh(self, current)->bool:
+    return current is not None and current[1] - self._refreshMargin > datetime.datetime.now()
+
+  def get(self)->str:
+    """
+      Returns a token valid for at least `refresh_margin` seconds.
+    """
+    current = self._current
+    if self._is_fresh(current):
+      return current[0]
+
+    with self._lock:
+      current = self._current
+      if self._is_fresh(current):
+        return current[0]
+      return self._refresh()
+
+  def issued(self, token:str)->bool:
+    """
+      Returns whether `token` is one of the recent tokens of this manager.
+    """
+    return token in tuple(self._issued)
+
+  def invalidate(self):
+    """
+      Drops the token, e.g. after the server rejected it (498 / 499). The next `get()` requests a new one.
+    """
+    with self._lock:
+      self._current = None
+      if self._cache is not None:
+        self._cache.remove(self._cacheKey)
+
+  def close(self):
+    """
+      Stops the background refresh.
+    """
+    with self._lock:
+      if self._timer is not None:
+        self._timer.cancel()
+        self._timer = None
+
+  def _refresh(self)->str:
+    # Caller holds self._lock.
+    token, expiration = self._fetch()
+    self._current = (token, expiration)
+    self._issued.append(token)
+    if self._cache is not None:
+      try:
+        self._cache.save(self._cacheKey, token, expiration)
+      except Exception:
+        logger.warning(f"Token cache write failed: {traceback.format_exc()}")
+    self._schedule(expiration)
+    return token
+
+  def _schedule(self, expiration:datetime.datetime):
+    if not self._background:
+      return
+    if self._timer is not None:
+      self._timer.cancel()
+    delay = (expiration - self._refreshMargin - datetime.datetime.now()).total_seconds()
+    self._timer = threading.Timer(max(delay, 1), self._background_refresh)
+    self._timer.daemon = True
+    self._timer.start()
+
+  def _background_refresh(self):
+    with self._lock:
+      try:
+        self._refresh()
+      except Exception:
+        # The next get() retries in the foreground.
+        logger.warning(f"Background token refresh failed: {traceback.format_exc()}")
+
 class restHelper:
-  def __init__(self, configs) -> None:
+  def __init__(self, configs, transport:httpTransport=None) -> None:
     print("Initializing restHelper")
+    self._clientId = None
+    self._clientSecret = None
+    self._scope = None
+    self._apiUrl = None
+    self._tokenUrl = None
     if "clientId" in configs:
         self._clientId = configs["clientId"] if configs else None
         self._clientSecret = configs["clientSecret"] if configs else None
         self._scope = configs["scope"] if configs else None
         self._apiUrl = configs["apiUrl"] if configs and "apiUrl" in configs else None
-    self._token = None
+        self._tokenUrl = configs["tokenUrl"] if configs and "tokenUrl" in configs else None
     self._logger = None
-    self._expiration = datetime.datetime.now()
     self._logger = logger
+    self._transport = transport if transport else httpTransport(configs)
+    self._tokenManager = tokenManager(self._request_client_token,
+                                      refresh_margin=float(UTILS.getConfigValue(configs, "TOKEN_REFRESH_MARGIN", 300)),
+                                      cache=restHelper.get_token_cache(configs),
+                                      cache_key=f"client|{self._tokenUrl}|{self._clientId}|{self._scope}" if self._clientId else None)
+
+  @staticmethod
+  def get_token_cache(configs)->tokenCache:
+    """
+    Returns the `tokenCache` of the `TOKEN_CACHE_PATH` config key, `None` when it is not set.
+    """
+    path = UTILS.getConfigValue(configs, "TOKEN_CACHE_PATH")
+    return tokenCache(os.path.expanduser(path)) if path else None
+
+  def getToken(self)->str:
+    """
+    Returns a valid client-credentials token (`clientId`, `clientSecret`, `scope`, `tokenUrl` configs), see `tokenManager`.
+    """
+    return self._tokenManager.get()
+
+  def _request_client_token(self):
+    if not self._clientId or not self._tokenUrl:
+      raise Exception("clientId and tokenUrl are required to request a token.")
+
+    data = {
+      "grant_type": "client_credentials",
+      "client_id": self._clientId,
+      "client_secret": self._clientSecret,
+      "scope": self._scope
+    }
+    result = self.callRest(self._tokenUrl, data, "POST", True, ignoreToken=True)
+    jsonObj = result.json()
+    if "access_token" not in jsonObj:
+      raise Exception(f"Token request failed: {jsonObj.get('error_description', jsonObj.get('error'))}")
+    return jsonObj["access_token"], datetime.datetime.now() + timedelta(seconds=int(jsonObj.get("expires_in", 3600)))
+
+  @property
+  def transport(self)->httpTransport:
+    """
+    Returns the shared `httpTransport`.
+    """
+    return self._transport
+
+  def logInfo(self, message):
+    self._logger.info(message)
+
+  def logRequest(self, url, para=None):
+    """
+    Logs the request at DEBUG, token, password and client secret values masked (`UTILS.redact`).
+    """
+    if self._logger.isEnabledFor(logging.DEBUG):
+      self._logger.debug(UTILS.redact(url if para is None else f"{url} {json.dumps(para, default=str)}"))
 
   def callRest(self, url, para = None, httpMode = 'GET', isForm = False, isJson = False, ignoreToken = False, verify=True):
     response = None
@@ -86,7 +1131,7 @@ class restHelper:
     if not ignoreToken:
         headers = {
             "Authorization": "Bearer {}".format(self.getToken()),
-            "client_id": self.clientId,
+            "client_id": self._clientId,
             "Content-type": "application/json"
         }
 
@@ -97,91 +1142,1404 @@ class restHelper:
         else:
             combinedUrl = url
 
-        if "secret" in combinedUrl.lower() or "pass" in combinedUrl.lower():
-            self.logInfo("") # This line seems to have an empty string argument
-        else:
-            self.logInfo(combinedUrl)
+        self.logRequest(combinedUrl)
 
         if (httpMode == "POST"):
-            response = requests.post(combinedUrl, headers=headers, verify=verify)
+            response = self._transport.request("POST", combinedUrl, headers=headers, verify=verify)
         else:
-            response = requests.get(combinedUrl, headers=headers, verify=verify)
+            response = self._transport.request("GET", combinedUrl, headers=headers, verify=verify)
 
     elif isForm:
-        self.logInfo(url)
         if (httpMode == "POST"):
             headers = {
                 "Content-Type": "application/x-www-form-urlencoded"
             }
-            if not any("secret" in item or "password" in item for item in para.keys()):
-                self.logInfo(para)
-            else:
-                self.logInfo("Secret token requested")
-
-            response = requests.post(url, headers=headers, data=para, verify=verify)
+            self.logRequest(url, para)
+            response = self._transport.request("POST", url, headers=headers, data=para, verify=verify)
         else:
-            response = requests.get(url, headers=headers, verify=verify)
+            self.logRequest(url)
+            response = self._transport.request("GET", url, headers=headers, verify=verify)
 
     elif isJson:
         if (httpMode == "POST"):
-            if not any("secret" in item or "password" in item for item in para.keys()):
-                self.logInfo(para)
-            else:
-                self.logInfo("Secret token requested")
-
-            response = requests.post(url, headers=headers, json=para, verify=verify)
+            self.logRequest(url, para)
+            response = self._transport.request("POST", url, headers=headers, json=para, verify=verify)
         else:
-            response = requests.get(url, headers=headers, verify=verify)
+            self.logRequest(url)
+            response = self._transport.request("GET", url, headers=headers, verify=verify)
 
     self.logInfo("status code: {0}".format(response.status_code))
-    self.logInfo(str(response.content))
+    # The body is logged by the transport's payloadLogger (DEBUG, size capped, redacted).
     return response
 
-class esriHelper:
-  def __init__(self, restHelper:restHelper, configs)-> None:
-    self._restHelper = restHelper
-    self._configs = configs
-    portalUrl = UTILS.getConfigValue(config, "PORTAL_URL")
-    portalUser = UTILS.getConfigValue(config, "PORTAL_USER")
-    portalPass = UTILS.getConfigValue(config, "PORTAL_PASS")
-    baseServiceUrl = UTILS.getConfigValue(config, "BASE_SERVICE_URL")
-    versionName = UTILS.getConfigValue(config, "VERSION_NAME")
-    versionOwner = UTILS.getConfigValue(config, "VERSION_OWNER")
-
-    self._gis = GIS(url= portalUrl, username= portalUser, password= portalPass)
-    self._featureServerUrl = f"{baseServiceUrl}/FeatureServer"
-    self._versionUrl = f"{baseServiceUrl}/VersionManagementServer"
-    self._unSererUrl = f"{baseServiceUrl}/UtilityNetworkServer"
+class layerMetadata:
+  """
+    Layer metadata JSON with domain lookups precomputed per `(subtype, field)`.
+    Inherited subtype domains are resolved once from the layer's `fields`.
+  """
+  def __init__(self, info:dict) -> None:
+    self.info = info
+    self.subtypeField = info.get("subtypeField") or None
+    self.hasSubtypes = bool(info.get("types"))
+    self.version = layerMetadata.get_version(info)
+    self._codedValues = {}
+    self._nameToCode = {}
+    self._codeToName = {}
+    self._domainMaps = {}
 
-    self._portalUrl = portalUrl
-    self._portalUserName = portalUser
-    self._portalPass = portalPass
-    self._versionName = versionName
-    self._versionOwner = versionOwner
-    self._expiration = datetime.datetime.now()
-    self._token = None #needed
-    self._token = self.generatePortalToken()
+    field_domains = {}
+    for field in info.get("fields") or []:
+      domain = field.get("domain") or {}
+      if "codedValues" in domain:
+        field_domains[field["name"].lower()] = domain["codedValues"]
+        self._add(None, field["name"], domain["codedValues"])
 
+    for st in info.get("types") or []:
+      for fieldName, domain in (st.get("domains") or {}).items():
+        if "codedValues" in domain:
+          self._add(st.get("id"), fieldName, domain["codedValues"])
+        elif domain.get("type") == "inherited" and fieldName.lower() in field_domains:
+          self._add(st.get("id"), fieldName, field_domains[fieldName.lower()])
 
-  @property
-  def token(self):
+  def _add(self, subTypeCode, fieldName:str, codedValues:list):
+    key = (subTypeCode, fieldName.lower())
+    self._codedValues[key] = codedValues
+    self._nameToCode[key] = {str(d["name"]).lower(): d["code"] for d in codedValues}
+    self._codeToName[key] = {d["code"]: d["name"] for d in codedValues}
+
+  def _key(self, subTypeCode, fieldName:str):
+    # Layers without subtypes only have field level domains.
+    return (subTypeCode if self.hasSubtypes else None, fieldName.lower())
+
+  def coded_values(self, subTypeCode, fieldName:str)->list:
+    return self._codedValues.get(self._key(subTypeCode, fieldName), [])
+
+  def name_to_code(self, subTypeCode, fieldName:str)->dict:
+    """
+    Returns `{lower case name: code}` of the domain.
+    """
+    return self._nameToCode.get(self._key(subTypeCode, fieldName), {})
+
+  def code_to_name(self, subTypeCode, fieldName:str)->dict:
+    """
+    Returns `{code: name}` of the domain.
+    """
+    return self._codeToName.get(self._key(subTypeCode, fieldName), {})
+
+  def domain_maps(self, reverse:bool=False)->dict:
+    """
+    Returns `{subtype: {field name: mapping}}` for all domain fields, mapping code->name, or lower case name->code with `reverse`.
+    Subtype `None` holds the field level domains. Field names are spelled as in the layer's `fields`.
+    """
+    maps = self._domainMaps.get(reverse)
+    if maps is None:
+      source = self._nameToCode if reverse else self._codeToName
+      names = {f["name"].lower(): f["name"] for f in self.info.get("fields") or []}
+      maps = {}
+      for (subTypeCode, fieldName), mapping in source.items():
+        maps.setdefault(subTypeCode, {})[names.get(fieldName, fieldName)] = mapping
+      self._domainMaps[reverse] = maps
+    return maps
+
+  @staticmethod
+  def get_version(info:dict)->tuple:
+    """
+    Returns what identifies the data and schema state of the layer: `editingInfo.lastEditDate`, `editingInfo.schemaLastEditDate` and the `fields` / `types` definitions.
+    """
+    editing_info = info.get("editingInfo") or {}
+    schema = json.dumps([info.get("fields"), info.get("types")], sort_keys=True, default=str)
+    return (editing_info.get("lastEditDate"), editing_info.get("schemaLastEditDate"), hash(schema))
+
+class layerMetadataCache:
+  """
+    Layer metadata cache keyed by layer URL, with TTL and LRU eviction.
+
+    Entries older than `ttl` seconds are re-validated: the layer JSON is requested again and the domain
+    lookups are rebuilt only when `editingInfo.lastEditDate` or the schema has changed.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    fetch                        Function `fetch(layer_url, token)` returning the layer JSON.
+    ---------------------        -------------------------------------------------------------------------------------
+    ttl:float=300                Seconds an entry is used without asking the server.
+    ---------------------        -------------------------------------------------------------------------------------
+    max_entries:int=128          Number of layers kept, the least recently used is evicted first.
+    =====================        =====================================================================================
+  """
+  def __init__(self, fetch, ttl:float=300, max_entries:int=128) -> None:
+    self._fetch = fetch
+    self._ttl = ttl
+    self._maxEntries = max_entries
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self._urlLocks = {}
+
+  def get(self, layer_url:str, token:str=None, max_age:float=None)->layerMetadata:
+    """
+      Returns the `layerMetadata` of the layer, from the cache when it is not older than `ttl` (or `max_age` when smaller).
+      With `max_age=0` the layer JSON is requested again, callers arriving during that request share it.
+    """
+    key = layer_url.rstrip("/").lower()
+    ttl = self._ttl if max_age is None else min(self._ttl, max_age)
+    requested_at = time.monotonic()
+    fresh = lambda entry: entry is not None and requested_at - entry[0] < ttl
+    entry = self._lookup(key)
+    if fresh(entry):
+      return entry[1]
+
+    with self._lock:
+      url_lock = self._urlLocks.setdefault(key, threading.Lock())
+    # One request per layer even when many threads miss at the same time.
+    with url_lock:
+      entry = self._lookup(key)
+      if fresh(entry):
+        return entry[1]
+
+      # The entry is dated when the request starts, it may miss edits made while it runs.
+      fetched_at = time.monotonic()
+      info = self._fetch(layer_url, token)
+      metadata = entry[1] if entry is not None else None
+      if metadata is None or metadata.version != layerMetadata.get_version(info):
+        metadata = layerMetadata(info)
+      else:
+        metadata.info = info
+      self._store(key, (fetched_at, metadata))
+      return metadata
+
+  def invalidate(self, layer_url:str=None):
+    """
+      Removes the layer from the cache, or all layers when `layer_url` is `None`.
+    """
+    with self._lock:
+      if layer_url is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(layer_url.rstrip("/").lower(), None)
+
+  def _lookup(self, key:str):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        self._entries.move_to_end(key)
+      return entry
+
+  def _store(self, key:str, entry:tuple):
+    with self._lock:
+      self._entries[key] = entry
+      self._entries.move_to_end(key)
+      while len(self._entries) > self._maxEntries:
+        self._entries.popitem(last=False)
+
+class syncStateStore:
+  """
+    SQLite state of the incremental layer extraction (`esriHelper.iter_layer_changes`): per layer the watermark
+    (last seen edit date and OID) and, for delete detection, the object ids seen by the last run.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    path:str                     SQLite database file, created when missing.
+    =====================        =====================================================================================
+  """
+  def __init__(self, path:str) -> None:
+    self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._lock = threading.RLock()
+    with self._lock:
+      self._connection.execute("PRAGMA journal_mode=WAL")
+      self._connection.execute("CREATE TABLE IF NOT EXISTS watermarks (layer_url TEXT PRIMARY KEY, edit_date INTEGER, object_id INTEGER, updated_at REAL)")
+      self._connection.execute("CREATE TABLE IF NOT EXISTS layer_oids (layer_url TEXT, object_id INTEGER, PRIMARY KEY (layer_url, object_id)) WITHOUT ROWID")
+      self._connection.execute("CREATE TEMP TABLE IF NOT EXISTS staged_oids (layer_url TEXT, object_id INTEGER, PRIMARY KEY (layer_url, object_id)) WITHOUT ROWID")
+
+  @staticmethod
+  def _key(layer_url:str)->str:
+    return layer_url.rstrip("/").lower()
+
+  def get_watermark(self, layer_url:str):
+    """
+      Returns `(edit_date, object_id)` of the last completed run, `None` before the first one.
+    """
+    with self._lock:
+      row = self._connection.execute("SELECT edit_date, object_id FROM watermarks WHERE layer_url = ?", (syncStateStore._key(layer_url),)).fetchone()
+    return row
+
+  def stage_object_ids(self, layer_url:str, object_ids:list)->list:
+    """
+      Stages the current object ids of the layer and returns the ids of the last run that are missing (deleted).
+      The staged ids replace the stored ones on `advance(..., object_ids_staged=True)`.
+    """
+    key = syncStateStore._key(layer_url)
+    with self._lock:
+      self._connection.execute("BEGIN")
+      try:
+        self._connection.execute("DELETE FROM staged_oids WHERE layer_url = ?", (key,))
+        self._connection.executemany("INSERT OR IGNORE INTO staged_oids VALUES (?, ?)", ((key, oid) for oid in object_ids))
+        self._connection.execute("COMMIT")
+      except BaseException:
+        self._connection.execute("ROLLBACK")
+        raise
+      rows = self._connection.execute("SELECT o.object_id FROM layer_oids o WHERE o.layer_url = ? AND NOT EXISTS "
+                                      "(SELECT 1 FROM staged_oids s WHERE s.layer_url = o.layer_url AND s.object_id = o.object_id)", (key,)).fetchall()
+    return [row[0] for row in rows]
+
+  def advance(self, layer_url:str, edit_date:int, object_id:int, object_ids_staged:bool=False):
+    """
+      Stores the new watermark, and the staged object ids when `object_ids_staged`, in one transaction.
+    """
+    key = syncStateStore._key(layer_url)
+    with self._lock:
+      self._connection.execute("BEGIN IMMEDIATE")
+      try:
+        self._connection.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)", (key, edit_date, object_id, time.time()))
+        if object_ids_staged:
+          self._connection.execute("DELETE FROM layer_oids WHERE layer_url = ?", (key,))
+          self._connection.execute("INSERT INTO layer_oids SELECT layer_url, object_id FROM staged_oids WHERE layer_url = ?", (key,))
+          self._connection.execute("DELETE FROM staged_oids WHERE layer_url = ?", (key,))
+        self._connection.execute("COMMIT")
+      except BaseException:
+        self._connection.execute("ROLLBACK")
+        raise
+
+  def reset(self, layer_url:str):
+    """
+      Forgets the layer, the next run extracts it completely.
+    """
+    key = syncStateStore._key(layer_url)
+    with self._lock:
+      self._connection.execute("DELETE FROM watermarks WHERE layer_url = ?", (key,))
+      self._connection.execute("DELETE FROM layer_oids WHERE layer_url = ?", (key,))
+
+  def close(self):
+    with self._lock:
+      self._connection.close()
+
+class extractionStateStore:
+  """
+    SQLite progress of `featureServerExtractor` runs: per run and layer the position after the last completed page
+    (last OID, or offset for layers without `objectIdField`), the pages and records written and the size of the output file.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    path:str                     SQLite database file, created when missing.
+    =====================        =====================================================================================
+  """
+  def __init__(self, path:str) -> None:
+    self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._lock = threading.RLock()
+    with self._lock:
+      self._connection.execute("PRAGMA journal_mode=WAL")
+      self._connection.execute("CREATE TABLE IF NOT EXISTS extract_progress (run_id TEXT, layer_url TEXT, position INTEGER, pages INTEGER, "
+                               "records INTEGER, output_bytes INTEGER, completed INTEGER, updated_at REAL, PRIMARY KEY (run_id, layer_url))")
+
+  @staticmethod
+  def _key(layer_url:str)->str:
+    return layer_url.rstrip("/").lower()
+
+  def get(self, run_id:str, layer_url:str)->dict:
+    """
+      Returns `{"position", "pages", "records", "outputBytes", "completed"}` of the layer, `None` when the run has not started it.
+    """
+    with self._lock:
+      row = self._connection.execute("SELECT position, pages, records, output_bytes, completed FROM extract_progress WHERE run_id = ? AND layer_url = ?",
+                                     (run_id, extractionStateStore._key(layer_url))).fetchone()
+    if row is None:
+      return None
+    return {"position": row[0], "pages": row[1], "records": row[2], "outputBytes": row[3], "completed": bool(row[4])}
+
+  def save(self, run_id:str, layer_url:str, position:int, pages:int, records:int, output_bytes:int=0, completed:bool=False):
+    """
+      Stores the progress of the layer after a page was written.
+    """
+    with self._lock:
+      self._connection.execute("INSERT OR REPLACE INTO extract_progress VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (run_id, extractionStateStore._key(layer_url), position, pages, records, output_bytes, int(completed), time.time()))
+
+  def reset(self, run_id:str):
+    """
+      Forgets the run, the next `run` with this id starts over.
+    """
+    with self._lock:
+      self._connection.execute("DELETE FROM extract_progress WHERE run_id = ?", (run_id,))
+
+  def close(self):
+    with self._lock:
+      self._connection.close()
+
+class queryResultCache:
+  """
+    Persistent SQLite cache of layer query results (`.../FeatureServer/<layerId>/query`) used by `esriHelper.evaluate_url`.
+
+    The key is the normalized request (URL and sorted parameters, without `token`) and the caller (`principal`, e.g. the
+    portal user), so the results of a secured layer are never served to another user. Each entry stores the layer state
+    it was read from (`serverGens.serverGen`, `editingInfo.lastEditDate` and `schemaLastEditDate`) and is ignored once
+    the layer reports another state. `esriHelper.evaluate_url` takes that state from its layer metadata cache, read again
+    once older than `QUERY_CACHE_MAX_STALENESS` seconds (default `60`), so hits make no request. Edits sent through the
+    helper drop it at once; edits of other clients may be missed for up to that many seconds. Layers reporting none of
+    them are not cached. Entries are evicted least recently used first when the
+    cache grows over `max_bytes`.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    path:str                     SQLite database file, created when missing.
+    ---------------------        -------------------------------------------------------------------------------------
+    max_bytes:int=1GB            Size cap of the compressed results.
+    =====================        =====================================================================================
+  """
+  def __init__(self, path:str, max_bytes:int=1024**3) -> None:
+    self._maxBytes = max_bytes
+    self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._lock = threading.Lock()
+    with self._lock:
+      self._connection.execute("PRAGMA journal_mode=WAL")
+      self._connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, layer_url TEXT, validator TEXT, value BLOB, size INTEGER, last_access REAL)")
+      self._connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+      self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+  @staticmethod
+  def make_key(url:str, params:dict, principal:str=None)->str:
+    """
+    Returns the cache key of the request: URL and parameters normalized, `token` excluded, and the caller identified by `principal`.
+    """
+    normalized = sorted((str(k).lower(), str(v).lower() if isinstance(v, bool) else str(v)) for k, v in (params or {}).items() if str(k).lower() != "token")
+    return hashlib.sha256(json.dumps([url.rstrip("/").lower(), normalized, principal]).encode("UTF-8")).hexdigest()
+
+  @staticmethod
+  def get_validator(layer_info:dict)->str:
+    """
+    Returns the layer state the results depend on, `None` when the layer does not report any.
+    """
+    editing_info = layer_info.get("editingInfo") or {}
+    state = [(layer_info.get("serverGens") or {}).get("serverGen"), editing_info.get("lastEditDate"), editing_info.get("schemaLastEditDate")]
+    if all(value is None for value in state):
+      return None
+    return json.dumps(state)
+
+  def get(self, key:str, validator:str)->bytes:
+    """
+      Returns the cached response bytes, `None` when missing or read from another layer state.
+    """
+    with self._lock:
+      row = self._connection.execute("SELECT validator, value FROM results WHERE key = ?", (key,)).fetchone()
+      if row is None:
+        return None
+      if row[0] != validator:
+        self._delete("key = ?", (key,))
+        return None
+      self._connection.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+    return zlib.decompress(row[1])
+
+  def put(self, key:str, layer_url:str, validator:str, content:bytes):
+    value = zlib.compress(content, 1)
+    if len(value) > self._maxBytes:
+      return
+    with self._lock:
+      self._delete("key = ?", (key,))
+      self._connection.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)", (key, layer_url.rstrip("/").lower(), validator, value, len(value), time.time()))
+      self._size += len(value)
+      while self._size > self._maxBytes:
+        oldest = self._connection.execute("SELECT key FROM results ORDER BY last_access LIMIT 1").fetchone()
+        if oldest is None:
+          break
+        self._delete("key = ?", oldest)
+
+  def invalidate(self, layer_url:str=None):
+    """
+      Removes the results of the layer, or all results when `layer_url` is `None`.
+    """
+    with self._lock:
+      if layer_url is None:
+        self._delete("1 = 1", ())
+      else:
+        self._delete("layer_url = ?", (layer_url.rstrip("/").lower(),))
+
+  def _delete(self, condition:str, args:tuple):
+    # Caller holds self._lock.
+    self._size -= self._connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM results WHERE {condition}", args).fetchone()[0]
+    self._connection.execute(f"DELETE FROM results WHERE {condition}", args)
+
+  def close(self):
+    with self._lock:
+      self._connection.close()
+
+class pbfFeatureCollection:
+  """
+    Decoder of the Esri `FeatureCollectionPBuffer` protocol buffer returned by a layer `query` with `f=pbf`.
+    Written against the wire format directly, so the `protobuf` package is not needed.
+
+    `decode` returns the same `dict` as the JSON response: `features` with `attributes` and dequantized `geometry`
+    (`x`/`y`, `points`, `paths` or `rings`), `fields`, `objectIdFieldName`, `exceededTransferLimit` ..., or `count` /
+    `objectIds` for `returnCountOnly` / `returnIdsOnly`.
+
+    .. code-block:: python
+      >>> response = pbfFeatureCollection.decode(requests.post(query_url, data={"f": "pbf", "where": "1=1", "token": token}).content)
+  """
+  GEOMETRY_TYPES = {0: "esriGeometryPoint", 1: "esriGeometryMultipoint", 2: "esriGeometryPolyline", 3: "esriGeometryPolygon", 4: "esriGeometryMultiPatch", 127: "esriGeometryNull"}
+  FIELD_TYPES = {0: "esriFieldTypeSmallInteger", 1: "esriFieldTypeInteger", 2: "esriFieldTypeSingle", 3: "esriFieldTypeDouble", 4: "esriFieldTypeString",
+                 5: "esriFieldTypeDate", 6: "esriFieldTypeOID", 7: "esriFieldTypeGeometry", 8: "esriFieldTypeBlob", 9: "esriFieldTypeRaster",
+                 10: "esriFieldTypeGUID", 11: "esriFieldTypeGlobalID", 12: "esriFieldTypeXML"}
+  _FLOAT = struct.Struct("<f")
+  _DOUBLE = struct.Struct("<d")
+
+  @staticmethod
+  def decode(content:bytes)->dict:
+    """
+    Decodes the `FeatureCollectionPBuffer` message.
+    """
+    buf = bytes(content)
+    query_result = None
+    for field, wire, value in pbfFeatureCollection._iter_fields(buf, 0, len(buf)):
+      if field == 2 and wire == 2:
+        query_result = value
+    if query_result is None:
+      return {"features": []}
+    for field, wire, value in pbfFeatureCollection._iter_fields(buf, *query_result):
+      if field == 1 and wire == 2:
+        return pbfFeatureCollection._decode_feature_result(buf, *value)
+      if field == 2 and wire == 2:
+        count = 0
+        for sub_field, _, sub_value in pbfFeatureCollection._iter_fields(buf, *value):
+          if sub_field == 1:
+            count = sub_value
+        return {"count": count}
+      if field == 3 and wire == 2:
+        result = {"objectIds": []}
+        for sub_field, sub_wire, sub_value in pbfFeatureCollection._iter_fields(buf, *value):
+          if sub_field == 1:
+            result["objectIdFieldName"] = buf[sub_value[0]:sub_value[1]].decode("UTF-8")
+          elif sub_field == 3:
+            result["objectIds"].extend(pbfFeatureCollection._packed_varints(buf, *sub_value) if sub_wire == 2 else [sub_value])
+        return result
+    return {"features": []}
+
+  @staticmethod
+  def _varint(buf:bytes, pos:int):
+    result = 0
+    shift = 0
+    while True:
+      byte = buf[pos]
+      pos += 1
+      result |= (byte & 0x7F) << shift
+      if byte < 0x80:
+        return result, pos
+      shift += 7
+
+  @staticmethod
+  def _iter_fields(buf:bytes, start:int, end:int):
+    """
+      Yields `(field number, wire type, value)`; `value` is an `int` for varints, the `(start, end)` of length delimited
+      fields and the raw bytes of fixed 32/64 bit fields.
+    """
+    varint = pbfFeatureCollection._varint
+    pos = start
+    while pos < end:
+      key, pos = varint(buf, pos)
+      wire = key & 7
+      if wire == 0:
+        value, pos = varint(buf, pos)
+      elif wire == 2:
+        length, pos = varint(buf, pos)
+        value = (pos, pos + length)
+        pos += length
+      elif wire == 1:
+        value = buf[pos:pos + 8]
+        pos += 8
+      elif wire == 5:
+        value = buf[pos:pos + 4]
+        pos += 4
+      else:
+        raise Exception(f"Unsupported protocol buffer wire type {wire}.")
+      yield key >> 3, wire, value
+
+  @staticmethod
+  def _packed_varints(buf:bytes, start:int, end:int)->list:
+    values = []
+    append = values.append
+    pos = start
+    while pos < end:
+      byte = buf[pos]
+      if byte < 0x80:
+        # One byte varint, the common case of delta encoded coordinates.
+        append(byte)
+        pos += 1
+        continue
+      result = 0
+      shift = 0
+      while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+          break
+        shift += 7
+      append(result)
+    return values
+
+  @staticmethod
+  def _decode_feature_result(buf:bytes, start:int, end:int)->dict:
+    result = {"objectIdFieldName": None, "geometryType": "esriGeometryPoint", "fields": [], "features": []}
+    has_z = has_m = False
+    scale = (1.0, 1.0, 1.0, 1.0)
+    translate = (0.0, 0.0, 0.0, 0.0)
+    upper_left = True
+    feature_spans = []
+    text = lambda span: buf[span[0]:span[1]].decode("UTF-8")
+    for field, wire, value in pbfFeatureCollection._iter_fields(buf, start, end):
+      if field == 1:
+        result["objectIdFieldName"] = text(value)
+      elif field == 3:
+        result["globalIdFieldName"] = text(value)
+      elif field == 6:
+        gens = {sub_field: sub_value for sub_field, _, sub_value in pbfFeatureCollection._iter_fields(buf, *value)}
+        result["serverGens"] = {"minServerGen": gens.get(1, 0), "serverGen": gens.get(2, 0)}
+      elif field == 7:
+        result["geometryType"] = pbfFeatureCollection.GEOMETRY_TYPES.get(value, "esriGeometryNull")
+      elif field == 8:
+        spatial_reference = {}
+        for sub_field, _, sub_value in pbfFeatureCollection._iter_fields(buf, *value):
+          if sub_field in (1, 2) and sub_value:
+            spatial_reference["wkid" if sub_field == 1 else "latestWkid"] = sub_value
+          elif sub_field == 5:
+            spatial_reference["wkt"] = text(sub_value)
+        result["spatialReference"] = spatial_reference
+      elif field == 9:
+        result["exceededTransferLimit"] = bool(value)
+      elif field == 10:
+        has_z = bool(value)
+      elif field == 11:
+        has_m = bool(value)
+      elif field == 12:
+        for sub_field, _, sub_value in pbfFeatureCollection._iter_fields(buf, *value):
+          if sub_field == 1:
+            upper_left = sub_value == 0
+          elif sub_field in (2, 3):
+            numbers = {n: pbfFeatureCollection._DOUBLE.unpack(v)[0] for n, _, v in pbfFeatureCollection._iter_fields(buf, *sub_value)}
+            # Scale / Translate messages: x=1, y=2, m=3, z=4.
+            values = (numbers.get(1, 0.0), numbers.get(2, 0.0), numbers.get(4, 0.0), numbers.get(3, 0.0))
+            if sub_field == 2:
+              scale = tuple(v if v else 1.0 for v in values)
+            else:
+              translate = values
+      elif field == 13:
+        field_info = {}
+        for sub_field, _, sub_value in pbfFeatureCollection._iter_fields(buf, *value):
+          if sub_field == 1:
+            field_info["name"] = text(sub_value)
+          elif sub_field == 2:
+            field_info["type"] = pbfFeatureCollection.FIELD_TYPES.get(sub_value, f"esriFieldType{sub_value}")
+          elif sub_field == 3:
+            field_info["alias"] = text(sub_value)
+        result["fields"].append(field_info)
+      elif field == 15:
+        feature_spans.append(value)
+
+    if has_z:
+      result["hasZ"] = True
+    if has_m:
+      result["hasM"] = True
+    names = [field_info.get("name") for field_info in result["fields"]]
+    dimensions = 2 + has_z + has_m
+    geometries = []
+    features = result["features"]
+    for span in feature_spans:
+      feature, geometry = pbfFeatureCollection._decode_feature(buf, span[0], span[1], names)
+      features.append(feature)
+      if geometry is not None:
+        geometries.append((feature, geometry[0], geometry[1]))
+
+    # All coordinates of the page are decoded in one pass.
+    points = pbfFeatureCollection._decode_coordinates(buf, [coords for _, _, coords in geometries], has_z, has_m, scale, translate, upper_left)
+    geometry_type = result["geometryType"]
+    for (feature, lengths, _), vertices in zip(geometries, points):
+      feature["geometry"] = pbfFeatureCollection._to_geometry(vertices, lengths, geometry_type, has_z, has_m)
+    return result
+
+  @staticmethod
+  def _decode_feature(buf:bytes, start:int, end:int, names:list):
+    """
+    Returns the feature with its attributes and `(part lengths, coords span)` of its geometry, `None` without geometry.
+    """
+    varint = pbfFeatureCollection._varint
+    decode_value = pbfFeatureCollection._decode_value
+    attributes = {}
+    geometry = None
+    index = 0
+    count = len(names)
+    pos = start
+    while pos < end:
+      key = buf[pos]
+      length = buf[pos + 1]
+      if length < 0x80:
+        pos += 2
+      else:
+        length, pos = varint(buf, pos + 1)
+      if key == 0x0A:
+        if index < count:
+          value = None
+          if length:
+            value_key = buf[pos]
+            if value_key == 0x0A and buf[pos + 1] < 0x80:
+              # Short string.
+              value = buf[pos + 2:pos + 2 + buf[pos + 1]].decode("UTF-8")
+            elif value_key == 0x40 and length == 2:
+              # One byte sint64.
+              value = (buf[pos + 1] >> 1) ^ -(buf[pos + 1] & 1)
+            else:
+              value = decode_value(buf, pos, pos + length)
+          attributes[names[index]] = value
+        index += 1
+      elif key == 0x12:
+        geometry = pbfFeatureCollection._geometry_spans(buf, pos, pos + length)
+      pos += length
+    return {"attributes": attributes}, geometry
+
+  @staticmethod
+  def _decode_value(buf:bytes, start:int, end:int):
+    if start == end:
+      return None
+    key = buf[start]
+    pos = start + 1
+    field = key >> 3
+    if field == 1:
+      length, pos = pbfFeatureCollection._varint(buf, pos)
+      return buf[pos:pos + length].decode("UTF-8")
+    if field == 2:
+      return pbfFeatureCollection._FLOAT.unpack_from(buf, pos)[0]
+    if field == 3:
+      return pbfFeatureCollection._DOUBLE.unpack_from(buf, pos)[0]
+    value, _ = pbfFeatureCollection._varint(buf, pos)
+    if field in (4, 8):
+      return (value >> 1) ^ -(value & 1)
+    if field == 6 and value >= 1 << 63:
+      return value - (1 << 64)
+    if field == 9:
+      return bool(value)
+    return value
+
+  @staticmethod
+  def _geometry_spans(buf:bytes, start:int, end:int):
+    lengths = []
+    coords = (start, start)
+    for field, wire, value in pbfFeatureCollection._iter_fields(buf, start, end):
+      if field == 2:
+        lengths.extend(pbfFeatureCollection._packed_varints(buf, *value) if wire == 2 else [value])
+      elif field == 3 and wire == 2:
+        coords = value
+    return lengths, coords
+
+  @staticmethod
+  def _decode_coordinates(buf:bytes, spans:list, has_z:bool, has_m:bool, scale:tuple, translate:tuple, upper_left:bool, use_numpy:bool=True)->list:
+    """
+      Decodes the packed, zigzag and delta encoded coordinates of every geometry and returns per geometry the `list`
+      of dequantized vertices `[x, y(, z)(, m)]`. Vectorised with `numpy` when it is installed and `use_numpy`.
+    """
+    if not spans:
+      return []
+    dimensions = 2 + has_z + has_m
+    factors = [scale[0], -scale[1] if upper_left else scale[1]] + ([scale[2]] if has_z else []) + ([scale[3]] if has_m else [])
+    offsets = [translate[0], translate[1]] + ([translate[2]] if has_z else []) + ([translate[3]] if has_m else [])
+    try:
+      import numpy as np
+    except ImportError:
+      np = None
+
+    if np is None or not use_numpy:
+      result = []
+      for start, end in spans:
+        values = pbfFeatureCollection._packed_varints(buf, start, end)
+        totals = [0] * dimensions
+        vertices = []
+        for i in range(0, len(values) - dimensions + 1, dimensions):
+          vertex = []
+          for d in range(dimensions):
+            value = values[i + d]
+            totals[d] += (value >> 1) ^ -(value & 1)
+            vertex.append(offsets[d] + totals[d] * factors[d])
+          vertices.append(vertex)
+        result.append(vertices)
+      return result
+
+    data = np.frombuffer(b"".join(buf[start:end] for start, end in spans), dtype=np.uint8)
+    last_bytes = data < 0x80
+    ends = np.flatnonzero(last_bytes)
+    if ends.size == 0:
+      # Only empty geometries.
+      return [[] for _ in spans]
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # Bits of the bytes of one varint do not overlap: a sum per varint is the OR.
+    shifts = (np.arange(len(data)) - np.repeat(starts, ends - starts + 1)) * 7
+    values = np.add.reduceat((data & 0x7F).astype(np.uint64) << shifts.astype(np.uint64), starts)
+    signed = (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+    # Number of vertices per geometry from the number of varints in each span.
+    byte_counts = np.array([end - start for start, end in spans])
+    varint_ends = np.concatenate(([0], np.cumsum(last_bytes)))[np.cumsum(byte_counts)]
+    varint_counts = np.diff(np.concatenate(([0], varint_ends)))
+    vertex_counts = varint_counts // dimensions
+
+    totals = np.cumsum(signed.reshape(-1, dimensions), axis=0)
+    first = np.cumsum(vertex_counts) - vertex_counts
+    base = np.zeros((len(spans), dimensions), dtype=np.int64)
+    base[first > 0] = totals[first[first > 0] - 1]
+    totals -= np.repeat(base, vertex_counts, axis=0)
+    vertices = (totals * np.array(factors) + np.array(offsets)).tolist()
+
+    result = []
+    position = 0
+    for count in vertex_counts.tolist():
+      result.append(vertices[position:position + count])
+      position += count
+    return result
+
+  @staticmethod
+  def _to_geometry(vertices:list, lengths:list, geometry_type:str, has_z:bool, has_m:bool)->dict:
+    if geometry_type == "esriGeometryPoint":
+      if not vertices:
+        return None
+      point = vertices[0]
+      geometry = {"x": point[0], "y": point[1]}
+      if has_z:
+        geometry["z"] = point[2]
+      if has_m:
+        geometry["m"] = point[-1]
+      return geometry
+    if geometry_type == "esriGeometryMultipoint":
+      return {"points": vertices}
+    if len(lengths) <= 1:
+      parts = [vertices]
+    else:
+      parts = []
+      offset = 0
+      for length in lengths:
+        parts.append(vertices[offset:offset + length])
+        offset += length
+    return {"paths": parts} if geometry_type == "esriGeometryPolyline" else {"rings": parts}
+
+class featureColumns:
+  """
+    Columnar container of query results, a few bytes per value instead of a `dict` per feature.
+
+    Fields are typed from the layer's `fields` metadata: numbers and dates (epoch ms) in `array.array`, text as one UTF-8
+    buffer with offsets, plus a validity byte per value. Geometries are one flat `[x, y(, z)(, m)]` coordinate buffer with
+    part and geometry offsets. The buffers follow the Arrow memory layout, so `to_arrow` wraps them without copying.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    fields:list                  Layer `fields` (`name`, `type`). Geometry, blob and raster fields are skipped.
+    ---------------------        -------------------------------------------------------------------------------------
+    geometry_type:str=None       Layer `geometryType`; `None` keeps no geometry.
+    ---------------------        -------------------------------------------------------------------------------------
+    has_z:bool=False             Vertices have `z`.
+    ---------------------        -------------------------------------------------------------------------------------
+    has_m:bool=False             Vertices have `m`.
+    ---------------------        -------------------------------------------------------------------------------------
+    spatial_reference:dict=None  Kept in the Arrow schema metadata.
+    =====================        =====================================================================================
+
+    .. code-block:: python
+      >>> columns = esri.query_to_columns(url=query_url, token=token, returnGeometry=True)
+      >>> columns.to_parquet("assets.parquet")
+      >>> with open("assets.ndjson", "w") as f:
+            columns.write_ndjson(f)
+  """
+  TYPE_CODES = {"esriFieldTypeSmallInteger": "h", "esriFieldTypeInteger": "i", "esriFieldTypeOID": "q", "esriFieldTypeBigInteger": "q",
+                "esriFieldTypeSingle": "f", "esriFieldTypeDouble": "d", "esriFieldTypeDate": "q"}
+  TEXT_TYPES = ("esriFieldTypeString", "esriFieldTypeGUID", "esriFieldTypeGlobalID", "esriFieldTypeXML",
+                "esriFieldTypeDateOnly", "esriFieldTypeTimeOnly", "esriFieldTypeTimestampOffset")
+
+  def __init__(self, fields:list, geometry_type:str=None, has_z:bool=False, has_m:bool=False, spatial_reference:dict=None) -> None:
+    self._length = 0
+    self._columns = []
+    for field in fields:
+      field_type = field.get("type")
+      if field_type in featureColumns.TYPE_CODES:
+        self._columns.append({"name": field["name"], "type": field_type, "values": array(featureColumns.TYPE_CODES[field_type]), "valid": bytearray()})
+      elif field_type in featureColumns.TEXT_TYPES:
+        self._columns.append({"name": field["name"], "type": field_type, "offsets": array("q", [0]), "data": bytearray(), "valid": bytearray()})
+
+    self.geometryType = geometry_type
+    self.hasZ = has_z
+    self.hasM = has_m
+    self.spatialReference = spatial_reference
+    self._dimensions = 2 + has_z + has_m
+    self._coords = array("d")
+    self._partOffsets = array("q", [0])
+    self._geometryOffsets = array("q", [0])
+    self._geometryValid = bytearray()
+
+  @staticmethod
+  def from_layer_info(layer_info:dict, outFields:str="*", returnGeometry:bool=False, text_fields:list=None)->"featureColumns":
+    """
+      Container for the features of a `query` on the layer with `outFields`.
+      `text_fields` are stored as text whatever their type, e.g. the coded value domain fields of decoded features.
+    """
+    fields = layer_info.get("fields") or []
+    if outFields and outFields.strip() != "*":
+      wanted = {name.strip().lower() for name in outFields.split(",")}
+      fields = [field for field in fields if field["name"].lower() in wanted]
+    if text_fields:
+      text = {name.lower() for name in text_fields}
+      fields = [dict(field, type="esriFieldTypeString") if field["name"].lower() in text else field for field in fields]
+    geometry_type = layer_info.get("geometryType") if returnGeometry else None
+    return featureColumns(fields, geometry_type, bool(layer_info.get("hasZ")), bool(layer_info.get("hasM")),
+                          (layer_info.get("extent") or {}).get("spatialReference") or layer_info.get("spatialReference"))
+
+  def __len__(self)->int:
+    return self._length
+
+  @property
+  def names(self)->list:
+    return [column["name"] for column in self._columns]
+
+  @property
+  def nbytes(self)->int:
+    """
+    Bytes held by the buffers.
+    """
+    total = len(self._coords) * 8 + (len(self._partOffsets) + len(self._geometryOffsets)) * 8 + len(self._geometryValid)
+    for column in self._columns:
+      total += len(column["valid"])
+      if "values" in column:
+        total += len(column["values"]) * column["values"].itemsize
+      else:
+        total += len(column["offsets"]) * 8 + len(column["data"])
+    return total
+
+  def append(self, features:list):
+    """
+      Appends a page of features (`{"attributes": {...}, "geometry": {...}}`, JSON or `pbfFeatureCollection`).
+    """
+    if not features:
+      return
+    for column in self._columns:
+      name = column["name"]
+      values = [feature["attributes"].get(name) for feature in features]
+      valid = column["valid"]
+      valid.extend([value is not None for value in values])
+      try:
+        if "values" in column:
+          zero = 0.0 if column["values"].typecode in "fd" else 0
+          column["values"].extend([zero if value is None else value for value in values])
+        else:
+          data = column["data"]
+          offsets = column["offsets"]
+          for value in values:
+            if value is not None:
+              data += str(value).encode("UTF-8")
+            offsets.append(len(data))
+      except (TypeError, OverflowError) as ex:
+        raise Exception(f"Field '{name}' ({column['type']}) cannot hold the values of the page: {ex}")
+    if self.geometryType:
+      self._append_geometries([feature.get("geometry") for feature in features])
+    self._length += len(features)
+
+  def _append_geometries(self, geometries:list):
+    coords = self._coords
+    dimensions = self._dimensions
+    if self.geometryType == "esriGeometryPoint":
+      for geometry in geometries:
+        if geometry and geometry.get("x") is not None:
+          coords.extend([geometry["x"], geometry["y"]] + ([geometry.get("z", 0.0)] if self.hasZ else []) + ([geometry.get("m", 0.0)] if self.hasM else []))
+          self._geometryValid.append(1)
+        else:
+          coords.extend([float("nan")] * dimensions)
+          self._geometryValid.append(0)
+      return
+
+    key = {"esriGeometryMultipoint": "points", "esriGeometryPolyline": "paths", "esriGeometryPolygon": "rings"}.get(self.geometryType)
+    part_offsets = self._partOffsets
+    for geometry in geometries:
+      parts = (geometry or {}).get(key)
+      if parts is None:
+        self._geometryValid.append(0)
+        parts = [[]] if key == "points" else []
+      else:
+        self._geometryValid.append(1)
+        if key == "points":
+          parts = [parts]
+      for part in parts:
+        for vertex in part:
+          coords.extend(vertex if len(vertex) == dimensions else (list(vertex) + [0.0] * dimensions)[:dimensions])
+        part_offsets.append(len(coords) // dimensions)
+      self._geometryOffsets.append(len(part_offsets) - 1)
+
+  # ---- Row access
+
+  def _value(self, column:dict, index:int):
+    if not column["valid"][index]:
+      return None
+    if "values" in column:
+      return column["values"][index]
+    offsets = column["offsets"]
+    return column["data"][offsets[index]:offsets[index + 1]].decode("UTF-8")
+
+  def _geometry(self, index:int)->dict:
+    if not self._geometryValid[index]:
+      return None
+    dimensions = self._dimensions
+    coords = self._coords
+    if self.geometryType == "esriGeometryPoint":
+      vertex = coords[index * dimensions:(index + 1) * dimensions]
+      geometry = {"x": vertex[0], "y": vertex[1]}
+      if self.hasZ:
+        geometry["z"] = vertex[2]
+      if self.hasM:
+        geometry["m"] = vertex[-1]
+      return geometry
+    parts = []
+    for part in range(self._geometryOffsets[index], self._geometryOffsets[index + 1]):
+      start, end = self._partOffsets[part] * dimensions, self._partOffsets[part + 1] * dimensions
+      flat = coords[start:end].tolist()
+      parts.append([flat[i:i + dimensions] for i in range(0, len(flat), dimensions)])
+    if self.geometryType == "esriGeometryMultipoint":
+      return {"points": parts[0] if parts else []}
+    return {"paths": parts} if self.geometryType == "esriGeometryPolyline" else {"rings": parts}
+
+  def iter_features(self, start:int=0, stop:int=None):
+    """
+    Yields the features as `{"attributes": {...}, "geometry": {...}}` again, one at a time.
+    """
+    for index in range(start, self._length if stop is None else min(stop, self._length)):
+      feature = {"attributes": {column["name"]: self._value(column, index) for column in self._columns}}
+      if self.geometryType:
+        feature["geometry"] = self._geometry(index)
+      yield feature
+
+  def column(self, name:str)->list:
+    """
+    Returns the values of the field as a `list` (`None` for nulls).
+    """
+    for column in self._columns:
+      if column["name"].lower() == name.lower():
+        return [self._value(column, index) for index in range(self._length)]
+    raise Exception(f"Field '{name}' not found.")
+
+  # ---- Export
+
+  def write_ndjson(self, fp, geometry:bool=True)->int:
+    """
+      Streams one JSON object per line (`{"attributes": ..., "geometry": ...}`) to the text file `fp` and returns the number of lines.
+    """
+    count = 0
+    for feature in self.iter_features():
+      if not geometry:
+        feature.pop("geometry", None)
+      fp.write(json.dumps(feature, separators=(",", ":")))
+      fp.write("\n")
+      count += 1
+    return count
+
+  def to_arrow(self):
+    """
+      Returns a `pyarrow.Table` over the buffers without copying them (the validity bitmaps of columns with nulls are packed).
+      Dates become `timestamp[ms, UTC]`, text `large_string` and geometries GeoArrow interleaved coordinates
+      (`geoarrow.point`, `geoarrow.multipoint`, `geoarrow.multilinestring`; polygons as lists of rings). Requires `pyarrow`.
+    """
+    import pyarrow as pa
+
+    arrays = []
+    fields = []
+    for column in self._columns:
+      validity, null_count = featureColumns._validity(pa, column["valid"])
+      if "values" in column:
+        arrow_type = {"h": pa.int16(), "i": pa.int32(), "q": pa.int64(), "f": pa.float32(), "d": pa.float64()}[column["values"].typecode]
+        if column["type"] == "esriFieldTypeDate":
+          arrow_type = pa.timestamp("ms", tz="UTC")
+        arrays.append(pa.Array.from_buffers(arrow_type, self._length, [validity, pa.py_buffer(column["values"])], null_count=null_count))
+      else:
+        arrays.append(pa.Array.from_buffers(pa.large_string(), self._length, [validity, pa.py_buffer(column["offsets"]), pa.py_buffer(column["data"])], null_count=null_count))
+      fields.append(pa.field(column["name"], arrays[-1].type, metadata={"esri:type": column["type"]}))
+
+    if self.geometryType:
+      dimensions = self._dimensions
+      names = "xy" + ("z" if self.hasZ else "") + ("m" if self.hasM else "")
+      coordinate_type = pa.list_(pa.field(names, pa.float64(), nullable=False), dimensions)
+      values = pa.Array.from_buffers(pa.float64(), len(self._coords), [None, pa.py_buffer(self._coords)])
+      validity, null_count = featureColumns._validity(pa, self._geometryValid)
+      if self.geometryType == "esriGeometryPoint":
+        geometries = pa.Array.from_buffers(coordinate_type, self._length, [validity], null_count=null_count, children=[values])
+        extension = "geoarrow.point"
+      else:
+        vertices = pa.Array.from_buffers(coordinate_type, len(self._coords) // dimensions, [None], children=[values])
+        parts = pa.Array.from_buffers(pa.large_list(coordinate_type), len(self._partOffsets) - 1, [None, pa.py_buffer(self._partOffsets)], children=[vertices])
+        if self.geometryType == "esriGeometryMultipoint":
+          # One part per feature: the parts are the multipoints.
+          geometries = pa.Array.from_buffers(parts.type, self._length, [validity, pa.py_buffer(self._partOffsets)], null_count=null_count, children=[vertices])
+          extension = "geoarrow.multipoint"
+        else:
+          geometries = pa.Array.from_buffers(pa.large_list(parts.type), self._length, [validity, pa.py_buffer(self._geometryOffsets)], null_count=null_count, children=[parts])
+          extension = "geoarrow.multilinestring" if self.geometryType == "esriGeometryPolyline" else None
+      metadata = {"esri:geometryType": self.geometryType}
+      if extension:
+        metadata["ARROW:extension:name"] = extension
+        metadata["ARROW:extension:metadata"] = "{}"
+      arrays.append(geometries)
+      fields.append(pa.field("geometry", geometries.type, metadata=metadata))
+
+    schema_metadata = {"esri:geometryType": self.geometryType or ""}
+    if self.spatialReference:
+      schema_metadata["esri:spatialReference"] = json.dumps(self.spatialReference)
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields, metadata=schema_metadata))
+
+  def to_parquet(self, path:str, compression:str="zstd", **kwargs):
+    """
+    Writes `to_arrow()` as Parquet (`pyarrow.parquet.write_table`), readable directly by pandas, DuckDB, Spark ...
+    """
+    import pyarrow.parquet as pq
+    pq.write_table(self.to_arrow(), path, compression=compression, **kwargs)
+
+  @staticmethod
+  def _validity(pa, valid:bytearray):
+    """
+    Returns `(bitmap buffer, null count)`; no bitmap when every value is set.
+    """
+    null_count = valid.count(0)
+    if null_count == 0:
+      return None, 0
+    packed = pa.Array.from_buffers(pa.uint8(), len(valid), [None, pa.py_buffer(valid)]).cast(pa.bool_())
+    return packed.buffers()[1], null_count
+
+class versionCatalog:
+  """
+    Versions of a VersionManagementServer loaded once (`.../VersionManagementServer/versions`) and indexed by lower case
+    version name. The list is loaded again when older than `max_age` seconds, or once when a name is not found.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    esri:esriHelper              Helper used for the requests and the token.
+    ---------------------        -------------------------------------------------------------------------------------
+    version_url:str              e.g. `https://<host>/arcgis/rest/services/<serviceName>/VersionManagementServer/versions`.
+    ---------------------        -------------------------------------------------------------------------------------
+    max_age:float=300            Seconds the list is used before it is loaded again.
+    =====================        =====================================================================================
+  """
+  def __init__(self, esri, version_url:str, max_age:float=300) -> None:
+    self._esri = esri
+    self._url = version_url
+    self._maxAge = max_age
+    self._lock = threading.Lock()
+    self._index = None
+    self._loadedAt = 0
+
+  def _load(self, token:str=None):
+    # Caller holds self._lock.
+    params = {
+      "f": "json",
+      "token": token if token else self._esri.token,
+      }
+    response = self._esri.evaluate_url(url= self._url, params= params)
+    versions = response.get('versions')
+    if versions is None:
+      raise Exception(f"Versions could not be read from '{self._url}': {response.get('error', {}).get('message')}")
+    self._index = {str(version['versionName']).lower(): version for version in versions}
+    self._loadedAt = time.monotonic()
+
+  def find(self, full_version_name:str, token:str=None)->dict:
+    """
+      Returns the version JSON (`versionName`, `versionGuid` ...) by name ignoring case, `None` when it does not exist.
+    """
+    key = full_version_name.lower()
+    with self._lock:
+      stale = self._index is None or time.monotonic() - self._loadedAt > self._maxAge
+      if stale:
+        self._load(token)
+      version = self._index.get(key)
+      if version is None and not stale:
+        # Created since the last load?
+        self._load(token)
+        version = self._index.get(key)
+      return version
+
+  def get_guid(self, full_version_name:str, token:str=None)->str:
+    """
+      Returns the `GUID` of the version without curly braces.
+    """
+    version = self.find(full_version_name, token)
+    if version is None:
+      raise Exception(f"Version '{full_version_name}' not found.")
+    return version['versionGuid'].strip("{}") # Remove curly braces and return without it.
+
+  def versions(self, token:str=None)->list:
+    with self._lock:
+      if self._index is None or time.monotonic() - self._loadedAt > self._maxAge:
+        self._load(token)
+      return list(self._index.values())
+
+  def invalidate(self):
+    with self._lock:
+      self._index = None
+
+class traceResult:
+  """
+    Elements of a Utility Network trace (`traceResults.elements`) as parallel arrays instead of one `dict` per element.
+
+    `networkSourceIds`, `objectIds`, `terminalIds`, `assetGroupCodes` and `assetTypeCodes` are `array.array`,
+    `globalIds` a `list` of upper case GUIDs with braces. Element `i` is the `i`-th item of every array.
+  """
+  def __init__(self) -> None:
+    self.networkSourceIds = array("i")
+    self.objectIds = array("q")
+    self.terminalIds = array("i")
+    self.assetGroupCodes = array("i")
+    self.assetTypeCodes = array("i")
+    self.globalIds = []
+    self._globalIdSet = None
+
+  @staticmethod
+  def from_elements(elements:list)->"traceResult":
+    result = traceResult()
+    get = lambda name, default=0: [default if element.get(name) is None else element[name] for element in elements]
+    result.networkSourceIds.extend(get("networkSourceId"))
+    result.objectIds.extend(get("objectId"))
+    result.terminalIds.extend(get("terminalId", -1))
+    result.assetGroupCodes.extend(get("assetGroupCode"))
+    result.assetTypeCodes.extend(get("assetTypeCode"))
+    result.globalIds = [traceResult.normalize_global_id(global_id) for global_id in get("globalId", "")]
+    return result
+
+  @staticmethod
+  def union(results:list)->"traceResult":
+    """
+      Elements of all `results` once each (same `networkSourceId`, `objectId` and `terminalId`).
+    """
+    if len(results) == 1:
+      return results[0]
+    union = traceResult()
+    seen = set()
+    for result in results:
+      for i in range(len(result)):
+        key = (result.networkSourceIds[i], result.objectIds[i], result.terminalIds[i])
+        if key in seen:
+          continue
+        seen.add(key)
+        union.networkSourceIds.append(key[0])
+        union.objectIds.append(key[1])
+        union.terminalIds.append(key[2])
+        union.assetGroupCodes.append(result.assetGroupCodes[i])
+        union.assetTypeCodes.append(result.assetTypeCodes[i])
+        union.globalIds.append(result.globalIds[i])
+    return union
+
+  @staticmethod
+  def normalize_global_id(global_id:str)->str:
+    return "{" + str(global_id).strip("{}").upper() + "}" if global_id else ""
+
+  def __len__(self)->int:
+    return len(self.objectIds)
+
+  def contains(self, global_id:str)->bool:
+    if self._globalIdSet is None:
+      self._globalIdSet = set(self.globalIds)
+    return traceResult.normalize_global_id(global_id) in self._globalIdSet
+
+  def object_ids_by_source(self)->dict:
+    """
+    Returns `{networkSourceId: array of objectIds}`, e.g. to query the traced features layer by layer.
+    """
+    groups = {}
+    for source, oid in zip(self.networkSourceIds, self.objectIds):
+      groups.setdefault(source, array("q")).append(oid)
+    return groups
+
+  def to_dict(self)->dict:
+    return {"networkSourceId": self.networkSourceIds.tolist(), "objectId": self.objectIds.tolist(), "terminalId": self.terminalIds.tolist(),
+            "assetGroupCode": self.assetGroupCodes.tolist(), "assetTypeCode": self.assetTypeCodes.tolist(), "globalId": list(self.globalIds)}
+
+class traceResultCache:
+  """
+    In-memory LRU cache of `traceResult` keyed by version, version moment, trace type, trace configuration and trace locations.
+
+    `connected` and `subnetwork` traces without barriers return the same elements from any starting point inside a
+    result, so a new trace of the same kind whose starting points are all inside cached results is answered with the
+    union of those results. Concurrent requests of the same key wait for the first one (single flight).
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    max_entries:int=256          Results kept.
+    =====================        =====================================================================================
+  """
+  COVERING_TRACE_TYPES = ("connected", "subnetwork")
+
+  def __init__(self, max_entries:int=256) -> None:
+    self._maxEntries = max_entries
+    self._entries = OrderedDict()
+    self._coverage = {}
+    self._inflight = {}
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.coveredHits = 0
+    self.misses = 0
+
+  def get_or_compute(self, context:tuple, locations:list, compute)->traceResult:
+    """
+      Returns the cached result of `context` (`(version guid, moment, trace type, configuration JSON)`) and `locations`,
+      or the one covering it, or `compute()`'s result which is then cached.
+    """
+    key = (context, json.dumps(sorted(locations, key=lambda location: json.dumps(location, sort_keys=True)), sort_keys=True))
+    while True:
+      with self._lock:
+        result = self._entries.get(key)
+        if result is not None:
+          self._entries.move_to_end(key)
+          self.hits += 1
+          return result
+        result = self._covered(context, locations)
+        if result is not None:
+          self.coveredHits += 1
+          return result
+        event = self._inflight.get(key)
+        if event is None:
+          event = self._inflight[key] = threading.Event()
+          self.misses += 1
+          break
+      event.wait()
+      with self._lock:
+        if key not in self._entries:
+          # The first request failed: try on our own.
+          continue
+
+    try:
+      result = compute()
+      with self._lock:
+        self._put(key, context, locations, result)
+      return result
+    finally:
+      with self._lock:
+        self._inflight.pop(key, None)
+      event.set()
+
+  def _covered(self, context:tuple, locations:list)->traceResult:
+    # Caller holds self._lock.
+    if context[2] not in traceResultCache.COVERING_TRACE_TYPES or any(location.get("traceLocationType") == "barrier" for location in locations):
+      return None
+    index = self._coverage.get(context)
+    if not index:
+      return None
+    covering = []
+    for location in locations:
+      key = next((key for key in index if self._entries[key].contains(location["globalId"])), None)
+      if key is None:
+        return None
+      if key not in covering:
+        covering.append(key)
+    for key in covering:
+      self._entries.move_to_end(key)
+    return traceResult.union([self._entries[key] for key in covering])
+
+  def _put(self, key:tuple, context:tuple, locations:list, result:traceResult):
+    # Caller holds self._lock.
+    self._entries[key] = result
+    self._entries.move_to_end(key)
+    if context[2] in traceResultCache.COVERING_TRACE_TYPES and not any(location.get("traceLocationType") == "barrier" for location in locations):
+      self._coverage.setdefault(context, []).append(key)
+    while len(self._entries) > self._maxEntries:
+      evicted, _ = self._entries.popitem(last=False)
+      keys = self._coverage.get(evicted[0])
+      if keys and evicted in keys:
+        keys.remove(evicted)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._coverage.clear()
+
+class esriHelper:
+  STATISTIC_TYPES = ("count", "sum", "min", "max", "avg", "stddev", "var", "percentile_cont", "percentile_disc",
+                     "envelope_aggregate", "centroid_aggregate", "convex_hull_aggregate")
+  # Messages of the VersionManagementServer when startReading / startEditing find the version locked by another session.
+  VERSION_LOCK_MESSAGES = (r"\bversion is (already )?locked\b", r"\blocked by another (user|session)\b",
+                           r"\b(unable|failed) to (acquire|obtain) (a |an )?(shared |exclusive |read |write )?lock\b")
+  # Operations changing layer data: the cached layer state is dropped after them (`queryResultCache` validation).
+  EDIT_OPERATIONS = re.compile(r"/(applyEdits|addFeatures|updateFeatures|deleteFeatures|calculate|append|post|reconcile)/?$", re.IGNORECASE)
+
+  def __init__(self, restHelper:restHelper, configs)-> None:
+    self._restHelper = restHelper
+    self._configs = configs
+    portalUrl = UTILS.getConfigValue(configs, "PORTAL_URL")
+    portalUser = UTILS.getConfigValue(configs, "PORTAL_USER")
+    portalPass = UTILS.getConfigValue(configs, "PORTAL_PASS")
+    baseServiceUrl = UTILS.getConfigValue(configs, "BASE_SERVICE_URL")
+    versionName = UTILS.getConfigValue(configs, "VERSION_NAME")
+    versionOwner = UTILS.getConfigValue(configs, "VERSION_OWNER")
+
+    self._gis = None
+    self._featureServerUrl = f"{baseServiceUrl}/FeatureServer"
+    self._versionUrl = f"{baseServiceUrl}/VersionManagementServer"
+    self._unSererUrl = f"{baseServiceUrl}/UtilityNetworkServer"
+
+    self._portalUrl = portalUrl
+    self._portalUserName = portalUser
+    self._portalPass = portalPass
+    self._versionName = versionName
+    self._versionOwner = versionOwner
+    self._tokenManager = tokenManager(self._request_portal_token,
+                                      refresh_margin=float(UTILS.getConfigValue(configs, "TOKEN_REFRESH_MARGIN", 300)),
+                                      cache=restHelper.get_token_cache(configs),
+                                      cache_key=f"portal|{portalUrl}|{portalUser}")
+    self._layerCache = layerMetadataCache(self._fetch_layer_info,
+                                          ttl=float(UTILS.getConfigValue(configs, "LAYER_CACHE_TTL", 300)),
+                                          max_entries=int(UTILS.getConfigValue(configs, "LAYER_CACHE_SIZE", 128)))
+    self._versionCatalogs = {}
+    self._versionCatalogsLock = threading.Lock()
+    self._versionCatalogMaxAge = float(UTILS.getConfigValue(configs, "VERSION_CATALOG_MAX_AGE", 300))
+    self._traceCache = traceResultCache(max_entries=int(UTILS.getConfigValue(configs, "UN_TRACE_CACHE_SIZE", 256)))
+    queryCachePath = UTILS.getConfigValue(configs, "QUERY_CACHE_PATH")
+    self._queryCache = None
+    self._queryCacheMaxStaleness = float(UTILS.getConfigValue(configs, "QUERY_CACHE_MAX_STALENESS", 60))
+    if queryCachePath:
+      self._queryCache = queryResultCache(os.path.expanduser(queryCachePath),
+                                          max_bytes=int(float(UTILS.getConfigValue(configs, "QUERY_CACHE_MAX_MB", 1024)) * 1024 * 1024))
+    # The portal token is requested on first use (`token`), creating the helper makes no request.
+
+
+  @property
+  def transport(self)->httpTransport:
+    """
+    Returns the `httpTransport` shared by this helper and its `restHelper`.
+    """
+    return self._restHelper.transport
+
+  @property
+  def metrics(self)->requestMetrics:
+    """
+    Returns the `requestMetrics` of the requests of this helper and its `restHelper` (shared transport).
+    """
+    return self.transport.metrics
+
+  @property
+  def gis(self):
+    """
+    Returns the `arcgis.gis.GIS` of the portal user. Created on first use, the REST helpers do not need it.
+    """
+    if self._gis is None:
+      from arcgis.gis import GIS
+      self._gis = GIS(url= self._portalUrl, username= self._portalUserName, password= self._portalPass)
+    return self._gis
+
+  @property
+  def token(self):
     """
     Returns valid token of ArcGIS Portal.
     """
     return self.getPortalToken()
 
   def getPortalToken(self):
-    if "session" not in self._gis.__dict__:
-      return self.generatePortalToken()
+    return self.generatePortalToken()
 
   def generatePortalToken(self):
     """
     Generates the token if its expired, otherwise retuns the existing token.
+    Concurrent callers share one `generateToken` request and the token is refreshed in the background before it expires (`tokenManager`).
     """
-    currentDate = datetime.datetime.now()
-    if self._token != None and self._expiration > currentDate:
-      return self._token
+    return self._tokenManager.get()
 
+  def _request_portal_token(self):
     tokenUrl = f"{self._portalUrl}/sharing/rest/generateToken"
     data = {
       "username": self._portalUserName,
@@ -194,12 +2552,12 @@ class esriHelper:
 
     result = self._restHelper.callRest(tokenUrl, data, "POST", True, ignoreToken=True)
     jsonObj = result.json()
-    self._token = jsonObj["token"]
-    self._expiration = datetime.datetime.fromtimestamp(jsonObj["expires"]/1000)
+    if "token" not in jsonObj:
+      raise Exception(f"Portal token request failed: {jsonObj.get('error', {}).get('message')}")
 
-    return self._token
+    return jsonObj["token"], datetime.datetime.fromtimestamp(jsonObj["expires"]/1000)
 
-  def query_arcgis_layer_rest_url(self, url:str, token:str, where_clause:str="1=1", outFields:str="*", returnGeometry:bool=False, resultoffset:int=0, batch_size:int=2000 )->[]:
+  def query_arcgis_layer_rest_url(self, url:str, token:str, where_clause:str="1=1", outFields:str="*", returnGeometry:bool=False, resultoffset:int=0, batch_size:int=2000, max_workers:int=1, paging:str="offset", query_format:str="json" )->[]:
     """
       Query `ArcGIS Feature Layer` using the REST request on the provided query `URL` and returns result as `list` of features.
 
@@ -219,156 +2577,930 @@ class esriHelper:
       resultoffset:int=0           This option can be used for fetching query results by skipping the specified number of records and starting from the next record (that is, `resultOffset` + 1). The default is `0`. This parameter only applies if `supportsPagination` is `true`. You can use this option to fetch records that are beyond `maxRecordCount`.
       ---------------------        -------------------------------------------------------------------------------------
       batch_size:int=2000          This option can be used for fetching query results up to the `resultRecordCount` specified. When `resultOffset` is specified but this parameter is not, the map service defaults it to `maxRecordCount`. The maximum value for this parameter is the value of the layer's `maxRecordCount` property. The minimum value entered for this parameter cannot be below 1. This parameter only applies if `supportsPagination` is `true`.
-      =====================        =====================================================================================
+      ---------------------        -------------------------------------------------------------------------------------
+      max_workers:int=1            Number of pages requested at the same time. With `1` pages are fetched one after the other. With more than `1` the record count is requested first (`returnCountOnly`), all page windows are computed and fetched on a thread pool. Pages are always returned in offset order.
+      ---------------------        -------------------------------------------------------------------------------------
+      paging:str="offset"          How the pages are requested:
+                                   `"offset"`: `resultOffset` / `resultRecordCount` paging.
+                                   `"keyset"`: `<objectIdField> > <last OID> AND (<where_clause>)` ordered by OID. Each page costs the same on the server, however deep it is, and works when `supportsPagination` is `false`.
+                                   `"partitioned"`: the OIDs are requested first (`returnIdsOnly`) and split into OID ranges fetched on `max_workers` threads.
+                                   `"auto"`: `"partitioned"` when `max_workers` > 1, otherwise `"keyset"`. Falls back to `"offset"` when `resultoffset` is set or the layer has no `objectIdField`.
+                                   Keyset modes use the layer's `objectIdField` and cap `batch_size` at the layer's `maxRecordCount`; pages come in OID order.
+                                   When `outFields` does not list the `objectIdField`, it is requested for the paging and removed from the features.
+      ---------------------        -------------------------------------------------------------------------------------
+      query_format:str="json"      `"json"`: JSON, coordinates as stored.
+                                   `"pbf"`: the compact protocol buffer format, decoded by `pbfFeatureCollection` into the same features, coordinates
+                                   quantized to the layer's XY resolution. Falls back to `json` when the layer does not list `PBF` in `supportedQueryFormats`.
+                                   `"auto"`: `pbf` for polyline, polygon and multipoint geometries (`returnGeometry=True`), where it is several
+                                   times smaller and faster to parse; `json` otherwise, as attribute-only pages parse faster from JSON.
+      =====================        =====================================================================================
 
       :returns:
-        `list` of features.
+        `list` of features. Use `iter_pages` / `iter_features` to process large layers without holding all features in memory.
 
     """
     features = []
+    for batch in self.iter_pages(url=url, token=token, where_clause=where_clause, outFields=outFields, returnGeometry=returnGeometry,
+                                 resultoffset=resultoffset, batch_size=batch_size, max_workers=max_workers, prefetch=0, paging=paging, query_format=query_format):
+      features.extend(batch)
+
+    return features
+
+  def iter_pages(self, url:str, token:str, where_clause:str="1=1", outFields:str="*", returnGeometry:bool=False, resultoffset:int=0, batch_size:int=2000, max_workers:int=1, prefetch:int=2, paging:str="offset", query_format:str="json" ):
+    """
+      Generator version of `query_arcgis_layer_rest_url`. Yields each page (`list` of features) as soon as it arrives, in offset order,
+      while the next pages are downloaded in the background. Only a few pages are held in memory whatever the size of the layer.
+
+      =====================        =====================================================================================
+      **Keys**                     **Description**
+      ---------------------        -------------------------------------------------------------------------------------
+      url, token, ...              Same as `query_arcgis_layer_rest_url`.
+      ---------------------        -------------------------------------------------------------------------------------
+      max_workers:int=1            Number of pages requested at the same time (see `query_arcgis_layer_rest_url`).
+      ---------------------        -------------------------------------------------------------------------------------
+      paging:str="offset"          `"offset"`, `"keyset"`, `"partitioned"` or `"auto"` (see `query_arcgis_layer_rest_url`).
+      ---------------------        -------------------------------------------------------------------------------------
+      query_format:str="json"      `"json"`, `"pbf"` or `"auto"` (see `query_arcgis_layer_rest_url`).
+      ---------------------        -------------------------------------------------------------------------------------
+      prefetch:int=2               Number of pages read ahead while the caller processes the current one. `0` fetches the next page only when it is asked for.
+                                   At most `max(max_workers, prefetch) + 1` pages are in memory.
+      =====================        =====================================================================================
+
+      :returns:
+        Generator of pages, each a `list` of features.
+
+      .. code-block:: python
+        >>> for page in esri.iter_pages(url=query_url, token=token, prefetch=4):
+              write_rows(page)
+    """
+    if paging not in ("auto", "offset", "keyset", "partitioned"):
+      raise Exception(f"Invalid paging '{paging}'.")
+    if query_format not in ("auto", "json", "pbf"):
+      raise Exception(f"Invalid query_format '{query_format}'.")
+
+    if query_format != "json":
+      query_format = self.get_query_format(UTILS.get_layer_url(url), token, query_format, returnGeometry)
+
+    oid_field = None
+    drop_oid_field = False
+    if paging != "offset" and not (paging == "auto" and resultoffset):
+      layer_info = self.get_layer_info(UTILS.get_layer_url(url), token)
+      oid_field = layer_info.get("objectIdField")
+      if oid_field:
+        supports_pagination = layer_info.get("advancedQueryCapabilities", {}).get("supportsPagination", layer_info.get("supportsPagination", False))
+        max_record_count = layer_info.get("maxRecordCount") or batch_size
+        batch_size = min(batch_size, max_record_count)
+        if outFields != "*" and oid_field.lower() not in [f.strip().lower() for f in outFields.split(",")]:
+          outFields = f"{outFields},{oid_field}"
+          drop_oid_field = True
+      elif paging != "auto":
+        raise Exception("Keyset paging is not possible, the layer has no 'objectIdField'. Use paging='offset'.")
+
+    if oid_field and (paging == "partitioned" or (paging == "auto" and max_workers > 1)):
+      object_ids = self.get_object_ids(url=url, token=token, where_clause=where_clause)
+      ranges = [(page, chunk[0], chunk[-1]) for page, chunk in enumerate(UTILS.chunk_array(object_ids, batch_size))]
+      fetch = lambda oid_range: [feature for batch in self._iter_keyset_pages(url, token, where_clause, outFields, returnGeometry, oid_field, batch_size, supports_pagination, oid_range[1], oid_range[2], first_page=oid_range[0], query_format=query_format, drop_oid_field=drop_oid_field) for feature in batch]
+      yield from UTILS.iter_ordered(fetch, ranges, max_workers=max_workers, in_flight=max(max_workers, prefetch))
+    elif oid_field:
+      pages = self._iter_keyset_pages(url, token, where_clause, outFields, returnGeometry, oid_field, batch_size, supports_pagination, query_format=query_format, drop_oid_field=drop_oid_field)
+      yield from UTILS.iter_prefetched(pages, prefetch)
+    elif max_workers > 1:
+      count = self.get_feature_count(url=url, token=token, where_clause=where_clause)
+      offsets = range(resultoffset, count, batch_size)
+      fetch = lambda offset: self._fetch_window(url, token, where_clause, outFields, returnGeometry, offset, batch_size, page=(offset - resultoffset) // batch_size, query_format=query_format)
+      yield from UTILS.iter_ordered(fetch, offsets, max_workers=max_workers, in_flight=max(max_workers, prefetch))
+    else:
+      pages = self._iter_offset_pages(url, token, where_clause, outFields, returnGeometry, resultoffset, batch_size, query_format)
+      yield from UTILS.iter_prefetched(pages, prefetch)
+
+  def iter_features(self, url:str, token:str, where_clause:str="1=1", outFields:str="*", returnGeometry:bool=False, resultoffset:int=0, batch_size:int=2000, max_workers:int=1, prefetch:int=2, paging:str="offset", query_format:str="json" ):
+    """
+      Generator of single features, see `iter_pages` for the keys.
+
+      .. code-block:: python
+        >>> for feature in esri.iter_features(url=query_url, token=token, returnGeometry=True):
+              process(feature["attributes"], feature["geometry"])
+    """
+    for batch in self.iter_pages(url=url, token=token, where_clause=where_clause, outFields=outFields, returnGeometry=returnGeometry,
+                                 resultoffset=resultoffset, batch_size=batch_size, max_workers=max_workers, prefetch=prefetch, paging=paging, query_format=query_format):
+      yield from batch
+
+  def query_to_columns(self, url:str, token:str, where_clause:str="1=1", outFields:str="*", returnGeometry:bool=False, batch_size:int=2000, max_workers:int=1, prefetch:int=2, paging:str="offset", query_format:str="json", decode_domains:bool=False )->featureColumns:
+    """
+      Same query as `query_arcgis_layer_rest_url` but stores the features in a `featureColumns` typed from the layer `fields`,
+      page by page, so only the pages in flight exist as `dict`. Use it for large extracts (millions of rows) and for Arrow/Parquet output.
+
+      =====================        =====================================================================================
+      **Keys**                     **Description**
+      ---------------------        -------------------------------------------------------------------------------------
+      url, token, ...              Same as `iter_pages`.
+      ---------------------        -------------------------------------------------------------------------------------
+      decode_domains:bool=False    Store the names of the coded value domains (`decode_domains`) instead of the codes; these fields become text.
+      =====================        =====================================================================================
+
+      :returns:
+        `featureColumns`.
+
+      .. code-block:: python
+        >>> columns = esri.query_to_columns(url=query_url, token=token, returnGeometry=True, max_workers=4)
+        >>> columns.to_parquet("assets.parquet")
+    """
+    layer_url = UTILS.get_layer_url(url)
+    layer_info = self.get_layer_info(layer_url, token)
+    text_fields = None
+    if decode_domains:
+      text_fields = {name for field_maps in self.get_layer_metadata(layer_url, token).domain_maps().values() for name in field_maps}
+    columns = featureColumns.from_layer_info(layer_info, outFields, returnGeometry, text_fields)
+    for page in self.iter_pages(url=url, token=token, where_clause=where_clause, outFields=outFields, returnGeometry=returnGeometry,
+                                batch_size=batch_size, max_workers=max_workers, prefetch=prefetch, paging=paging, query_format=query_format):
+      columns.append(self.decode_domains(page, layer_url) if decode_domains else page)
+    return columns
+
+  def _iter_offset_pages(self, url:str, token:str, where_clause:str, outFields:str, returnGeometry:bool, resultoffset:int, batch_size:int, query_format:str="json"):
+    """
+      Serial `resultOffset` paging, one request after the other.
+    """
     offset = resultoffset
-    while True:
+    for page in itertools.count():
       params = {
-        "f": "json",
+        "f": query_format,
         "token": token,
         "where": where_clause,
         "outFields": outFields,
         "returnGeometry": returnGeometry,
-        "resultoffset": offset,
+        "resultOffset": offset,
         "resultRecordCount": batch_size
       }
-      response = evaluate_url(url=url, params=params)
-      batch = res.get("features",[])
+      response = self.evaluate_url(url=url, params=params, trace={"page": page})
+      batch = response.get("features",[])
       if not batch:
         break
+      yield batch
+      offset += len(batch)
+      # A short page without `exceededTransferLimit` is the last one, no need to ask for an empty page.
+      if len(batch) < batch_size and not response.get("exceededTransferLimit"):
+        break
+
+  def _iter_keyset_pages(self, url:str, token:str, where_clause:str, outFields:str, returnGeometry:bool, oid_field:str, batch_size:int, supports_pagination:bool, lower_oid:int=None, upper_oid:int=None, first_page:int=0, query_format:str="json", drop_oid_field:bool=False):
+    """
+      Serial keyset paging: `<oid_field> > <last OID>` ordered by OID, optionally within `lower_oid` and `upper_oid` (inclusive).
+      Pages are numbered from `first_page` in the request events. `drop_oid_field` removes `oid_field` from the features
+      once the page is read, when it was only requested for the paging.
+    """
+    last_oid = None
+    for page in itertools.count(first_page):
+      conditions = []
+      if last_oid is not None:
+        conditions.append(f"{oid_field} > {last_oid}")
+      elif lower_oid is not None:
+        conditions.append(f"{oid_field} >= {lower_oid}")
+      if upper_oid is not None:
+        conditions.append(f"{oid_field} <= {upper_oid}")
+      if where_clause and where_clause.strip() != "1=1":
+        conditions.append(f"({where_clause})")
+
+      params = {
+        "f": query_format,
+        "token": token,
+        "where": " AND ".join(conditions) if conditions else "1=1",
+        "outFields": outFields,
+        "returnGeometry": returnGeometry,
+        "orderByFields": f"{oid_field} ASC"
+      }
+      if supports_pagination:
+        params["resultRecordCount"] = batch_size
+
+      response = self.evaluate_url(url=url, params=params, trace={"page": page})
+      batch = response.get("features",[])
+      if not batch:
+        break
+      last_oid = max(feature["attributes"][oid_field] for feature in batch)
+      # Before the yield: the consumer (or the prefetch queue) owns the page afterwards.
+      if drop_oid_field:
+        for feature in batch:
+          del feature["attributes"][oid_field]
+      yield batch
+      if upper_oid is not None and last_oid >= upper_oid:
+        break
+      if len(batch) < batch_size and not response.get("exceededTransferLimit"):
+        break
+
+  def get_object_ids(self, url:str, token:str, where_clause:str="1=1")->list:
+    """
+      Returns the sorted `list` of object ids matching `where_clause` on the provided query `URL` (`returnIdsOnly`).
+
+      =====================        =====================================================================================
+      **Keys**                     **Description**
+      ---------------------        -------------------------------------------------------------------------------------
+      url:str                      A REST end point of query 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>/query`
+      ---------------------        -------------------------------------------------------------------------------------
+      token:str                    Valid token of ArcGIS Portal.
+      ---------------------        -------------------------------------------------------------------------------------
+      where_clause:str="1=1"       Where clause to restrict the object ids.
+      =====================        =====================================================================================
+
+      :returns:
+        Sorted `list` of object ids.
+    """
+    params = {
+      "f": "json",
+      "token": token,
+      "where": where_clause,
+      "returnIdsOnly": True
+    }
+    response = self.evaluate_url(url=url, params=params)
+    if "objectIds" not in response:
+      raise Exception(f"Object ids query failed: {response.get('error', {}).get('message')}")
+    return sorted(response["objectIds"] or [])
+
+  def get_layer_info(self, featureLayer_url:str, token:str=None)->dict:
+    """
+      Returns the layer metadata JSON (`objectIdField`, `maxRecordCount`, `fields`, `types` ...) of the provided feature layer URL.
+      The metadata is cached per layer URL, see `get_layer_metadata`.
+
+      =====================    =====================================================================================
+      **Keys**                 **Description**
+      ---------------------    -------------------------------------------------------------------------------------
+      featureLayer_url:str     A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
+      ---------------------    -------------------------------------------------------------------------------------
+      token:str                Valid token of ArcGIS Portal. Default is the token of the portal user.
+      =====================    =====================================================================================
+
+      :returns:
+        Layer metadata as `dict`.
+    """
+    return self.get_layer_metadata(featureLayer_url, token).info
+
+  def get_layer_metadata(self, featureLayer_url:str, token:str=None, max_age:float=None)->layerMetadata:
+    """
+      Returns the cached `layerMetadata` of the provided feature layer URL. The layer JSON is requested again once the
+      entry is older than `LAYER_CACHE_TTL` seconds; domain lookups are rebuilt only when the layer's `editingInfo` or schema changed.
+
+      =====================    =====================================================================================
+      **Keys**                 **Description**
+      ---------------------    -------------------------------------------------------------------------------------
+      featureLayer_url:str     A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
+      ---------------------    -------------------------------------------------------------------------------------
+      token:str                Valid token of ArcGIS Portal. Default is the token of the portal user.
+      ---------------------    -------------------------------------------------------------------------------------
+      max_age:float=None       Seconds the cached entry may be old, when less than `LAYER_CACHE_TTL`. `0` requests the layer JSON again.
+      =====================    =====================================================================================
+
+      :returns:
+        `layerMetadata`.
+    """
+    return self._layerCache.get(UTILS.get_layer_url(featureLayer_url), token, max_age)
+
+  def get_query_format(self, featureLayer_url:str, token:str=None, query_format:str="pbf", returnGeometry:bool=True)->str:
+    """
+      Resolves the `f` of the layer queries for `query_format` (see `query_arcgis_layer_rest_url`): `"pbf"` when the layer lists
+      `PBF` in `supportedQueryFormats` (and, for `"auto"`, the geometry is worth it), otherwise `"json"`.
+    """
+    layer_info = self.get_layer_info(featureLayer_url, token)
+    formats = layer_info.get("supportedQueryFormats") or ""
+    if "pbf" not in [f.strip().lower() for f in formats.split(",")]:
+      return "json"
+    if query_format == "auto" and not (returnGeometry and layer_info.get("geometryType") in ("esriGeometryPolyline", "esriGeometryPolygon", "esriGeometryMultipoint")):
+      return "json"
+    return "pbf"
+
+  def invalidate_layer_metadata(self, featureLayer_url:str=None):
+    """
+      Drops the cached metadata of the layer, or of all layers when `featureLayer_url` is `None`.
+    """
+    self._layerCache.invalidate(UTILS.get_layer_url(featureLayer_url) if featureLayer_url else None)
+
+  def _fetch_layer_info(self, featureLayer_url:str, token:str=None)->dict:
+    params = {
+      "f": "json",
+      "token": token if token else self.token
+    }
+    response = self.evaluate_url(featureLayer_url, params)
+    if "error" in response:
+      raise Exception(f"Layer info failed for '{featureLayer_url}': {response['error'].get('message')}")
+    return response
+
+  def get_feature_count(self, url:str, token:str, where_clause:str="1=1")->int:
+    """
+      Returns the number of features matching `where_clause` on the provided query `URL` (`returnCountOnly`).
+
+      =====================        =====================================================================================
+      **Keys**                     **Description**
+      ---------------------        -------------------------------------------------------------------------------------
+      url:str                      A REST end point of query 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>/query`
+      ---------------------        -------------------------------------------------------------------------------------
+      token:str                    Valid token of ArcGIS Portal.
+      ---------------------        -------------------------------------------------------------------------------------
+      where_clause:str="1=1"       Where clause to restrict the count.
+      =====================        =====================================================================================
+
+      :returns:
+        Feature count as `int`.
+    """
+    params = {
+      "f": "json",
+      "token": token,
+      "where": where_clause,
+      "returnCountOnly": True
+    }
+    response = self.evaluate_url(url=url, params=params)
+    if "count" not in response:
+      raise Exception(f"Feature count failed: {response.get('error', {}).get('message')}")
+    return int(response["count"])
+
+  def query_statistics(self, url:str, token:str, statistics:list, group_by:list=None, where_clause:str="1=1", having:str=None, order_by:str=None, decode_domains:bool=True, batch_size:int=None)->list:
+    """
+      Aggregates on the server (`outStatistics`, `groupByFieldsForStatistics`, `having`) instead of downloading the features:
+      one row per group, paged when the groups exceed `maxRecordCount`.
+
+      =====================        =====================================================================================
+      **Keys**                     **Description**
+      ---------------------        -------------------------------------------------------------------------------------
+      url:str                      A REST end point of query 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>/query`
+      ---------------------        -------------------------------------------------------------------------------------
+      token:str                    Valid token of ArcGIS Portal.
+      ---------------------        -------------------------------------------------------------------------------------
+      statistics:list              Statistics, each a `dict` as in `outStatistics` or a tuple `(statisticType, onStatisticField[, outStatisticFieldName])`,
+                                   e.g. `[("count", "objectid", "assets"), ("max", "last_edited_date")]`. The default output name is `<type>_<field>`.
+      ---------------------        -------------------------------------------------------------------------------------
+      group_by:list=None           Fields of `groupByFieldsForStatistics`. `None` returns one row for the whole `where_clause`.
+      ---------------------        -------------------------------------------------------------------------------------
+      where_clause:str="1=1"       Where clause to restrict the features.
+      ---------------------        -------------------------------------------------------------------------------------
+      having:str=None              `having` clause on the statistics, e.g. `"COUNT(objectid) > 100"` (`supportsHavingClause`).
+      ---------------------        -------------------------------------------------------------------------------------
+      order_by:str=None            `orderByFields`. Default the `group_by` fields, so the pages are stable.
+      ---------------------        -------------------------------------------------------------------------------------
+      decode_domains:bool=True     Replace the coded values of the `group_by` fields by their names, per subtype when the subtype field is
+                                   grouped too; the subtype field itself gets the subtype name. See `decode_domains`.
+      ---------------------        -------------------------------------------------------------------------------------
+      batch_size:int=None          Groups per page, default the layer's `maxRecordCount`.
+      =====================        =====================================================================================
+
+      :returns:
+        `list` of `dict`, one per group: the `group_by` fields and the statistics.
+
+      .. code-block:: python
+        >>> esri.query_statistics(url=query_url, token=token, statistics=[("count", "objectid", "assets")],
+                                  group_by=["assetgroup", "lifecyclestatus"], having="COUNT(objectid) > 100")
+        [{'assetgroup': 'Group 1', 'lifecyclestatus': 'In Service', 'assets': 1532}, ...]
+    """
+    layer_url = UTILS.get_layer_url(url)
+    layer_info = self.get_layer_info(layer_url, token)
+    capabilities = layer_info.get("advancedQueryCapabilities", {})
+    if not capabilities.get("supportsStatistics", layer_info.get("supportsStatistics", False)):
+      raise Exception(f"The layer does not support statistics queries: {layer_url}")
+    if having and not capabilities.get("supportsHavingClause", False):
+      raise Exception(f"The layer does not support the 'having' clause: {layer_url}")
+
+    group_by = list(group_by or [])
+    params = {
+      "f": "json",
+      "token": token,
+      "where": where_clause,
+      "outStatistics": json.dumps(self._out_statistics(statistics)),
+    }
+    if group_by:
+      params["groupByFieldsForStatistics"] = ",".join(group_by)
+    if having:
+      params["having"] = having
+    if order_by or group_by:
+      params["orderByFields"] = order_by or ",".join(group_by)
+
+    paged = bool(group_by) and capabilities.get("supportsPaginationOnAggregatedQueries", False)
+    batch_size = min(batch_size or layer_info.get("maxRecordCount") or 1000, layer_info.get("maxRecordCount") or batch_size or 1000)
+    rows = []
+    for page in itertools.count():
+      if paged:
+        params["resultOffset"] = page * batch_size
+        params["resultRecordCount"] = batch_size
+      response = self.evaluate_url(url=url, params=params, trace={"page": page})
+      if "features" not in response:
+        raise Exception(f"Statistics query failed: {response.get('error', {}).get('message')} {response.get('error', {}).get('details') or ''}")
+      rows.extend(feature["attributes"] for feature in response["features"])
+      if not response.get("exceededTransferLimit") or not response["features"]:
+        break
+      if not paged:
+        raise Exception(f"More than {len(rows)} groups and the layer does not support paging aggregated queries. Restrict 'where_clause' or use 'having'.")
+
+    if decode_domains and group_by and rows:
+      rows = self._decode_group_keys(rows, layer_url, group_by)
+    return rows
+
+  def query_statistics_batch(self, url:str, token:str, queries:dict, max_workers:int=4)->dict:
+    """
+      Runs several `query_statistics` (or counts) against the layer at the same time, e.g. all tiles of a dashboard.
+
+      =====================        =====================================================================================
+      **Keys**                     **Description**
+      ---------------------        -------------------------------------------------------------------------------------
+      url, token                   Same as `query_statistics`.
+      ---------------------        -------------------------------------------------------------------------------------
+      queries:dict                 `{name: keys}` where `keys` are the keys of `query_statistics`. Without `statistics` the query is a
+                                   `returnCountOnly` on its `where_clause` and the result is an `int`.
+      ---------------------        -------------------------------------------------------------------------------------
+      max_workers:int=4            Number of queries requested at the same time.
+      =====================        =====================================================================================
+
+      :returns:
+        `{name: result}` in the order of `queries`.
+
+      .. code-block:: python
+        >>> esri.query_statistics_batch(url=query_url, token=token, queries={
+              "total": {},
+              "retired": {"where_clause": "lifecyclestatus = 3"},
+              "per_group": {"statistics": [("count", "objectid", "assets")], "group_by": ["assetgroup"]}})
+        {'total': 120000, 'retired': 2310, 'per_group': [...]}
+    """
+    def run(item):
+      name, keys = item
+      keys = dict(keys)
+      if keys.get("statistics"):
+        return name, self.query_statistics(url=url, token=token, **keys)
+      return name, self.get_feature_count(url=url, token=token, where_clause=keys.get("where_clause", "1=1"))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(queries) or 1))) as executor:
+      return dict(executor.map(run, queries.items()))
+
+  @staticmethod
+  def _out_statistics(statistics:list)->list:
+    """
+      Normalizes the `statistics` of `query_statistics` to `outStatistics` definitions.
+    """
+    if not statistics:
+      raise Exception("At least one statistic is needed.")
+    definitions = []
+    for statistic in statistics:
+      if isinstance(statistic, dict):
+        definition = dict(statistic)
+      else:
+        definition = {"statisticType": statistic[0], "onStatisticField": statistic[1]}
+        if len(statistic) > 2:
+          definition["outStatisticFieldName"] = statistic[2]
+      kind = str(definition.get("statisticType", "")).lower()
+      if kind not in esriHelper.STATISTIC_TYPES:
+        raise Exception(f"Invalid statisticType '{definition.get('statisticType')}'.")
+      definition["statisticType"] = kind
+      definition.setdefault("outStatisticFieldName", f"{kind}_{definition.get('onStatisticField')}".replace(".", "_"))
+      definitions.append(definition)
+    return definitions
+
+  def _decode_group_keys(self, rows:list, featureLayer_url:str, group_by:list)->list:
+    """
+      Domain names for the `group_by` values of statistics rows (the server may spell the fields differently than the layer's `fields`).
+    """
+    metadata = self.get_layer_metadata(featureLayer_url)
+    spelled = {f["name"].lower(): f["name"] for f in metadata.info.get("fields") or []}
+    grouped = {name.lower() for name in group_by}
+    renames = {key: spelled.get(key.lower(), key) for key in rows[0] if key.lower() in grouped}
+    features = [{"attributes": {renames.get(k, k): v for k, v in row.items()}} for row in rows]
+    self._translate_domains(features, featureLayer_url, list(renames.values()), False, True)
+
+    subtype_field = metadata.subtypeField if metadata.hasSubtypes else None
+    if subtype_field and subtype_field.lower() in grouped:
+      subtype_names = {st.get("id"): st.get("name") for st in metadata.info.get("types") or []}
+      subtype_field = spelled.get(subtype_field.lower(), subtype_field)
+      for feature in features:
+        value = feature["attributes"].get(subtype_field)
+        feature["attributes"][subtype_field] = subtype_names.get(value, value)
+
+    original = {name: key for key, name in renames.items()}
+    return [{original.get(k, k): v for k, v in feature["attributes"].items()} for feature in features]
+
+  def _fetch_window(self, url:str, token:str, where_clause:str, outFields:str, returnGeometry:bool, offset:int, size:int, page:int=None, query_format:str="json")->list:
+    """
+      Fetches the `size` records starting at `offset`. When the server caps the page below `size` (layer's `maxRecordCount`),
+      the rest of the window is requested until it is complete.
+    """
+    features = []
+    while len(features) < size:
+      params = {
+        "f": query_format,
+        "token": token,
+        "where": where_clause,
+        "outFields": outFields,
+        "returnGeometry": returnGeometry,
+        "resultOffset": offset + len(features),
+        "resultRecordCount": size - len(features)
+      }
+      response = self.evaluate_url(url=url, params=params, trace={"page": page})
+      batch = response.get("features",[])
       features.extend(batch)
-      offset += batch_size
-    
+      if not batch or not response.get("exceededTransferLimit"):
+        break
     return features
 
-  def evaluate_url(self, url:str, params:dict[str, Any]=None):
+  def evaluate_url(self, url:str, params:dict[str, Any]=None, use_cache:bool=True, trace:dict=None, rate_limiter:hostRateLimiter=None):
+    """
+      Performs the REST request on the provided `url` with provided `params`, and returns the response.
+
+      =====================        =====================================================================================
+      **Keys**                     **Description**
+      ---------------------        -------------------------------------------------------------------------------------
+      url:str                      A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
+      ---------------------        -------------------------------------------------------------------------------------
+      params:dict[str, Any]=None   Valid JSON dictionary. Default value is `None`. (e.g. `{"f": "json", "token": "<TOKEN>"}`)
+      ---------------------        -------------------------------------------------------------------------------------
+      use_cache:bool=True          With `QUERY_CACHE_PATH` configured, layer `query` results are read from and written to the `queryResultCache`.
+      ---------------------        -------------------------------------------------------------------------------------
+      trace:dict=None              Extra fields of the request event (`httpTransport`), e.g. `{"page": 3}`.
+      ---------------------        -------------------------------------------------------------------------------------
+      rate_limiter=None            `hostRateLimiter` of this request instead of the transport's `HTTP_RATE_LIMIT` one.
+      =====================        =====================================================================================
+
+      :returns:
+        HTTP reponse.
+    """
+
+    request_params = {"f": "pjson"}
+    if params:
+      request_params.update(params)
+
+    cache_key = None
+    if use_cache and self._queryCache is not None and UTILS.is_query_url(url):
+      layer_url = UTILS.get_layer_url(url)
+      token = request_params.get("token")
+      # The layer state is read once per QUERY_CACHE_MAX_STALENESS (at most LAYER_CACHE_TTL) from the layer metadata cache,
+      # so a hit makes no request. Edits sent through this helper drop it at once (EDIT_OPERATIONS).
+      validator = queryResultCache.get_validator(self.get_layer_metadata(layer_url, token, max_age=self._queryCacheMaxStaleness).info)
+      if validator is not None:
+        cache_key = queryResultCache.make_key(url, request_params, self._token_principal(token))
+        cached = self._queryCache.get(cache_key, validator)
+        if cached is not None:
+          self.metrics.increment("query_cache_hits", endpoint="query")
+          return esriHelper._parse_response(cached, request_params)
+
+    # Retries, backoff and the circuit breaker are applied by the transport (`resiliencePolicy`).
+    try:
+      response = self.transport.request("POST", url, data=request_params, trace=trace, rate_limiter=rate_limiter)
+      response.raise_for_status()
+    except requests.HTTPError as ex:
+      raise Exception(f"Request to {url} failed with HTTP {ex.response.status_code}: {UTILS.redact(ex.response.text[:500])}") from ex
+    except requests.RequestException as ex:
+      raise Exception(f"Request to {url} failed: {type(ex).__name__}: {UTILS.redact(str(ex))}") from ex
+    finally:
+      # Also after a failure: a timed out edit may have been applied.
+      if esriHelper.EDIT_OPERATIONS.search(url.split("?", 1)[0]):
+        self._invalidate_edited(url)
+    try:
+      json_reponse = esriHelper._parse_response(response.content, request_params)
+    except (ValueError, IndexError, struct.error) as ex:
+      raise Exception(f"Invalid response from {url} ({response.headers.get('Content-Type')}): {UTILS.redact(response.text[:500])}") from ex
+    if isinstance(json_reponse, dict) and "error" in json_reponse:
+      self.metrics.increment("arcgis_errors", endpoint=UTILS.get_endpoint_class(url), code=json_reponse["error"].get("code"))
+    if cache_key is not None and "error" not in json_reponse:
+      self._queryCache.put(cache_key, layer_url, validator, response.content)
+    return json_reponse
+
+  def _invalidate_edited(self, url:str):
+    """
+      Drops the cached metadata of the layer of an edit operation URL; of all layers for service and version operations.
+    """
+    layer_url = esriHelper.EDIT_OPERATIONS.sub("", url.split("?", 1)[0])
+    self.invalidate_layer_metadata(layer_url if re.search(r"/(FeatureServer|MapServer)/\d+$", layer_url, re.IGNORECASE) else None)
+
+  def _token_principal(self, token:str)->str:
+    """
+      Identifies the caller in the `queryResultCache` keys: the portal user for the tokens of this helper, a hash of the token otherwise.
+    """
+    if not token:
+      return None
+    if self._tokenManager.issued(token):
+      return f"{self._portalUrl}|{self._portalUserName}".lower()
+    return hashlib.sha256(str(token).encode("UTF-8")).hexdigest()
+
+  @staticmethod
+  def _parse_response(content:bytes, request_params:dict):
+    # Errors of f=pbf requests come back as JSON.
+    if request_params.get("f") == "pbf" and content[:1] != b"{":
+      return pbfFeatureCollection.decode(content)
+    return json.loads(content)
+
+  def getDomainValues(self, featureLayer_url:str, subTypeCode:int, fieldName:str)->list:
+    """
+      Returns a list of dictionaries containing domain code and their values for the specified field name, based on the subtypes defined in the provided feature layer URL.
+
+      =====================    =====================================================================================
+      **Keys**                 **Description**
+      ---------------------    -------------------------------------------------------------------------------------
+      featureLayer_url:str     A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
+      ---------------------    -------------------------------------------------------------------------------------
+      subTypeCode:int          Value of subType of the layer. e.g. `0`
+      ---------------------    -------------------------------------------------------------------------------------
+      fieldName:str            Name of the field for which the domain values should be retrieved (e.g. `"lifecyclestatus"`)
+      ---------------------    -------------------------------------------------------------------------------------
+      =====================    =====================================================================================
+
+      :returns:
+        A list of dictionaries containing domain code and their values.
+
+      .. code-block:: python
+        #Returned list Example
+        >>> domain_list = getDomainValues(featureLayer_url=https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>
+                            subTypeCode:int, 
+                            fieldName:"lifecyclestatus")
+            [{"name": "Generation", "code": 1}, {"name": "Retired", "code": 5}, {"name": "Unknown", "code": 0}]
+    """
+
+    if featureLayer_url is None or subTypeCode is None or fieldName is None:
+      raise Exception("Error while getting domain value. Invalid Parameters")
+    
+    return self.get_layer_metadata(featureLayer_url).coded_values(subTypeCode, fieldName)
+
+  def getDomainCode(self, featureLayer_url:str, subTypeCode:int, fieldName:str, domainValue:str)->list:
+    """
+      Returns a domain code as `int` for the specified domainValue of field name, based on the subtypes defined in the provided feature layer URL.
+
+      =====================    =====================================================================================
+      **Keys**                 **Description**
+      ---------------------    -------------------------------------------------------------------------------------
+      featureLayer_url:str     A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
+      ---------------------    -------------------------------------------------------------------------------------
+      subTypeCode:int          Value of subType of the layer. e.g. `0`
+      ---------------------    -------------------------------------------------------------------------------------
+      fieldName:str            Name of the field for which the domain values should be retrieved (e.g. `"lifecyclestatus"`)
+      ---------------------    -------------------------------------------------------------------------------------
+      domainValue:str          Domain value for which the domain code should be retrieved (e.g. `"Retired"`)
+      ---------------------    -------------------------------------------------------------------------------------
+      =====================    =====================================================================================
+
+      :returns:
+        A domain code as `int`.
+
+      .. code-block:: python
+        #Returned list Example
+        >>> domain_list = getDomainCode(featureLayer_url=https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>
+                            subTypeCode:int, 
+                            fieldName:"lifecyclestatus",
+                            domainValue:"Retired")
+            5
+    """
+    
+    if featureLayer_url is None or subTypeCode is None or fieldName is None or domainValue is None:
+      raise Exception("Error while getting domain code. Invalid Parameters")
+
+    return self.get_layer_metadata(featureLayer_url).name_to_code(subTypeCode, fieldName).get(str(domainValue).lower())
+
+  def getDomainName(self, featureLayer_url:str, subTypeCode:int, fieldName:str, domainCode)->str:
+    """
+      Returns the domain value (name) for the specified domain code of field name, based on the subtypes defined in the provided feature layer URL.
+
+      =====================    =====================================================================================
+      **Keys**                 **Description**
+      ---------------------    -------------------------------------------------------------------------------------
+      featureLayer_url:str     A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
+      ---------------------    -------------------------------------------------------------------------------------
+      subTypeCode:int          Value of subType of the layer. e.g. `0`
+      ---------------------    -------------------------------------------------------------------------------------
+      fieldName:str            Name of the field (e.g. `"lifecyclestatus"`)
+      ---------------------    -------------------------------------------------------------------------------------
+      domainCode               Domain code for which the domain value should be retrieved (e.g. `5`)
+      =====================    =====================================================================================
+
+      :returns:
+        A domain value as `str`, `None` when the code is not in the domain.
+
+      .. code-block:: python
+        >>> getDomainName(featureLayer_url=https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>
+                            subTypeCode:int,
+                            fieldName:"lifecyclestatus",
+                            domainCode:5)
+            "Retired"
+    """
+    if featureLayer_url is None or subTypeCode is None or fieldName is None:
+      raise Exception("Error while getting domain value. Invalid Parameters")
+
+    return self.get_layer_metadata(featureLayer_url).code_to_name(subTypeCode, fieldName).get(domainCode)
+
+  def iter_layer_changes(self, featureLayer_url:str, store:syncStateStore, token:str=None, where_clause:str="1=1", outFields:str="*", returnGeometry:bool=False, overlap_seconds:float=300, detect_deletes:bool=False, batch_size:int=2000, max_workers:int=1, prefetch:int=2 ):
     """
-      Performs the REST request on the provided `url` with provided `params`, and returns the response.
+      Incremental extraction: yields only the features edited since the last completed run, based on the layer's
+      `editFieldsInfo.editDateField` and a watermark kept in `store`. The first run extracts all features matching `where_clause`.
+
+      Features edited up to `overlap_seconds` before the watermark are requested again to cover clock skew between the
+      database and the server, so the consumer shall upsert by OID. The watermark advances, in one transaction, only once
+      the generator has been consumed completely; a failed or interrupted run is repeated by the next one.
 
       =====================        =====================================================================================
       **Keys**                     **Description**
       ---------------------        -------------------------------------------------------------------------------------
-      url:str                      A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
+      featureLayer_url:str         A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
       ---------------------        -------------------------------------------------------------------------------------
-      params:dict[str, Any]=None   Valid JSON dictionary. Default value is `None`. (e.g. `{"f": "json", "token": "<TOKEN>"}`)
+      store:syncStateStore         State store holding the watermarks.
+      ---------------------        -------------------------------------------------------------------------------------
+      token:str=None               Valid token of ArcGIS Portal. Default is the token of the portal user.
+      ---------------------        -------------------------------------------------------------------------------------
+      where_clause, outFields,     Same as `query_arcgis_layer_rest_url`. `outFields` is extended with the OID and edit date fields.
+      returnGeometry, batch_size,
+      max_workers, prefetch
+      ---------------------        -------------------------------------------------------------------------------------
+      overlap_seconds:float=300    Seconds before the watermark requested again.
       ---------------------        -------------------------------------------------------------------------------------
+      detect_deletes:bool=False    Compares the object ids of the layer (`returnIdsOnly`) with the ones of the last run and yields the missing ones.
       =====================        =====================================================================================
 
       :returns:
-        HTTP reponse.
+        Generator of `("upsert", features)` pages, followed by `("delete", object_ids)` when `detect_deletes` found deleted features.
+
+      .. code-block:: python
+        >>> store = syncStateStore("C:/temp/sync_state.db")
+        >>> for kind, records in esri.iter_layer_changes(layer_url, store, detect_deletes=True):
+              if kind == "upsert":
+                upsert_rows(records)
+              else:
+                delete_rows(records)
     """
+    token = token if token else self.token
+    layer_url = UTILS.get_layer_url(featureLayer_url)
+    query_url = f"{layer_url}/query"
+    info = self.get_layer_info(layer_url, token)
+    oid_field = info.get("objectIdField")
+    edit_field = (info.get("editFieldsInfo") or {}).get("editDateField")
+    if not oid_field or not edit_field:
+      raise Exception(f"Incremental extraction needs 'objectIdField' and editor tracking ('editFieldsInfo.editDateField') on '{layer_url}'.")
 
-    try:
-      request_params = {"f": "pjson"}
-      if params:
-        request_params.update(params)
-      encoded_params = urllib.parse.urlencode(request_params)
-      request = urllib.request.urlopen(url, encoded_params.encode('UTF-8'))
-      response = request.read()
-      json_reponse = json.loads(response)
-      return json_reponse
-    except:
-      raise Exception(traceback.format_exc())
-      return None
-      
+    where = where_clause
+    watermark = store.get_watermark(layer_url)
+    if watermark is not None and watermark[0] is not None:
+      # Date literals are interpreted in the layer's time zone when it declares one.
+      time_zone = (info.get("dateFieldsTimeReference") or {}).get("timeZoneIANA") or "UTC"
+      since = UTILS.get_datetime_string_from_epoch(watermark[0] - int(overlap_seconds * 1000), time_zone)
+      where = f"{edit_field} >= TIMESTAMP '{since}'"
+      if where_clause and where_clause.strip() != "1=1":
+        where = f"{where} AND ({where_clause})"
 
-  def getDomainValues(self, featureLayer_url:str, subTypeCode:int, fieldName:str)->list:
+    if outFields != "*":
+      names = [f.strip().lower() for f in outFields.split(",")]
+      outFields = ",".join([outFields] + [f for f in (oid_field, edit_field) if f.lower() not in names])
+
+    last_edit, last_oid = watermark if watermark is not None else (None, None)
+    for page in self.iter_pages(url=query_url, token=token, where_clause=where, outFields=outFields, returnGeometry=returnGeometry,
+                                batch_size=batch_size, max_workers=max_workers, prefetch=prefetch, paging="auto"):
+      for feature in page:
+        edit_date = feature["attributes"].get(edit_field)
+        if edit_date is not None and (last_edit is None or (edit_date, feature["attributes"][oid_field]) > (last_edit, last_oid or 0)):
+          last_edit, last_oid = edit_date, feature["attributes"][oid_field]
+      yield ("upsert", page)
+
+    if detect_deletes:
+      deleted = store.stage_object_ids(layer_url, self.get_object_ids(url=query_url, token=token, where_clause=where_clause))
+      if deleted:
+        yield ("delete", deleted)
+
+    store.advance(layer_url, last_edit, last_oid, object_ids_staged=detect_deletes)
+
+  def decode_domains(self, features:list, featureLayer_url:str, fields:list=None, inplace:bool=True)->list:
     """
-      Returns a list of dictionaries containing domain code and their values for the specified field name, based on the subtypes defined in the provided feature layer URL.
+      Replaces the domain codes of all domain fields by their names (coded -> name) for a whole list of features in one pass,
+      e.g. a page of `iter_pages` or the result of `query_arcgis_layer_rest_url`. Each row is decoded with the domains of
+      its own subtype (layer's `subtypeField`); rows without subtype value use the field level domains.
+      Codes not in the domain are left as they are.
 
       =====================    =====================================================================================
       **Keys**                 **Description**
       ---------------------    -------------------------------------------------------------------------------------
-      featureLayer_url:str     A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
+      features:list            `list` of features (`{"attributes": {...}, ...}`).
       ---------------------    -------------------------------------------------------------------------------------
-      subTypeCode:int          Value of subType of the layer. e.g. `0`
+      featureLayer_url:str     A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
       ---------------------    -------------------------------------------------------------------------------------
-      fieldName:str            Name of the field for which the domain values should be retrieved (e.g. `"lifecyclestatus"`)
+      fields:list=None         Names of the fields to decode. Default all fields having a coded value domain.
       ---------------------    -------------------------------------------------------------------------------------
+      inplace:bool=True        Update the attributes of the given features. With `False` the features are copied first.
       =====================    =====================================================================================
 
       :returns:
-        A list of dictionaries containing domain code and their values.
+        `list` of features.
 
       .. code-block:: python
-        #Returned list Example
-        >>> domain_list = getDomainValues(featureLayer_url=https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>
-                            subTypeCode:int, 
-                            fieldName:"lifecyclestatus")
-            [{"name": "Generation", "code": 1}, {"name": "Retired", "code": 5}, {"name": "Unknown", "code": 0}]
+        >>> for page in esri.iter_pages(url=f"{layer_url}/query", token=token):
+              write_rows(esri.decode_domains(page, layer_url))
     """
+    return self._translate_domains(features, featureLayer_url, fields, False, inplace)
 
-    if featureLayer_url is None or subTypeCode is None or fieldName is None:
-      raise Exception("Error while getting domain value. Invalid Parameters")
-    
-    domainValues = []
+  def encode_domains(self, features:list, featureLayer_url:str, fields:list=None, inplace:bool=True)->list:
+    """
+      Reverse of `decode_domains`: replaces the domain names (case insensitive) by their codes (name -> coded), e.g. before `applyEdits`.
+      See `decode_domains` for the keys.
 
-    param = {
-        "f": "json",
-        "token": "<TOKEN>"
-    }
-    response = evaluate_url(featureLayer_url, param)
-    print(f"Response:: {response}")
-
-    ST_fieldName = response.get('subtypeField')
-    ST_list = response.get('types')
-    # Loop through subTypes
-    for st in ST_list:
-      if st.get('id') == subTypeCode:
-        if 'domains' in st:
-          domains = st.get('domains')
-          if fieldName in domains:
-            domain_field = domains.get(fieldName)
-            if 'codedValues' in domain_field:
-              domainValues = domain_field.get('codedValues')
-              break
-            if 'type' in domain_field and domain_field['type'] == 'inherited':
-              flds = [f for f in response['fields'] if f['name'] == fieldName]
-              if len(flds) > 0 and 'domain' in flds[0] and 'codedValues' in flds[0]['domain']:
-                domainValues = flds[0]['domain']['codedValues']
-                break
-
-    return domainValues
+      :returns:
+        `list` of features.
+    """
+    return self._translate_domains(features, featureLayer_url, fields, True, inplace)
 
-  def getDomainCode(self, featureLayer_url:str, subTypeCode:int, fieldName:str, domainValue:str)->list:
+  def _translate_domains(self, features:list, featureLayer_url:str, fields:list, reverse:bool, inplace:bool)->list:
+    metadata = self.get_layer_metadata(featureLayer_url)
+    maps = metadata.domain_maps(reverse)
+    if fields:
+      wanted = {f.lower() for f in fields}
+      maps = {st: {name: mapping for name, mapping in field_maps.items() if name.lower() in wanted} for st, field_maps in maps.items()}
+    subtype_field = metadata.subtypeField if metadata.hasSubtypes else None
+    default_maps = maps.get(None, {})
+
+    if not inplace:
+      features = [dict(feature, attributes=dict(feature["attributes"])) for feature in features]
+
+    for feature in features:
+      attributes = feature["attributes"]
+      field_maps = default_maps
+      if subtype_field is not None:
+        subTypeCode = attributes.get(subtype_field)
+        if subTypeCode is not None:
+          field_maps = maps.get(subTypeCode, default_maps)
+      for name, mapping in field_maps.items():
+        if name in attributes:
+          value = attributes[name]
+          if reverse:
+            attributes[name] = mapping.get(str(value).lower(), value) if value is not None else None
+          else:
+            attributes[name] = mapping.get(value, value)
+    return features
+
+  def decode_domains_dataframe(self, df, featureLayer_url:str, fields:list=None, reverse:bool=False):
     """
-      Returns a domain code as `int` for the specified domainValue of field name, based on the subtypes defined in the provided feature layer URL.
+      Columnar version of `decode_domains` / `encode_domains` for large pages, on a `pandas.DataFrame` with one column per field
+      (see `UTILS.features_to_dataframe`). Requires `pandas`.
 
       =====================    =====================================================================================
       **Keys**                 **Description**
       ---------------------    -------------------------------------------------------------------------------------
-      featureLayer_url:str     A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
-      ---------------------    -------------------------------------------------------------------------------------
-      subTypeCode:int          Value of subType of the layer. e.g. `0`
+      df:pandas.DataFrame      Attributes, one column per field.
       ---------------------    -------------------------------------------------------------------------------------
-      fieldName:str            Name of the field for which the domain values should be retrieved (e.g. `"lifecyclestatus"`)
+      featureLayer_url:str     A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
       ---------------------    -------------------------------------------------------------------------------------
-      domainValue:str          Domain value for which the domain code should be retrieved (e.g. `"Retired"`)
+      fields:list=None         Names of the fields to translate. Default all fields having a coded value domain.
       ---------------------    -------------------------------------------------------------------------------------
+      reverse:bool=False       `False` decodes code -> name, `True` encodes name -> code.
       =====================    =====================================================================================
 
       :returns:
-        A domain code as `int`.
-
-      .. code-block:: python
-        #Returned list Example
-        >>> domain_list = getDomainCode(featureLayer_url=https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>
-                            subTypeCode:int, 
-                            fieldName:"lifecyclestatus",
-                            domainValue:"Retired")
-            5
+        New `pandas.DataFrame`.
     """
-    
-    domainValues = getDomainValues(featureLayer_url= featureLayer_url, subTypeCode= subTypeCode, fieldName= fieldName, domainValue= "Retired")
-    if len(domainValues)>0:
-      return next((d['code'] for d in domainValues if str(d['name']).lower() == domainValue.lower()), None)
-    else:
-      return None
+    import numpy as np
+
+    metadata = self.get_layer_metadata(featureLayer_url)
+    maps = metadata.domain_maps(reverse)
+    wanted = {f.lower() for f in fields} if fields else None
+    df = df.copy()
+    done = set()
+
+    subtype_field = metadata.subtypeField if metadata.hasSubtypes and metadata.subtypeField in df.columns else None
+    if not reverse and (subtype_field is None or df[subtype_field].dtype.kind in "iu"):
+      # Integer codes and subtypes: one (subtype, code) -> name lookup table per field and a single fancy indexing pass.
+      subtypes = df[subtype_field].to_numpy() if subtype_field else None
+      st_ids = [st for st in maps if st is not None]
+      max_st = max(st_ids) if st_ids else -1
+      names = {name for field_maps in maps.values() for name in field_maps}
+      for name in names:
+        if name not in df.columns or (wanted and name.lower() not in wanted) or df[name].dtype.kind not in "iu":
+          continue
+        # Row `st` decodes subtype `st`, the last row the subtypes not in `types` (field level domain), like `_translate_domains`.
+        row_maps = [maps.get(st, maps.get(None, {})).get(name, {}) for st in range(max_st + 1)] if subtype_field else []
+        row_maps.append(maps.get(None, {}).get(name, {}))
+        codes = [c for mapping in row_maps for c in mapping if isinstance(c, int)]
+        if not codes or min(codes) < 0 or max(codes) > 65535 or max_st > 65535:
+          continue
+        table = np.full((len(row_maps), max(codes) + 1), None, dtype=object)
+        for row, mapping in enumerate(row_maps):
+          for code, domain_name in mapping.items():
+            table[row, code] = domain_name
+        values = df[name].to_numpy()
+        fallback_row = len(row_maps) - 1
+        if subtype_field:
+          rows = np.where((subtypes >= 0) & (subtypes < fallback_row), subtypes, fallback_row)
+        else:
+          rows = np.full(len(values), fallback_row)
+        valid = (values >= 0) & (values < table.shape[1])
+        result = values.astype(object)
+        looked_up = table[rows[valid], values[valid]]
+        found = looked_up != None
+        result[np.flatnonzero(valid)[found]] = looked_up[found]
+        df[name] = result
+        done.add(name)
+
+    # (row mask, field maps) per subtype, mask None means all rows.
+    groups = [(None, maps.get(None, {}))]
+    if subtype_field:
+      subtypes = df[subtype_field]
+      groups = [(subtypes.isna(), maps.get(None, {}))]
+      groups += [(subtypes == subTypeCode, maps.get(subTypeCode, maps.get(None, {}))) for subTypeCode in subtypes.dropna().unique()]
+
+    translated = set()
+    for mask, field_maps in groups:
+      for name, mapping in field_maps.items():
+        if name not in df.columns or name in done or (wanted and name.lower() not in wanted):
+          continue
+        if name not in translated:
+          df[name] = df[name].astype(object)
+          translated.add(name)
+        values = df[name] if mask is None else df.loc[mask, name]
+        keys = values.astype(str).str.lower().where(values.notna()) if reverse else values
+        mapped = keys.map(mapping)
+        result = mapped.where(keys.isin(list(mapping.keys())), values)
+        if mask is None:
+          df[name] = result
+        else:
+          df.loc[mask, name] = result
+    return df
 
   # ==========[START] Version Management Related ....
 
@@ -392,21 +3524,18 @@ class esriHelper:
 
     """
 
-    params = {
-      "f": "json",
-      "token": token,
-      }
-
-    response = evaluate_url(url= version_url, params= params)
-    versions = response.get('versions')
-    if versions is None:
-      raise Exception(f"Version '{full_version_name}' not found.")
-    
-    for version in versions:
-      if str(version['versionName']).lower() == full_version_name.lower(): # comparing by ignoring CASE.
-        return version['versionGuid'].strip("{}") # Remove curly braces and return without it.
+    return self.get_version_catalog(version_url).get_guid(full_version_name, token)
 
-    raise Exception(f"Version '{full_version_name}' not found.")
+  def get_version_catalog(self, version_url:str=None)->versionCatalog:
+    """
+      Returns the cached `versionCatalog` (name -> version index) of the versions' `URL`. Default is the `versions` of `BASE_SERVICE_URL`.
+    """
+    version_url = version_url if version_url else f"{self._versionUrl}/versions"
+    key = version_url.rstrip("/").lower()
+    with self._versionCatalogsLock:
+      if key not in self._versionCatalogs:
+        self._versionCatalogs[key] = versionCatalog(self, version_url, max_age=self._versionCatalogMaxAge)
+      return self._versionCatalogs[key]
 
   def purge_lock(self, version_purge_lock_url:str, full_version_name:str, token:str=None)->str:
     """
@@ -434,68 +3563,815 @@ class esriHelper:
       "versionName": full_version_name
       }
 
-    response = evaluate_url(url= version_purge_lock_url, params= params)
-    if not response.get('success'):
-      return True
-    else:
-      return False
+    params["token"] = token if token else self.token
+    response = self.evaluate_url(url= version_purge_lock_url, params= params)
+    return bool(response.get('success'))
 
-    raise Exception(f"Purge lock failed for '{full_version_name}'.")
+  def create_version(self, versions_url:str, version_name:str, token:str=None, access:str="public")->str:
+    """
+      Creates the branch version `version_name` and returns its `GUID`.
 
-  def create_version(self, versions_url:str, version_name:str, token:str=None)->str:
-    create_version_param = {
-      "f": "json", 
-      "token": get_token()
-    }
-    response = evaluate_url(versions_url, params=create_version_param)
-    versions = response.get("versions", [])
+      =====================    =====================================================================================
+      **Keys**                 **Description**
+      ---------------------    -------------------------------------------------------------------------------------
+      versions_url:str         A REST end point 'URL' of ArcGIS Version e.g. `https://<host>/arcgis/rest/services/<serviceName>/VersionManagementServer/versions`.
+      ---------------------    -------------------------------------------------------------------------------------
+      version_name:str         Name of the version without owner, e.g. `"crew42"`.
+      ---------------------    -------------------------------------------------------------------------------------
+      token:str                Valid token of ArcGIS Portal. Default is the token of the portal user.
+      ---------------------    -------------------------------------------------------------------------------------
+      access:str="public"      `accessPermission` of the version.
+      =====================    =====================================================================================
 
-    if any(v["versionName"] == FULL_VERSION_NAME for v in versions):
-      raise Exception("Version {FULL_VERSION_NAME} exists")
-    else:
-      url = f"{versions_url}/create"
-      create_version_param = {"f": "json", "versionName": VERSION_NAME, "accessPermission": "public", "token": get_token()}
-      response = evaluate_url(url, data=create_version_param)
-      if "error" in response.json():
-          raise Exception(f"Version creation failed: {response.json()['error']['message']}")
-      print(f"Created version: {FULL_VERSION_NAME}")
+      :returns:
+        A version `GUID` as `str`.
+    """
+    catalog = self.get_version_catalog(versions_url)
+    full_version_name = f"{self._versionOwner}.{version_name}" if self._versionOwner and "." not in version_name else version_name
+    if catalog.find(full_version_name, token) is not None:
+      raise Exception(f"Version {full_version_name} exists")
+
+    url = f"{re.sub(r'/versions/?$', '', versions_url.rstrip('/'), flags=re.IGNORECASE)}/create"
+    create_version_param = {"f": "json", "versionName": version_name.split(".")[-1], "accessPermission": access, "token": token if token else self.token}
+    response = self.evaluate_url(url, params=create_version_param)
+    if "error" in response:
+        raise Exception(f"Version creation failed: {response['error']['message']}")
+    logger.info(f"Created version: {full_version_name}")
+    catalog.invalidate()
+    version_info = response.get("versionInfo") or {}
+    if version_info.get("versionGuid"):
+      return version_info["versionGuid"].strip("{}")
+    return catalog.get_guid(full_version_name, token)
 
   # Session management
-  def session_action(self, version_guid:str, action:str = stopEditing | None ):
+  def session_action(self, version_guid:str, action:str = "stopEditing", session_id:str=None, save_edits:bool=True):
+    """
+      Performs the session `action` (`startReading`, `startEditing`, `stopEditing`, `stopReading`) on the version.
+
+      =====================    =====================================================================================
+      **Keys**                 **Description**
+      ---------------------    -------------------------------------------------------------------------------------
+      version_guid:str         `GUID` of the version, see `get_version_guid`.
+      ---------------------    -------------------------------------------------------------------------------------
+      action:str               Session action. Default `stopEditing`.
+      ---------------------    -------------------------------------------------------------------------------------
+      session_id:str           Client generated session id (`GUID`).
+      ---------------------    -------------------------------------------------------------------------------------
+      save_edits:bool=True     `saveEdits` of `stopEditing`.
+      =====================    =====================================================================================
+    """
     if version_guid is None:
       raise Exception("version_guid is required.")
 
-    url = f"{VERSION_MGMT_URL}/versions/{version_guid}/{action}"
-    params = {"sessionId": SESSION_ID, "token": get_token(), "f": "json"}
+    url = f"{self._versionUrl}/versions/{version_guid}/{action}"
+    params = {"sessionId": session_id, "token": self.token, "f": "json"}
 
     if action == "stopEditing":
-        params["saveEdits"] = "true"
+        params["saveEdits"] = "true" if save_edits else "false"
+
+    response = self.evaluate_url(url, params=params)
+    if not response.get("success"):
+        message = response.get('error', {}).get('message')
+        error = Exception(f"{action} failed: {message}")
+        # Set when the session could not start because another session holds the version lock (see `purge_lock`).
+        error.version_locked = action in ("startReading", "startEditing") and esriHelper.is_version_lock_message(message)
+        raise error
+
+  @staticmethod
+  def is_version_lock_message(message:str)->bool:
+    """
+      Returns whether the error message of a session action is one of `VERSION_LOCK_MESSAGES`.
+    """
+    return bool(message) and any(re.search(pattern, message, re.IGNORECASE) for pattern in esriHelper.VERSION_LOCK_MESSAGES)
+
+  @contextmanager
+  def edit_session(self, version_guid:str, session_id:str=None):
+    """
+      Opens a read and edit session on the version and yields the session id. Edits are saved when the block
+      completes and discarded when it raises.
+
+      .. code-block:: python
+        >>> with esri.edit_session(version_guid) as session_id:
+              applyEditsWriter(esri, layer_url, session_id=session_id, gdb_version=full_version_name).write(updates=features)
+    """
+    session_id = session_id if session_id else "{" + str(uuid.uuid4()).upper() + "}"
+    self.session_action(version_guid, "startReading", session_id)
+    error = None
+    try:
+      self.session_action(version_guid, "startEditing", session_id)
+      try:
+        yield session_id
+      except BaseException as ex:
+        error = ex
+        self._close_session(version_guid, "stopEditing", session_id, error, save_edits=False)
+        raise
+      self.session_action(version_guid, "stopEditing", session_id, save_edits=True)
+    except BaseException as ex:
+      error = error or ex
+      raise
+    finally:
+      if error is None:
+        self.session_action(version_guid, "stopReading", session_id)
+      else:
+        self._close_session(version_guid, "stopReading", session_id, error)
+
+  def _close_session(self, version_guid:str, action:str, session_id:str, error:BaseException, save_edits:bool=True):
+    """
+      Session cleanup after `error`: a failure is logged, so it does not replace `error` (often its cause, e.g. the service is down).
+    """
+    try:
+      self.session_action(version_guid, action, session_id, save_edits=save_edits)
+    except Exception as ex:
+      logger.warning(f"{action} of version {version_guid} (session {session_id}) after '{error}' failed: {ex}")
+
+  def reconcile(self, version_guid:str, session_id:str, abort_if_conflicts:bool=False, conflict_detection:str="ByObject", with_post:bool=False)->dict:
+    """
+      Reconciles the version with `DEFAULT` in the open edit session (`edit_session`) and returns the response (`hasConflicts`, `didPost` ...).
+    """
+    url = f"{self._versionUrl}/versions/{version_guid}/reconcile"
+    params = {
+        "sessionId": session_id,
+        "abortIfConflicts": "true" if abort_if_conflicts else "false",
+        "conflictDetection": conflict_detection,
+        "withPost": "true" if with_post else "false",
+        "token": self.token,
+        "f": "json"
+    }
+
+    response = self.evaluate_url(url, params=params)
+    if not response.get("success"):
+        raise Exception(f"Reconcile failed: {response.get('error', {}).get('message')}")
+    return response
 
-    response = evaluate_url(url, data=params)
+  def post(self, version_guid:str, session_id:str)->dict:
+    """
+      Posts the reconciled version to `DEFAULT` in the open edit session (`edit_session`) and returns the response.
+    """
+    url = f"{self._versionUrl}/versions/{version_guid}/post"
+    params = {"sessionId": session_id, "token": self.token, "f": "json"}
+    response = self.evaluate_url(url, params=params)
     if not response.get("success"):
-        raise Exception(f"{action} failed: {response.json().get('error', {}).get('message')}")
+        raise Exception(f"Post failed: {response.get('error', {}).get('message')}")
+    return response
+
+  # ==========[END] Version Management Related
+
+  # ==========[START] Utility Network Related ....
+
+  def trace(self, starting_points:list, trace_type:str="downstream", trace_configuration:dict=None, barriers:list=None, result_types:list=None, version_name:str=None, use_cache:bool=True)->traceResult:
+    """
+      Runs a trace on the UtilityNetworkServer (`<BASE_SERVICE_URL>/UtilityNetworkServer/trace`) in the configured version
+      and returns its elements as `traceResult` arrays. Results are cached per version moment, see `iter_traces`.
+
+      =====================          =====================================================================================
+      **Keys**                       **Description**
+      ---------------------          -------------------------------------------------------------------------------------
+      starting_points:list           Global ids, or trace locations `{"globalId", "terminalId", "percentAlong"}`.
+      ---------------------          -------------------------------------------------------------------------------------
+      trace_type:str="downstream"    `traceType`, e.g. `"connected"`, `"subnetwork"`, `"upstream"`, `"downstream"`, `"isolation"`.
+      ---------------------          -------------------------------------------------------------------------------------
+      trace_configuration:dict=None  `traceConfiguration` JSON (domain network, tier, conditions ...).
+      ---------------------          -------------------------------------------------------------------------------------
+      barriers:list=None             Global ids or trace locations of the barriers.
+      ---------------------          -------------------------------------------------------------------------------------
+      result_types:list=None         `resultTypes`. Default the elements without geometry.
+      ---------------------          -------------------------------------------------------------------------------------
+      version_name:str=None          Full version name. Default `VERSION_OWNER.VERSION_NAME`, `sde.DEFAULT` when not configured.
+      ---------------------          -------------------------------------------------------------------------------------
+      use_cache:bool=True            Reuse the result of an earlier trace of the same version moment.
+      =====================          =====================================================================================
+
+      :returns:
+        `traceResult`.
+
+      .. code-block:: python
+        >>> result = esri.trace(["{8E2B7A4C-...}"], trace_type="upstream", trace_configuration=config)
+        >>> result.object_ids_by_source()
+        {9: array('q', [1201, 1388]), 10: array('q', [77])}
+    """
+    return self._run_trace(self._trace_version(version_name), starting_points, trace_type, trace_configuration, barriers, result_types, use_cache)
+
+  def iter_traces(self, traces:list, max_workers:int=4, version_name:str=None, use_cache:bool=True):
+    """
+      Runs many traces concurrently against the same version moment, e.g. the upstream and downstream traces of an outage
+      analysis, and yields `(index, traceResult)` in the order of `traces` as soon as each is available.
+
+      The version's `modifiedDate` is read once per call: results are cached by version, moment, trace type, configuration
+      and trace locations (`traceResultCache`, `UN_TRACE_CACHE_SIZE` entries), so an edit in the version starts new
+      results. A `connected` or `subnetwork` trace whose starting points all lie in earlier results of the same kind is
+      answered from them without a request.
+
+      =====================          =====================================================================================
+      **Keys**                       **Description**
+      ---------------------          -------------------------------------------------------------------------------------
+      traces:list                    `dict` per trace with the keys of `trace` (`starting_points`, `trace_type`, `trace_configuration`, `barriers`, `result_types`).
+      ---------------------          -------------------------------------------------------------------------------------
+      max_workers:int=4              Traces requested at the same time.
+      ---------------------          -------------------------------------------------------------------------------------
+      version_name, use_cache        See `trace`.
+      =====================          =====================================================================================
+
+      :returns:
+        Generator of `(index, traceResult)`.
+
+      .. code-block:: python
+        >>> traces = [{"starting_points": [device], "trace_type": "downstream", "trace_configuration": config} for device in devices]
+        >>> for index, result in esri.iter_traces(traces, max_workers=8):
+              write_outage(devices[index], result.objectIds)
+    """
+    version = self._trace_version(version_name)
+    run = lambda item: self._run_trace(version, item.get("starting_points"), item.get("trace_type", "downstream"), item.get("trace_configuration"),
+                                       item.get("barriers"), item.get("result_types"), use_cache)
+    yield from enumerate(UTILS.iter_ordered(run, traces, max_workers=max_workers, in_flight=max_workers * 2))
+
+  def _trace_version(self, version_name:str=None)->tuple:
+    """
+      Returns `(full version name, version guid, modifiedDate)` of the version the traces run in.
+    """
+    if not version_name:
+      version_name = self._versionName or "sde.DEFAULT"
+      if self._versionOwner and "." not in version_name:
+        version_name = f"{self._versionOwner}.{version_name}"
+    guid = self.get_version_catalog().get_guid(version_name)
+    info = self.evaluate_url(f"{self._versionUrl}/versions/{{{guid}}}", params={"f": "json", "token": self.token})
+    if "error" in info:
+      raise Exception(f"Version '{version_name}' could not be read: {info['error'].get('message')}")
+    return (version_name, guid, info.get("modifiedDate"))
+
+  def _run_trace(self, version:tuple, starting_points:list, trace_type:str, trace_configuration:dict, barriers:list, result_types:list, use_cache:bool)->traceResult:
+    if not starting_points:
+      raise Exception("At least one starting point is needed.")
+    def location(point, kind:str)->dict:
+      point = {"globalId": point} if isinstance(point, str) else dict(point)
+      point.update(globalId=traceResult.normalize_global_id(point["globalId"]), traceLocationType=kind)
+      return point
 
-  def reconcile(self):
-      url = f"{VERSION_MGMT_URL}/versions/{version_guid}/reconcile"
+    locations = [location(point, "startingPoint") for point in starting_points] + [location(point, "barrier") for point in barriers or []]
+    result_types = result_types or [{"type": "elements", "includeGeometry": False, "includePropagatedValues": False,
+                                     "networkAttributeNames": [], "diagramTemplateName": "", "resultTypeFields": []}]
+    version_name, guid, moment = version
+
+    def compute():
       params = {
-          "sessionId": SESSION_ID,
-          "abortIfConflicts": "false",
-          "conflictDetection": "ByObject",
-          "withPost": "false",
-          "token": get_token(),
-          "f": "json"
+        "f": "json",
+        "token": self.token,
+        "gdbVersion": version_name,
+        "traceType": trace_type,
+        "traceLocations": json.dumps(locations),
+        "traceConfiguration": json.dumps(trace_configuration or {}),
+        "resultTypes": json.dumps(result_types)
       }
+      response = self.evaluate_url(f"{self._unSererUrl}/trace", params=params)
+      if "traceResults" not in response or response.get("success") is False:
+        raise Exception(f"Trace failed: {response.get('error', {}).get('message')}")
+      return traceResult.from_elements(response["traceResults"].get("elements") or [])
+
+    if not use_cache or moment is None:
+      return compute()
+    context = (guid, moment, trace_type.lower(), json.dumps(trace_configuration or {}, sort_keys=True), json.dumps(result_types, sort_keys=True))
+    return self._traceCache.get_or_compute(context, locations, compute)
+
+  # ==========[END] Utility Network Related
+
+class versionOrchestrator:
+  """
+    Reconciles and posts many versions concurrently, e.g. the field crew versions at month end.
+
+    Each version runs in its own edit session: `startReading`, `startEditing`, `reconcile`, `post`, `stopEditing`, `stopReading`.
+    A version starts only when the versions it depends on are done; when one of them fails, its dependents are skipped.
+    A version whose session cannot start because another session holds its lock (`esriHelper.VERSION_LOCK_MESSAGES`) is
+    unlocked with `purge_lock` and tried again; other failures are retried up to `retries` times with backoff, without
+    purging. `run` returns a timing report per version.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    esri:esriHelper              Helper of the service (`BASE_SERVICE_URL`).
+    ---------------------        -------------------------------------------------------------------------------------
+    max_workers:int=4            Versions processed at the same time.
+    ---------------------        -------------------------------------------------------------------------------------
+    retries:int=2                Additional attempts of a failed version.
+    ---------------------        -------------------------------------------------------------------------------------
+    purge_locks:bool=True        Call `purge_lock` when the version is locked.
+    =====================        =====================================================================================
+  """
+  def __init__(self, esri, max_workers:int=4, retries:int=2, purge_locks:bool=True) -> None:
+    self._esri = esri
+    self._maxWorkers = max_workers
+    self._retries = retries
+    self._purgeLocks = purge_locks
+
+  def run(self, version_names:list, depends_on:dict=None, post:bool=True, abort_if_conflicts:bool=False, conflict_detection:str="ByObject")->list:
+    """
+      Reconciles (and posts) the versions and returns the report, one `dict` per version in the order of `version_names`:
+      `{"version", "status", "attempts", "hasConflicts", "reconcileSeconds", "postSeconds", "totalSeconds", "error"}`.
+      `status` is `"posted"`, `"reconciled"`, `"conflicts"` (not posted), `"failed"` or `"skipped"`.
+
+      =====================            =====================================================================================
+      **Keys**                         **Description**
+      ---------------------            -------------------------------------------------------------------------------------
+      version_names:list               Full version names, e.g. `["owner.crew1", "owner.crew2"]`.
+      ---------------------            -------------------------------------------------------------------------------------
+      depends_on:dict=None             `{version: [versions that must be posted first]}`.
+      ---------------------            -------------------------------------------------------------------------------------
+      post:bool=True                   Post after reconcile.
+      ---------------------            -------------------------------------------------------------------------------------
+      abort_if_conflicts:bool=False    `abortIfConflicts` of the reconcile. A version with conflicts is not posted.
+      =====================            =====================================================================================
+    """
+    names = list(dict.fromkeys(version_names))
+    depends_on = {name.lower(): [d.lower() for d in deps] for name, deps in (depends_on or {}).items()}
+    waiting = {name: {d for d in depends_on.get(name.lower(), []) if d in {n.lower() for n in names}} for name in names}
+    self._check_cycles(waiting)
+
+    reports = {}
+    done = set()
+    failed = set()
+    pending = {}
+    catalog = self._esri.get_version_catalog()
+    with ThreadPoolExecutor(max_workers=self._maxWorkers) as executor:
+      while waiting or pending:
+        for name in [n for n, deps in waiting.items() if deps & failed]:
+          reports[name] = dict(self._new_report(name), status="skipped", error="A version it depends on failed.")
+          failed.add(name.lower())
+          del waiting[name]
+        for name in [n for n, deps in waiting.items() if deps <= done]:
+          if len(pending) >= self._maxWorkers:
+            break
+          pending[executor.submit(self._process, catalog, name, post, abort_if_conflicts, conflict_detection)] = name
+          del waiting[name]
+        if not pending:
+          continue
+
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+          name = pending.pop(future)
+          reports[name] = future.result()
+          (done if reports[name]["status"] in ("posted", "reconciled") else failed).add(name.lower())
+    return [reports[name] for name in names]
+
+  def _process(self, catalog:versionCatalog, name:str, post:bool, abort_if_conflicts:bool, conflict_detection:str)->dict:
+    report = self._new_report(name)
+    start = time.perf_counter()
+    version_guid = None
+    for attempt in range(self._retries + 1):
+      report["attempts"] = attempt + 1
+      try:
+        version_guid = catalog.get_guid(name)
+        with self._esri.edit_session(version_guid) as session_id:
+          step = time.perf_counter()
+          response = self._esri.reconcile(version_guid, session_id, abort_if_conflicts=abort_if_conflicts, conflict_detection=conflict_detection)
+          report["reconcileSeconds"] = time.perf_counter() - step
+          report["hasConflicts"] = bool(response.get("hasConflicts"))
+          report["status"] = "reconciled"
+          if report["hasConflicts"] and abort_if_conflicts:
+            report["status"] = "conflicts"
+          elif post:
+            step = time.perf_counter()
+            self._esri.post(version_guid, session_id)
+            report["postSeconds"] = time.perf_counter() - step
+            report["status"] = "posted"
+        report["error"] = None
+        break
+      except Exception as ex:
+        report["status"] = "failed"
+        report["error"] = str(ex).strip().splitlines()[-1] if str(ex).strip() else type(ex).__name__
+        logger.warning(f"Version '{name}' attempt {attempt + 1} failed: {report['error']}")
+        if self._purgeLocks and getattr(ex, "version_locked", False):
+          try:
+            purged = self._esri.purge_lock(f"{self._esri._versionUrl}/purgeLock", name)
+            logger.warning(f"Purge lock of version '{name}' ({version_guid}) after '{report['error']}': {'purged' if purged else 'not purged'}.")
+          except Exception:
+            logger.warning(f"Purge lock of '{name}' failed: {traceback.format_exc()}")
+        if attempt < self._retries:
+          time.sleep(min(2 ** attempt, 30) * (0.5 + random.random() / 2))
+    report["totalSeconds"] = time.perf_counter() - start
+    return report
+
+  @staticmethod
+  def _new_report(name:str)->dict:
+    return {"version": name, "status": "failed", "attempts": 0, "hasConflicts": None, "reconcileSeconds": None, "postSeconds": None, "totalSeconds": None, "error": None}
+
+  @staticmethod
+  def _check_cycles(waiting:dict):
+    lower = {name.lower(): deps for name, deps in waiting.items()}
+    state = {}
+    def visit(name, path):
+      if state.get(name) == 1:
+        raise Exception(f"Circular version dependency: {' -> '.join(path + [name])}")
+      if state.get(name) == 2:
+        return
+      state[name] = 1
+      for dependency in lower.get(name, ()):
+        visit(dependency, path + [name])
+      state[name] = 2
+    for name in lower:
+      visit(name, [])
+
+class featureServerExtractor:
+  """
+    Extracts all layers and tables of a FeatureServer concurrently, e.g. a full service snapshot.
+
+    `plan` reads the layer and table list of the service and the record count of each one; `run` extracts one job per layer,
+    the largest first (so the longest job does not start last), with `max_workers` jobs at the same time. Each job pages by
+    OID (`<objectIdField> > <last OID>`) and its position is saved in an `extractionStateStore` after every page, so an
+    interrupted run started again with the same `run_id` continues each layer after its last completed page; completed
+    layers are skipped. With `rate_limit` the page queries of the run are limited per host (`hostRateLimiter`); the other
+    requests of the shared transport keep its own limiter.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    esri:esriHelper              Helper of the service (`BASE_SERVICE_URL`).
+    ---------------------        -------------------------------------------------------------------------------------
+    state_path:str=None          SQLite file of the progress. `None` keeps it in memory (no resume).
+    ---------------------        -------------------------------------------------------------------------------------
+    max_workers:int=4            Layers extracted at the same time.
+    ---------------------        -------------------------------------------------------------------------------------
+    rate_limit:float=None        Page queries per second per host during `run`. Default the transport's `HTTP_RATE_LIMIT`.
+    ---------------------        -------------------------------------------------------------------------------------
+    service_url:str=None         FeatureServer URL. Default `<BASE_SERVICE_URL>/FeatureServer`.
+    =====================        =====================================================================================
+
+    .. code-block:: python
+      >>> extractor = featureServerExtractor(esri, state_path="snapshot.db", max_workers=8, rate_limit=20)
+      >>> reports = extractor.run(output_dir="snapshot", run_id="2026-10-17")
+  """
+  def __init__(self, esri, state_path:str=None, max_workers:int=4, rate_limit:float=None, service_url:str=None) -> None:
+    self._esri = esri
+    self._store = extractionStateStore(state_path or ":memory:")
+    self._maxWorkers = max_workers
+    self._rateLimit = rate_limit
+    self._serviceUrl = (service_url or esri._featureServerUrl).rstrip("/")
+
+  def plan(self, layer_ids:list=None, where_clause:str="1=1")->list:
+    """
+      Returns the extraction jobs of the service, largest first: `{"id", "name", "type", "url", "records", "objectIdField",
+      "supportsPagination", "maxRecordCount", "geometryType"}` per layer and table (group layers are left out).
+
+      =====================        =====================================================================================
+      **Keys**                     **Description**
+      ---------------------        -------------------------------------------------------------------------------------
+      layer_ids:list=None          Ids of the layers and tables to extract. Default all.
+      ---------------------        -------------------------------------------------------------------------------------
+      where_clause:str="1=1"       Where clause of the record counts.
+      =====================        =====================================================================================
+    """
+    token = self._esri.token
+    service = self._esri.evaluate_url(self._serviceUrl, {"f": "json", "token": token})
+    if "error" in service:
+      raise Exception(f"Unable to read the service {self._serviceUrl}: {service['error'].get('message')}")
+    entries = [(entry, "layer") for entry in service.get("layers") or []] + [(entry, "table") for entry in service.get("tables") or []]
+    entries = [(entry, kind) for entry, kind in entries if not entry.get("subLayerIds") and (layer_ids is None or entry["id"] in layer_ids)]
 
-      response = requests.post(url, data=params)
-      if not response.json().get("success"):
-          raise Exception(f"Reconcile failed: {response.json().get('error', {}).get('message')}")
+    def size(item):
+      entry, kind = item
+      url = f"{self._serviceUrl}/{entry['id']}"
+      info = self._esri.get_layer_info(url, token)
+      return {"id": entry["id"], "name": entry.get("name"), "type": kind, "url": url,
+              "records": self._esri.get_feature_count(url=f"{url}/query", token=token, where_clause=where_clause),
+              "objectIdField": info.get("objectIdField"),
+              "supportsPagination": info.get("advancedQueryCapabilities", {}).get("supportsPagination", info.get("supportsPagination", False)),
+              "maxRecordCount": info.get("maxRecordCount"),
+              "geometryType": info.get("geometryType")}
 
-  def post(self):
-      url = f"{VERSION_MGMT_URL}/versions/{version_guid}/post"
-      params = {"sessionId": SESSION_ID, "token": get_token(), "f": "json"}
-      response = requests.post(url, data=params)
-      if not response.json().get("success"):
-          raise Exception(f"Post failed: {response.json().get('error', {}).get('message')}")
+    with ThreadPoolExecutor(max_workers=max(1, min(self._maxWorkers, len(entries) or 1))) as executor:
+      jobs = list(executor.map(size, entries))
+    return sorted(jobs, key=lambda job: job["records"], reverse=True)
 
+  def run(self, output_dir:str=None, sink=None, run_id:str="default", layer_ids:list=None, where_clause:str="1=1", outFields:str="*",
+          returnGeometry:bool=True, batch_size:int=2000, query_format:str="json")->list:
+    """
+      Extracts the planned jobs and returns one report per layer, in plan order: `{"id", "name", "records", "extracted",
+      "pages", "status", "resumedAtPage", "seconds", "error"}` with `status` `"completed"`, `"skipped"` (completed by an
+      earlier run) or `"failed"`.
+
+      =====================        =====================================================================================
+      **Keys**                     **Description**
+      ---------------------        -------------------------------------------------------------------------------------
+      output_dir:str=None          Directory of the `<id>_<name>.ndjson` files (one Esri JSON feature per line). On resume the
+                                   file is cut back to the last completed page first, so no feature is written twice.
+      ---------------------        -------------------------------------------------------------------------------------
+      sink=None                    Instead of `output_dir`: `sink(job:dict, page:list)` called with every page, from the worker
+                                   threads. The page being written when the run was interrupted is passed again on resume.
+      ---------------------        -------------------------------------------------------------------------------------
+      run_id:str="default"         Id of the run in the progress store; the same id resumes, a new one starts over.
+      ---------------------        -------------------------------------------------------------------------------------
+      layer_ids, where_clause      See `plan`.
+      ---------------------        -------------------------------------------------------------------------------------
+      outFields, returnGeometry    Query parameters of every page (tables never return geometry).
+      ---------------------        -------------------------------------------------------------------------------------
+      batch_size:int=2000          Features per page, capped to each layer's `maxRecordCount`.
+      ---------------------        -------------------------------------------------------------------------------------
+      query_format:str="json"      `"json"`, `"pbf"` or `"auto"` per layer, see `esriHelper.get_query_format`.
+      =====================        =====================================================================================
+
+      :returns:
+        `list` of reports.
+    """
+    if (output_dir is None) == (sink is None):
+      raise Exception("Either 'output_dir' or 'sink' is needed.")
+    if output_dir:
+      os.makedirs(output_dir, exist_ok=True)
+    jobs = self.plan(layer_ids=layer_ids, where_clause=where_clause)
+
+    # Only the page queries of this run are limited, other users of the shared transport keep its limiter.
+    rate_limiter = hostRateLimiter(self._rateLimit) if self._rateLimit else None
+    extract = lambda job: self._extract(job, output_dir, sink, run_id, where_clause, outFields, returnGeometry, batch_size, query_format, rate_limiter)
+    # The executor starts the jobs in submission order: largest first.
+    with ThreadPoolExecutor(max_workers=max(1, min(self._maxWorkers, len(jobs) or 1))) as executor:
+      return list(executor.map(extract, jobs))
+
+  def _extract(self, job:dict, output_dir:str, sink, run_id:str, where_clause:str, outFields:str, returnGeometry:bool, batch_size:int, query_format:str, rate_limiter:hostRateLimiter=None)->dict:
+    report = {"id": job["id"], "name": job["name"], "records": job["records"], "extracted": 0, "pages": 0, "status": None,
+              "resumedAtPage": None, "seconds": 0.0, "error": None}
+    start = time.perf_counter()
+    progress = self._store.get(run_id, job["url"])
+    if progress and progress["completed"]:
+      report.update(extracted=progress["records"], pages=progress["pages"], status="skipped")
+      return report
+
+    position, pages, records, output_bytes = (progress["position"], progress["pages"], progress["records"], progress["outputBytes"]) if progress else (None, 0, 0, 0)
+    if progress:
+      report["resumedAtPage"] = pages
+    output = None
+    try:
+      if output_dir:
+        safe_name = re.sub(r"[^\w.-]+", "_", str(job["name"] or "layer"))
+        path = os.path.join(output_dir, f"{job['id']}_{safe_name}.ndjson")
+        output = open(path, "r+b" if progress and os.path.exists(path) else "wb")
+        output.truncate(output_bytes)
+        output.seek(output_bytes)
+
+      oid_field = job["objectIdField"]
+      batch_size = min(batch_size, job["maxRecordCount"] or batch_size)
+      geometry = returnGeometry and job["type"] == "layer"
+      page_format = query_format if query_format == "json" else self._esri.get_query_format(job["url"], self._esri.token, query_format, geometry)
+      if oid_field and outFields != "*" and oid_field.lower() not in [f.strip().lower() for f in outFields.split(",")]:
+        outFields = f"{outFields},{oid_field}"
+
+      while True:
+        params = {"f": page_format, "token": self._esri.token, "outFields": outFields, "returnGeometry": geometry}
+        conditions = [f"({where_clause})"] if where_clause and where_clause.strip() != "1=1" else []
+        if oid_field:
+          if position is not None:
+            conditions.insert(0, f"{oid_field} > {position}")
+          params["orderByFields"] = f"{oid_field} ASC"
+          if job["supportsPagination"]:
+            params["resultRecordCount"] = batch_size
+        else:
+          params.update(resultOffset=position or 0, resultRecordCount=batch_size)
+        params["where"] = " AND ".join(conditions) if conditions else "1=1"
+
+        response = self._esri.evaluate_url(url=f"{job['url']}/query", params=params, use_cache=False, trace={"page": pages}, rate_limiter=rate_limiter)
+        if "error" in response:
+          raise Exception(f"Query of layer {job['id']} failed: {response['error'].get('message')}")
+        page = response.get("features") or []
+        if page:
+          if output is not None:
+            output.write("".join(json.dumps(feature, separators=(",", ":")) + "\n" for feature in page).encode("UTF-8"))
+            output.flush()
+            output_bytes = output.tell()
+          else:
+            sink(job, page)
+          position = max(feature["attributes"][oid_field] for feature in page) if oid_field else (position or 0) + len(page)
+          pages += 1
+          records += len(page)
+        done = not page or (len(page) < batch_size and not response.get("exceededTransferLimit"))
+        self._store.save(run_id, job["url"], position, pages, records, output_bytes, completed=done)
+        if done:
+          break
+      report["status"] = "completed"
+    except Exception as ex:
+      report["status"] = "failed"
+      report["error"] = str(ex)
+      logger.warning(f"Extraction of layer {job['id']} ({job['name']}) failed at page {pages}: {ex}")
+    finally:
+      if output is not None:
+        output.close()
+      report.update(extracted=records, pages=pages, seconds=time.perf_counter() - start)
+    return report
+
+class applyEditsWriter:
+  """
+    Bulk writer for the layer `applyEdits` end point (`.../FeatureServer/<layerId>/applyEdits`), optionally inside an open
+    version edit session (`esriHelper.edit_session`).
+
+    Adds, updates and deletes are sent in chunks. The chunk size adapts after every request to reach `target_seconds` per
+    request without exceeding `max_payload_bytes`. A chunk whose request fails is split in two and both halves are sent
+    again, which also isolates a single bad record; a single record is retried `retries` times before it is reported as failed.
+    Adds are only sent again when the server rejected the request (ArcGIS error response or HTTP error): after a timeout or
+    a lost connection they may have been added already, so they are reported with `"unknown": True` instead of duplicated.
+    Per-record results are streamed while the next chunks are sent, responses are not kept.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    esri:esriHelper              Helper used for the requests and the token.
+    ---------------------        -------------------------------------------------------------------------------------
+    featureLayer_url:str         A REST end point 'URL' of :class: `~ArcGIS Feature Layer. e.g. `https://<host>/arcgis/rest/services/<serviceName>/FeatureServer/<layerId>`
+    ---------------------        -------------------------------------------------------------------------------------
+    session_id:str=None          Session id of the open edit session.
+    ---------------------        -------------------------------------------------------------------------------------
+    gdb_version:str=None         Full name of the version edited, e.g. `"owner.version"`.
+    ---------------------        -------------------------------------------------------------------------------------
+    max_workers:int=None         Requests in flight. Edits of one session are applied one after the other by the server,
+                                 so the default is `1` with `session_id` and `4` without.
+    ---------------------        -------------------------------------------------------------------------------------
+    chunk_size:int=500           Initial number of records per request, adapted between `min_chunk` and `max_chunk`.
+    ---------------------        -------------------------------------------------------------------------------------
+    target_seconds:float=5       Aimed duration of one request.
+    ---------------------        -------------------------------------------------------------------------------------
+    max_payload_bytes:int=8MB    Upper bound of the JSON sent per request.
+    ---------------------        -------------------------------------------------------------------------------------
+    use_global_ids:bool=False    `useGlobalIds` of `applyEdits`, deletes are then global ids.
+    ---------------------        -------------------------------------------------------------------------------------
+    retries:int=3                Attempts of a failed single record request.
+    =====================        =====================================================================================
+  """
+  TRANSIENT_CODES = (429, 500, 502, 503, 504)
+
+  def __init__(self, esri, featureLayer_url:str, session_id:str=None, gdb_version:str=None, max_workers:int=None, chunk_size:int=500, min_chunk:int=1, max_chunk:int=5000, target_seconds:float=5, max_payload_bytes:int=8*1024*1024, use_global_ids:bool=False, retries:int=3) -> None:
+    self._esri = esri
+    self._url = f"{UTILS.get_layer_url(featureLayer_url)}/applyEdits"
+    self._sessionId = session_id
+    self._gdbVersion = gdb_version
+    self._maxWorkers = max_workers if max_workers else (1 if session_id else 4)
+    self._chunkSize = chunk_size
+    self._minChunk = max(min_chunk, 1)
+    self._maxChunk = max_chunk
+    self._targetSeconds = target_seconds
+    self._maxPayloadBytes = max_payload_bytes
+    self._useGlobalIds = use_global_ids
+    self._retries = retries
+    self._bytesPerRecord = None
+    self._lock = threading.Lock()
+
+  @property
+  def chunk_size(self)->int:
+    return self._chunkSize
+
+  def write(self, adds=None, updates=None, deletes=None, on_result=None)->dict:
+    """
+      Sends all edits and returns the counts `{"adds": {"success": n, "failed": n, "unknown": n}, "updates": ..., "deletes": ..., "requests": n, "seconds": s}`,
+      `unknown` being the adds whose request failed without telling whether they were added.
+
+      =====================    =====================================================================================
+      **Keys**                 **Description**
+      ---------------------    -------------------------------------------------------------------------------------
+      adds=None                Iterable of features to add (`{"attributes": {...}, "geometry": {...}}`).
+      ---------------------    -------------------------------------------------------------------------------------
+      updates=None             Iterable of features to update, with the OID (or global id) in the attributes.
+      ---------------------    -------------------------------------------------------------------------------------
+      deletes=None             Iterable of OIDs (or global ids) to delete.
+      ---------------------    -------------------------------------------------------------------------------------
+      on_result=None           Called with `(kind, result)` for every record, e.g. `("updates", {"objectId": 1, "success": False, "error": {...}})`.
+      =====================    =====================================================================================
+    """
+    summary = {kind: {"success": 0, "failed": 0, "unknown": 0} for kind in ("adds", "updates", "deletes")}
+    start = time.perf_counter()
+    self._requests = 0
+    for kind, result in self.iter_write(adds=adds, updates=updates, deletes=deletes):
+      summary[kind]["success" if result.get("success") else "unknown" if result.get("unknown") else "failed"] += 1
+      if on_result is not None:
+        on_result(kind, result)
+    summary["requests"] = self._requests
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+  def iter_write(self, adds=None, updates=None, deletes=None):
+    """
+      Generator version of `write`, yields `(kind, result)` for every record as the responses arrive.
+    """
+    self._requests = 0
+    sources = [(kind, iter(records)) for kind, records in (("adds", adds), ("updates", updates), ("deletes", deletes)) if records is not None]
+    retry_queue = deque()
+    pending = {}
+
+    def next_chunk():
+      if retry_queue:
+        return retry_queue.popleft()
+      while sources:
+        kind, records = sources[0]
+        chunk = list(itertools.islice(records, self._chunkSize))
+        if chunk:
+          return (kind, chunk, 0)
+        sources.pop(0)
+      return None
+
+    with ThreadPoolExecutor(max_workers=self._maxWorkers) as executor:
+      while True:
+        while len(pending) < self._maxWorkers:
+          chunk = next_chunk()
+          if chunk is None:
+            break
+          pending[executor.submit(self._send, chunk[0], chunk[1], chunk[2])] = chunk
+        if not pending:
+          break
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          kind, records, attempt = pending.pop(future)
+          try:
+            results = future.result()
+          except Exception as ex:
+            yield from self._handle_failure(kind, records, attempt, ex, retry_queue)
+            continue
+          for result in results:
+            yield (kind, result)
+
+  def _handle_failure(self, kind:str, records:list, attempt:int, error:Exception, retry_queue:deque):
+    transient = getattr(error, "transient", True)
+    if transient:
+      # Timeouts and server errors: send smaller chunks from now on.
+      with self._lock:
+        self._chunkSize = max(self._minChunk, self._chunkSize // 2)
+    if kind == "adds" and not getattr(error, "rejected", False):
+      # rollbackOnFailure is false: the server may have added the features before the response was lost.
+      for record in records:
+        yield (kind, self._failed_result(kind, record, error, unknown=True))
+      return
+    if len(records) > 1:
+      half = len(records) // 2
+      retry_queue.appendleft((kind, records[half:], 0))
+      retry_queue.appendleft((kind, records[:half], 0))
+      return
+    if attempt + 1 < self._retries and transient:
+      retry_queue.append((kind, records, attempt + 1))
+      return
+    yield (kind, self._failed_result(kind, records[0], error))
 
-  # ==========[END] Version Management Related
\ No newline at end of file
+  def _failed_result(self, kind:str, record, error:Exception, unknown:bool=False)->dict:
+    result = {"success": False, "error": {"description": str(error).splitlines()[-1] if str(error) else type(error).__name__}}
+    if unknown:
+      result["unknown"] = True
+    if kind == "deletes":
+      result["globalId" if self._useGlobalIds else "objectId"] = record
+    else:
+      attributes = record.get("attributes", {})
+      result["objectId"] = next((v for k, v in attributes.items() if k.lower() in ("objectid", "oid")), None)
+      result["globalId"] = next((v for k, v in attributes.items() if k.lower() == "globalid"), None)
+    return result
+
+  @staticmethod
+  def _is_rejected(error:Exception)->bool:
+    """
+      Whether the failed request surely did not apply the edits: an HTTP error status (except the gateway timeout 504)
+      or a connection that could not be opened. Read timeouts and lost connections are not.
+    """
+    cause = error.__cause__
+    if isinstance(cause, requests.HTTPError):
+      return cause.response is not None and cause.response.status_code != 504
+    return isinstance(cause, requests.ConnectTimeout)
+
+  def _send(self, kind:str, records:list, attempt:int=0)->list:
+    if attempt:
+      # Backoff with jitter before a retry.
+      time.sleep(min(2 ** attempt, 30) * (0.5 + random.random() / 2))
+    payload = json.dumps(records)
+    params = {
+      "f": "json",
+      "token": self._esri.token,
+      kind: payload,
+      "rollbackOnFailure": "false",
+      "useGlobalIds": "true" if self._useGlobalIds else "false"
+    }
+    if self._sessionId:
+      params["sessionId"] = self._sessionId
+    if self._gdbVersion:
+      params["gdbVersion"] = self._gdbVersion
+
+    start = time.perf_counter()
+    try:
+      response = self._esri.evaluate_url(self._url, params=params, use_cache=False, trace={"retries": attempt})
+    except Exception as ex:
+      ex.rejected = applyEditsWriter._is_rejected(ex)
+      raise
+    finally:
+      with self._lock:
+        self._requests += 1
+    elapsed = time.perf_counter() - start
+
+    if "error" in response:
+      # The whole request was refused, none of the edits was applied.
+      code = response["error"].get("code")
+      error = Exception(f"applyEdits failed ({code}): {response['error'].get('message')}")
+      error.transient = code in applyEditsWriter.TRANSIENT_CODES
+      error.rejected = True
+      raise error
+
+    self._adapt(len(records), len(payload), elapsed)
+    return response.get(f"{kind[:-1]}Results", [])
+
+  def _adapt(self, records:int, payload_bytes:int, elapsed:float):
+    """
+      Moves the chunk size towards `target_seconds` per request, capped by `max_payload_bytes`.
+    """
+    with self._lock:
+      per_record = payload_bytes / records
+      self._bytesPerRecord = per_record if self._bytesPerRecord is None else 0.8 * self._bytesPerRecord + 0.2 * per_record
+      suggested = records * self._targetSeconds / max(elapsed, 0.001)
+      # Grow at most x2 per request, shrink halfway towards the suggestion when requests get slow.
+      size = min(suggested, self._chunkSize * 2) if suggested > self._chunkSize else (self._chunkSize + suggested) / 2
+      size = min(size, self._maxPayloadBytes / self._bytesPerRecord)
+      self._chunkSize = int(max(self._minChunk, min(self._maxChunk, size)))
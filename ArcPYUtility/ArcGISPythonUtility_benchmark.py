@@ -0,0 +1,520 @@
+"""
+Benchmarks for ArcGISPythonUtility.py.
+
+Runs against a local stub HTTPS server or the mock portal (ArcGISPythonUtility_mockserver.py), so no portal is needed.
+
+  python ArcGISPythonUtility_benchmark.py transport --requests 500 --threads 8
+  python ArcGISPythonUtility_benchmark.py domains --rows 1000000
+  python ArcGISPythonUtility_benchmark.py pbf --records 20000 --vertices 50
+  python ArcGISPythonUtility_benchmark.py columns --records 500000 --geometry point
+  python ArcGISPythonUtility_benchmark.py e2e
+  python ArcGISPythonUtility_benchmark.py e2e --latency 20 --jitter 5 --update-baseline
+  python ArcGISPythonUtility_benchmark.py startup --repeat 10
+
+`e2e` runs the helpers end to end against the mock portal and reports throughput, p50/p99 request latency and peak
+Python memory per scenario. It exits with 1 when a scenario is slower, or uses more memory, than the stored baseline
+(ArcGISPythonUtility_benchmark_baseline.json) by more than `--tolerance`.
+
+`startup` reports the import time of the module and the time of a short job (new process, token, one count query),
+run cold against run by the warm worker of ArcGISPythonUtility_worker.py.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from ArcGISPythonUtility import UTILS, applyEditsWriter, esriHelper, featureColumns, httpTransport, layerMetadataCache, pbfFeatureCollection, restHelper, versionOrchestrator
+from ArcGISPythonUtility_mockserver import mockArcGISServer, mockState
+
+#---- END of import
+
+class stubHandler(BaseHTTPRequestHandler):
+  """
+    Answers every request with a small ArcGIS-like JSON page. HTTP/1.1 so clients can keep the connection alive.
+  """
+  protocol_version = "HTTP/1.1"
+  disable_nagle_algorithm = True
+  payload = json.dumps({"features": [{"attributes": {"objectid": i}} for i in range(10)]}).encode("UTF-8")
+
+  def _reply(self):
+    length = int(self.headers.get("Content-Length") or 0)
+    if length:
+      self.rfile.read(length)
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(self.payload)))
+    self.end_headers()
+    self.wfile.write(self.payload)
+
+  do_GET = _reply
+  do_POST = _reply
+
+  def log_message(self, format, *args):
+    pass
+
+class stubHttpsServer:
+  """
+    Local HTTPS server with a throw-away self signed certificate for `localhost`. Requires the `openssl` command.
+  """
+  def __init__(self, handler=stubHandler) -> None:
+    if shutil.which("openssl") is None:
+      raise Exception("The 'openssl' command is required to create the certificate of the stub HTTPS server.")
+
+    self._tempDir = tempfile.mkdtemp()
+    self.certFile = os.path.join(self._tempDir, "cert.pem")
+    keyFile = os.path.join(self._tempDir, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-keyout", keyFile, "-out", self.certFile, "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+                   check=True, capture_output=True)
+
+    self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    self._server.daemon_threads = True
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(self.certFile, keyFile)
+    self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+    self.url = f"https://localhost:{self._server.server_address[1]}/arcgis/rest/services/Stub/FeatureServer/0/query"
+
+  def __enter__(self):
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    return self
+
+  def __exit__(self, *args):
+    self._server.shutdown()
+    self._server.server_close()
+    shutil.rmtree(self._tempDir, ignore_errors=True)
+
+def _run(call, count:int, threads:int)->float:
+  """
+    Calls `call()` `count` times spread over `threads` threads and returns requests/sec.
+  """
+  per_thread = count // threads
+  def worker():
+    for _ in range(per_thread):
+      call()
+
+  workers = [threading.Thread(target=worker) for _ in range(threads)]
+  start = time.perf_counter()
+  for w in workers:
+    w.start()
+  for w in workers:
+    w.join()
+  return (per_thread * threads) / (time.perf_counter() - start)
+
+def benchmark_transport(count:int, threads:int):
+  params = {"f": "json", "where": "1=1", "outFields": "*"}
+  with stubHttpsServer() as server:
+    context = ssl.create_default_context(cafile=server.certFile)
+    encoded_params = urllib.parse.urlencode(params).encode("UTF-8")
+    transport = httpTransport({"HTTP_POOL_SIZE": threads})
+
+    results = {
+      # Previous evaluate_url: one urlopen (new connection) per request.
+      "urllib.urlopen (before)": lambda: json.loads(urllib.request.urlopen(server.url, encoded_params, context=context).read()),
+      # Previous callRest: bare requests.post per request.
+      "requests.post (before)": lambda: requests.post(server.url, data=params, verify=server.certFile).json(),
+      # Shared pooled transport.
+      "httpTransport (after)": lambda: transport.request("POST", server.url, data=params, verify=server.certFile).json(),
+    }
+    print(f"{count} requests, {threads} thread(s)")
+    for name, call in results.items():
+      print(f"  {name:<28} {_run(call, count, threads):>10.1f} req/s")
+    transport.close()
+
+def synthetic_layer_info(subtypes:int=10, codes:int=20)->dict:
+  """
+    Layer JSON with a subtype field, two subtype domains per subtype and one inherited field domain.
+  """
+  coded = lambda prefix: [{"name": f"{prefix} {c}", "code": c} for c in range(codes)]
+  return {
+    "objectIdField": "objectid",
+    "subtypeField": "assetgroup",
+    "fields": [
+      {"name": "objectid", "type": "esriFieldTypeOID"},
+      {"name": "assetgroup", "type": "esriFieldTypeInteger"},
+      {"name": "lifecyclestatus", "type": "esriFieldTypeSmallInteger", "domain": {"type": "codedValue", "codedValues": coded("Status")}},
+      {"name": "assettype", "type": "esriFieldTypeSmallInteger"},
+      {"name": "material", "type": "esriFieldTypeSmallInteger"},
+    ],
+    "types": [{"id": st, "name": f"Group {st}", "domains": {
+      "lifecyclestatus": {"type": "inherited"},
+      "assettype": {"type": "codedValue", "codedValues": coded(f"Type {st}")},
+      "material": {"type": "codedValue", "codedValues": coded(f"Material {st}")}}} for st in range(subtypes)],
+  }
+
+def offline_esri_helper(layer_info:dict)->esriHelper:
+  """
+    `esriHelper` whose layer metadata comes from `layer_info` instead of the portal.
+  """
+  esri = esriHelper.__new__(esriHelper)
+  esri._layerCache = layerMetadataCache(lambda layer_url, token: layer_info)
+  return esri
+
+def benchmark_domains(rows:int):
+  layer_url = "https://localhost/arcgis/rest/services/Stub/FeatureServer/0"
+  esri = offline_esri_helper(synthetic_layer_info())
+  rnd = random.Random(0)
+  make_features = lambda: [{"attributes": {"objectid": i, "assetgroup": rnd.randrange(10), "lifecyclestatus": rnd.randrange(20),
+                                           "assettype": rnd.randrange(20), "material": rnd.randrange(20)}} for i in range(rows)]
+  domain_fields = ["lifecyclestatus", "assettype", "material"]
+  print(f"{rows} rows, {len(domain_fields)} domain fields")
+
+  features = make_features()
+  start = time.perf_counter()
+  for feature in features:
+    attributes = feature["attributes"]
+    for name in domain_fields:
+      attributes[name] = esri.getDomainName(layer_url, attributes["assetgroup"], name, attributes[name])
+  print(f"  {'getDomainName per value':<28} {rows / (time.perf_counter() - start):>12.0f} rows/s")
+
+  features = make_features()
+  start = time.perf_counter()
+  esri.decode_domains(features, layer_url)
+  print(f"  {'decode_domains':<28} {rows / (time.perf_counter() - start):>12.0f} rows/s")
+
+  start = time.perf_counter()
+  esri.encode_domains(features, layer_url)
+  print(f"  {'encode_domains':<28} {rows / (time.perf_counter() - start):>12.0f} rows/s")
+
+  try:
+    df = UTILS.features_to_dataframe(make_features())
+  except ImportError:
+    print("  pandas is not installed, columnar path skipped.")
+    return
+  start = time.perf_counter()
+  esri.decode_domains_dataframe(df, layer_url)
+  print(f"  {'decode_domains_dataframe':<28} {rows / (time.perf_counter() - start):>12.0f} rows/s")
+
+class latencyRecorder:
+  """
+    `httpTransport` hook recording the latency of every request.
+  """
+  def __init__(self) -> None:
+    self._latencies = []
+    self._lock = threading.Lock()
+
+  def __call__(self, event:dict, response=None):
+    with self._lock:
+      self._latencies.append(event["latency"])
+
+  def reset(self)->list:
+    """
+    Returns the latencies (seconds) recorded since the last call.
+    """
+    with self._lock:
+      latencies, self._latencies = self._latencies, []
+    return latencies
+
+def _percentile(values:list, percent:float)->float:
+  if not values:
+    return 0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+def _measure(call, recorder:latencyRecorder, repeat:int)->dict:
+  """
+    Runs `call()` (returns the number of units processed) `repeat` times and keeps the best value of every metric,
+    which is far less noisy than a single run.
+  """
+  runs = []
+  for _ in range(repeat):
+    recorder.reset()
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    units = call()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies = recorder.reset()
+    runs.append({"throughput": units / elapsed, "p50_ms": _percentile(latencies, 50) * 1000, "p99_ms": _percentile(latencies, 99) * 1000,
+                 "peak_mb": peak / 1024 / 1024, "requests": len(latencies)})
+  return {"throughput": max(run["throughput"] for run in runs),
+          "p50_ms": min(run["p50_ms"] for run in runs),
+          "p99_ms": min(run["p99_ms"] for run in runs),
+          "peak_mb": min(run["peak_mb"] for run in runs),
+          "requests": min(run["requests"] for run in runs)}
+
+def e2e_scenarios(esri:esriHelper, server:mockArcGISServer, records:int)->dict:
+  """
+    Returns `{name: (unit, call)}`; `call()` returns the number of units processed.
+  """
+  query_url = f"{server.layerUrl}/query"
+  query = lambda paging, workers: lambda: len(esri.query_arcgis_layer_rest_url(query_url, esri.token, batch_size=1000, max_workers=workers, paging=paging))
+
+  def domains():
+    esri.invalidate_layer_metadata()
+    lookups = 0
+    for i in range(50000):
+      group = i % 5 + 1
+      esri.getDomainValues(server.layerUrl, group, "assettype")
+      esri.getDomainCode(server.layerUrl, group, "lifecyclestatus", "In Service")
+      lookups += 2
+    return lookups
+
+  def token_refresh():
+    for _ in range(50):
+      esri._tokenManager.invalidate()
+      esri.token
+    # Concurrent callers after an invalidation share one generateToken request.
+    esri._tokenManager.invalidate()
+    workers = [threading.Thread(target=lambda: esri.token) for _ in range(16)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+    return 51
+
+  def apply_edits():
+    updates = [{"attributes": {"objectid": oid, "lifecyclestatus": oid % 5}} for oid in range(1, min(records, 5000) + 1)]
+    summary = applyEditsWriter(esri, server.layerUrl, max_workers=4, chunk_size=250).write(updates=updates)
+    if summary["updates"]["failed"]:
+      raise Exception(f"applyEdits failed: {summary}")
+    return summary["updates"]["success"]
+
+  def versions():
+    names = [version["versionName"] for version in esri.get_version_catalog().versions() if version["versionName"].lower() != "sde.default"]
+    report = versionOrchestrator(esri, max_workers=4).run(names)
+    failed = [row for row in report if row["status"] != "posted"]
+    if failed:
+      raise Exception(f"Version workflow failed: {failed}")
+    return len(report)
+
+  return {
+    "query_offset": ("records", query("offset", 1)),
+    "query_keyset": ("records", query("keyset", 1)),
+    "query_partitioned_4": ("records", query("partitioned", 4)),
+    "domain_lookups": ("lookups", domains),
+    "token_refresh": ("tokens", token_refresh),
+    "apply_edits_4": ("records", apply_edits),
+    "version_reconcile_post": ("versions", versions),
+  }
+
+def benchmark_e2e(args)->int:
+  options = {"records": args.records, "max_record_count": args.max_record_count, "latency": args.latency, "jitter": args.jitter,
+             "error_rate": args.error_rate}
+  with mockArcGISServer(**options) as server:
+    configs = server.configs(HTTP_POOL_SIZE=8)
+    transport = httpTransport(configs)
+    recorder = latencyRecorder()
+    transport.add_hook(recorder)
+    esri = esriHelper(restHelper(configs, transport=transport), configs)
+    results = {}
+    print(f"{args.records} records, maxRecordCount {args.max_record_count}, latency {args.latency}±{args.jitter} ms, best of {args.repeat} runs")
+    print(f"  {'scenario':<24} {'throughput':>16} {'p50 ms':>8} {'p99 ms':>8} {'peak MB':>8} {'requests':>9}")
+    for name, (unit, call) in e2e_scenarios(esri, server, args.records).items():
+      if args.scenario and name not in args.scenario:
+        continue
+      results[name] = _measure(call, recorder, args.repeat)
+      r = results[name]
+      print(f"  {name:<24} {r['throughput']:>10.1f} {unit + '/s':<5} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['peak_mb']:>8.2f} {r['requests']:>9}")
+    if args.metrics:
+      print(esri.metrics.to_prometheus())
+    transport.close()
+
+  if args.update_baseline:
+    baseline = {"options": options, "results": {name: {key: round(value, 2) for key, value in result.items()} for name, result in results.items()}}
+    with open(args.baseline, "w") as f:
+      json.dump(baseline, f, indent=2)
+    print(f"Baseline written to {args.baseline}")
+    return 0
+  return check_baseline(results, options, args.baseline, args.tolerance)
+
+def check_baseline(results:dict, options:dict, path:str, tolerance:float)->int:
+  """
+    Compares `results` with the stored baseline and returns the exit code (`1` when a scenario regressed).
+  """
+  if not os.path.exists(path):
+    print(f"No baseline at {path}, run with --update-baseline to create it.")
+    return 0
+  with open(path) as f:
+    baseline = json.load(f)
+  if baseline.get("options") != options:
+    print(f"Baseline was recorded with {baseline.get('options')}, not compared.")
+    return 0
+
+  failures = []
+  for name, result in results.items():
+    expected = baseline["results"].get(name)
+    if expected is None:
+      continue
+    if result["throughput"] < expected["throughput"] * (1 - tolerance):
+      failures.append(f"{name}: throughput {result['throughput']:.1f} < baseline {expected['throughput']:.1f}")
+    if result["p99_ms"] > expected["p99_ms"] * (1 + tolerance) + 1:
+      failures.append(f"{name}: p99 {result['p99_ms']:.2f} ms > baseline {expected['p99_ms']:.2f} ms")
+    if result["peak_mb"] > expected["peak_mb"] * (1 + tolerance) + 1:
+      failures.append(f"{name}: peak memory {result['peak_mb']:.2f} MB > baseline {expected['peak_mb']:.2f} MB")
+  for failure in failures:
+    print(f"FAIL {failure}")
+  if not failures:
+    print(f"All scenarios within {tolerance:.0%} of the baseline.")
+  return 1 if failures else 0
+
+def benchmark_pbf(records:int, vertices:int):
+  """
+    f=json against f=pbf on a polyline layer: bytes and parse time of one page, and records/s of a full extraction.
+  """
+  with mockArcGISServer(records=records, geometry="polyline", vertices=vertices) as server:
+    configs = server.configs()
+    esri = esriHelper(restHelper(configs), configs)
+    query_url = f"{server.layerUrl}/query"
+    print(f"{records} polylines of {vertices} vertices, pages of 1000")
+
+    page = {}
+    for query_format in ("json", "pbf"):
+      params = {"f": query_format, "token": esri.token, "where": "1=1", "outFields": "*", "returnGeometry": True, "resultRecordCount": 1000}
+      content = esri.transport.request("POST", query_url, data=params).content
+      parse = json.loads if query_format == "json" else pbfFeatureCollection.decode
+      start = time.perf_counter()
+      for _ in range(5):
+        parse(content)
+      page[query_format] = (len(content), (time.perf_counter() - start) / 5)
+
+    for query_format in ("json", "pbf"):
+      start = time.perf_counter()
+      count = len(esri.query_arcgis_layer_rest_url(query_url, esri.token, returnGeometry=True, batch_size=1000, paging="keyset", query_format=query_format))
+      elapsed = time.perf_counter() - start
+      size, parse_seconds = page[query_format]
+      print(f"  {'f=' + query_format:<8} {size / 1024:>10.0f} KB/page {parse_seconds * 1000:>8.1f} ms parse/page {count / elapsed:>10.0f} records/s")
+    print(f"  pbf is {page['json'][0] / page['pbf'][0]:.1f}x smaller")
+
+def benchmark_columns(records:int, geometry:str, vertices:int):
+  """
+    Memory held by a full extract as a `list` of feature `dict` against `featureColumns`, pages decoded from JSON like
+    they come from the server.
+  """
+  state = mockState(records=records, max_record_count=1000, geometry=geometry, vertices=vertices)
+  layer_info = state.layer_info()
+  pages = lambda: (json.loads(json.dumps(state.query({"f": "json", "where": f"objectid > {offset} AND objectid <= {offset + 1000}", "outFields": "*", "returnGeometry": True})))["features"]
+                   for offset in range(0, records, 1000))
+  print(f"{records} {geometry} features")
+
+  held = {}
+  for container in ("list", "featureColumns"):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    if container == "list":
+      result = [feature for page in pages() for feature in page]
+    else:
+      result = featureColumns.from_layer_info(layer_info, returnGeometry=True)
+      for page in pages():
+        result.append(page)
+    elapsed = time.perf_counter() - start
+    held[container] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"  {container:<16} {held[container] / 1048576:>10.1f} MB held {elapsed:>8.2f} s")
+    del result
+  print(f"  featureColumns holds {held['list'] / held['featureColumns']:.1f}x less")
+
+STARTUP_JOB = """
+print(esri.get_feature_count(f"{configs['BASE_SERVICE_URL']}/FeatureServer/0/query", esri.token))
+"""
+
+def _free_port()->int:
+  import socket
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+def _timed_process(args:list, env:dict)->float:
+  start = time.perf_counter()
+  subprocess.run(args, env=env, check=True, stdout=subprocess.DEVNULL)
+  return time.perf_counter() - start
+
+def benchmark_startup(repeat:int):
+  """
+    Import time of the module, and time of a short scheduled job (new process, login, one count query) run cold against
+    run by the warm worker (ArcGISPythonUtility_worker.py), through the same launcher command.
+  """
+  import ArcGISPythonUtility_worker as worker
+  here = os.path.dirname(os.path.abspath(__file__))
+  env = dict(os.environ, ARCGIS_WORKER_SECRET="benchmark")
+  imports = {}
+  for module in ("ArcGISPythonUtility", "ArcGISPythonUtility_worker"):
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    imports[module] = [float(subprocess.run([sys.executable, "-c", code], cwd=here, env=env, check=True, capture_output=True, text=True).stdout)
+                       for _ in range(repeat)]
+    print(f"  import {module:<28} {_percentile(imports[module], 50) * 1000:>8.1f} ms")
+
+  with mockArcGISServer(latency=2) as server, tempfile.TemporaryDirectory() as folder:
+    ini = os.path.join(folder, "configs.ini")
+    with open(ini, "w") as f:
+      f.write("[configuration]\n" + "".join(f'{key} = "{value}"\n' for key, value in server.configs().items()))
+    script = os.path.join(folder, "job.py")
+    with open(script, "w") as f:
+      f.write(STARTUP_JOB)
+    port = _free_port()
+    launcher = [sys.executable, os.path.join(here, "ArcGISPythonUtility_worker.py"), "--port", str(port), "--config", ini, "run", script]
+
+    cold = [_timed_process(launcher, env) for _ in range(repeat)]
+    serving = subprocess.Popen([sys.executable, os.path.join(here, "ArcGISPythonUtility_worker.py"), "--port", str(port), "--config", ini, "serve"],
+                               env=env, stdout=subprocess.PIPE, text=True)
+    try:
+      for line in serving.stdout:
+        if "listening" in line:
+          break
+      warm = [_timed_process(launcher, env) for _ in range(repeat)]
+      submitted = []
+      for _ in range(repeat):
+        start = time.perf_counter()
+        response = worker.submit({"op": "run", "script": script, "args": []}, port, "benchmark")
+        submitted.append(time.perf_counter() - start)
+        if not response["ok"]:
+          raise Exception(response.get("error") or response.get("stderr"))
+    finally:
+      serving.terminate()
+      serving.wait()
+
+  print(f"  {'job':<35} {'p50 ms':>8} {'max ms':>8}")
+  for name, values in (("cold process", cold), ("launcher + warm worker", warm), ("submit to warm worker", submitted)):
+    print(f"  {name:<35} {_percentile(values, 50) * 1000:>8.1f} {max(values) * 1000:>8.1f}")
+  print(f"  the warm worker runs the job {_percentile(cold, 50) / _percentile(warm, 50):.1f}x faster through the launcher")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="ArcGISPythonUtility benchmarks")
+  parser.add_argument("benchmark", choices=["transport", "domains", "pbf", "columns", "e2e", "startup"])
+  parser.add_argument("--requests", type=int, default=500)
+  parser.add_argument("--threads", type=int, default=1)
+  parser.add_argument("--rows", type=int, default=1000000)
+  parser.add_argument("--records", type=int, default=20000, help="pbf, columns, e2e: features of the mock layer")
+  parser.add_argument("--geometry", choices=["point", "polyline"], default="point", help="columns: geometry of the mock layer")
+  parser.add_argument("--vertices", type=int, default=50, help="pbf, columns: vertices per polyline")
+  parser.add_argument("--max-record-count", type=int, default=1000, help="e2e: maxRecordCount of the mock layer")
+  parser.add_argument("--latency", type=float, default=2, help="e2e: milliseconds added by the mock server")
+  parser.add_argument("--jitter", type=float, default=1, help="e2e: milliseconds")
+  parser.add_argument("--error-rate", type=float, default=0, help="e2e: share of HTTP 503 responses")
+  parser.add_argument("--repeat", type=int, default=5, help="e2e: runs per scenario, the best value of every metric is kept, startup: runs per measure")
+  parser.add_argument("--scenario", action="append", help="e2e: run only this scenario (repeatable)")
+  parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ArcGISPythonUtility_benchmark_baseline.json"))
+  parser.add_argument("--tolerance", type=float, default=0.5, help="e2e: allowed regression against the baseline")
+  parser.add_argument("--update-baseline", action="store_true")
+  parser.add_argument("--metrics", action="store_true", help="e2e: print the request metrics in the Prometheus format")
+  args = parser.parse_args()
+
+  if args.benchmark == "transport":
+    benchmark_transport(args.requests, args.threads)
+  elif args.benchmark == "domains":
+    benchmark_domains(args.rows)
+  elif args.benchmark == "pbf":
+    benchmark_pbf(args.records, args.vertices)
+  elif args.benchmark == "columns":
+    benchmark_columns(args.records, args.geometry, args.vertices)
+  elif args.benchmark == "e2e":
+    sys.exit(benchmark_e2e(args))
+  elif args.benchmark == "startup":
+    benchmark_startup(args.repeat)
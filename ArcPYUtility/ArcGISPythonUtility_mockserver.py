@@ -0,0 +1,824 @@
+"""
+Local stand-in of an ArcGIS Enterprise portal for ArcGISPythonUtility.py, so the helpers can be exercised and measured
+without a live portal. Only the standard library is used.
+
+  python ArcGISPythonUtility_mockserver.py --port 8080 --records 50000 --latency 20 --jitter 5 --error-rate 0.01
+
+Endpoints (`<base>` is `http://127.0.0.1:<port>`):
+
+  <base>/portal/sharing/rest/generateToken
+  <base>/arcgis/rest/services/Mock/FeatureServer                       layer list
+  <base>/arcgis/rest/services/Mock/FeatureServer/0                     layer metadata (subtypes, coded value domains)
+  <base>/arcgis/rest/services/Mock/FeatureServer/0/query               where (AND of simple comparisons), paging, returnIdsOnly, returnCountOnly, f=json|pbf
+  <base>/arcgis/rest/services/Mock/FeatureServer/0/applyEdits
+  <base>/arcgis/rest/services/Mock/VersionManagementServer/versions    version list and info, create, purgeLock, start/stop Reading/Editing, reconcile, post
+  <base>/arcgis/rest/services/Mock/UtilityNetworkServer/trace          connected, subnetwork, upstream, downstream (binary tree per 1000 object ids)
+  <base>/mock/stats                                                    request counts per endpoint
+"""
+import argparse
+import bisect
+import datetime
+import json
+import random
+import re
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#---- END of import
+
+SERVICE_PATH = "/arcgis/rest/services/Mock"
+PORTAL_PATH = "/portal"
+NETWORK_COMPONENT = 1000
+
+# ---- FeatureCollectionPBuffer encoding (f=pbf), quantized to 1e-9 degrees from the upper left corner.
+
+PBF_SCALE = 1e-9
+PBF_TRANSLATE = (-180.0, 90.0)
+PBF_GEOMETRY_TYPES = {"esriGeometryPoint": 0, "esriGeometryMultipoint": 1, "esriGeometryPolyline": 2, "esriGeometryPolygon": 3}
+PBF_FIELD_TYPES = {"esriFieldTypeSmallInteger": 0, "esriFieldTypeInteger": 1, "esriFieldTypeSingle": 2, "esriFieldTypeDouble": 3, "esriFieldTypeString": 4,
+                   "esriFieldTypeDate": 5, "esriFieldTypeOID": 6, "esriFieldTypeGUID": 10, "esriFieldTypeGlobalID": 11}
+
+def _pb_varint(value:int)->bytes:
+  out = bytearray()
+  value &= (1 << 64) - 1
+  while value >= 0x80:
+    out.append((value & 0x7F) | 0x80)
+    value >>= 7
+  out.append(value)
+  return bytes(out)
+
+def _pb_zigzag(value:int)->int:
+  return (value << 1) ^ (value >> 63)
+
+def _pb_uint(field:int, value:int)->bytes:
+  return _pb_varint(field << 3) + _pb_varint(value)
+
+def _pb_bytes(field:int, payload:bytes)->bytes:
+  return _pb_varint(field << 3 | 2) + _pb_varint(len(payload)) + payload
+
+def _pb_double(field:int, value:float)->bytes:
+  return _pb_varint(field << 3 | 1) + struct.pack("<d", value)
+
+def _pb_value(value)->bytes:
+  if value is None:
+    return b""
+  if isinstance(value, bool):
+    return _pb_uint(9, int(value))
+  if isinstance(value, int):
+    return _pb_uint(8, _pb_zigzag(value))
+  if isinstance(value, float):
+    return _pb_double(3, value)
+  return _pb_bytes(1, str(value).encode("UTF-8"))
+
+def _pb_geometry(geometry:dict)->bytes:
+  if "x" in geometry:
+    points, lengths = [[geometry["x"], geometry["y"]]], []
+  else:
+    parts = geometry.get("paths") or geometry.get("rings") or [geometry.get("points", [])]
+    points = [point for part in parts for point in part]
+    lengths = [len(part) for part in parts]
+  coords = []
+  last_x = last_y = 0
+  for x, y in points:
+    qx = round((x - PBF_TRANSLATE[0]) / PBF_SCALE)
+    qy = round((PBF_TRANSLATE[1] - y) / PBF_SCALE)
+    coords += [_pb_zigzag(qx - last_x), _pb_zigzag(qy - last_y)]
+    last_x, last_y = qx, qy
+  payload = b""
+  if lengths:
+    payload += _pb_bytes(2, b"".join(_pb_varint(length) for length in lengths))
+  return payload + _pb_bytes(3, b"".join(_pb_varint(coord) for coord in coords))
+
+def encode_pbf(result:dict, fields:list, geometry_type:str, cache:dict=None)->bytes:
+  """
+    Encodes a query result `dict` (features, count or objectIds) as `FeatureCollectionPBuffer`. Encoded features are kept
+    in `cache` by object id, so the mock does not spend more time encoding than a real server.
+  """
+  if "count" in result:
+    query_result = _pb_bytes(2, _pb_uint(1, result["count"]))
+  elif "objectIds" in result:
+    ids = b"".join(_pb_varint(oid) for oid in result["objectIds"])
+    query_result = _pb_bytes(3, _pb_bytes(1, result["objectIdFieldName"].encode("UTF-8")) + _pb_bytes(3, ids))
+  else:
+    names = list(result["features"][0]["attributes"].keys()) if result["features"] else [field["name"] for field in fields]
+    types = {field["name"]: field["type"] for field in fields}
+    transform = (_pb_uint(1, 0) + _pb_bytes(2, _pb_double(1, PBF_SCALE) + _pb_double(2, PBF_SCALE))
+                 + _pb_bytes(3, _pb_double(1, PBF_TRANSLATE[0]) + _pb_double(2, PBF_TRANSLATE[1])))
+    body = [_pb_bytes(1, result["objectIdFieldName"].encode("UTF-8")),
+            _pb_uint(7, PBF_GEOMETRY_TYPES[geometry_type]),
+            _pb_bytes(8, _pb_uint(1, 4326) + _pb_uint(2, 4326)),
+            _pb_uint(9, int(bool(result.get("exceededTransferLimit")))),
+            _pb_bytes(12, transform)]
+    body += [_pb_bytes(13, _pb_bytes(1, name.encode("UTF-8")) + _pb_uint(2, PBF_FIELD_TYPES.get(types.get(name), 4))) for name in names]
+    oid_field = result["objectIdFieldName"]
+    names_key = tuple(names)
+    for feature in result["features"]:
+      key = (feature["attributes"].get(oid_field), names_key, "geometry" in feature)
+      encoded = cache.get(key) if cache is not None else None
+      if encoded is None:
+        payload = b"".join(_pb_bytes(1, _pb_value(feature["attributes"].get(name))) for name in names)
+        if feature.get("geometry"):
+          payload += _pb_bytes(2, _pb_geometry(feature["geometry"]))
+        encoded = _pb_bytes(15, payload)
+        if cache is not None:
+          cache[key] = encoded
+      body.append(encoded)
+    query_result = _pb_bytes(1, b"".join(body))
+  return _pb_bytes(1, b"1.0.0") + _pb_bytes(2, query_result)
+
+class mockState:
+  """
+    Data and behaviour of the mock portal.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    records:int=10000            Number of features of layer `0`.
+    ---------------------        -------------------------------------------------------------------------------------
+    max_record_count:int=1000    `maxRecordCount` of the layer, pages are capped to it.
+    ---------------------        -------------------------------------------------------------------------------------
+    latency:float=0              Milliseconds added to every response.
+    ---------------------        -------------------------------------------------------------------------------------
+    jitter:float=0               Milliseconds of uniform random variation of `latency`.
+    ---------------------        -------------------------------------------------------------------------------------
+    error_rate:float=0           Share of requests answered with HTTP 503.
+    ---------------------        -------------------------------------------------------------------------------------
+    json_error_rate:float=0      Share of requests answered with HTTP 200 and an ArcGIS JSON error (`code` 500).
+    ---------------------        -------------------------------------------------------------------------------------
+    versions:int=8               Number of branch versions `mock.version<n>` besides `sde.DEFAULT`.
+    ---------------------        -------------------------------------------------------------------------------------
+    geometry:str="point"         Geometry of the layer, `"point"` or `"polyline"`.
+    ---------------------        -------------------------------------------------------------------------------------
+    vertices:int=50              Vertices per polyline.
+    ---------------------        -------------------------------------------------------------------------------------
+    pbf:bool=True                `PBF` in the layer's `supportedQueryFormats`.
+    ---------------------        -------------------------------------------------------------------------------------
+    layers:int=1                 Number of layers of the FeatureServer. Layer `<n>` serves the first `records / 2^n` features of layer `0`.
+    ---------------------        -------------------------------------------------------------------------------------
+    token_minutes:int=60         Lifetime of generated tokens, unless the request asks for less (`expiration`).
+    ---------------------        -------------------------------------------------------------------------------------
+    seed:int=0                   Seed of the generated data and the injected faults.
+    =====================        =====================================================================================
+  """
+  def __init__(self, records:int=10000, max_record_count:int=1000, latency:float=0, jitter:float=0, error_rate:float=0, json_error_rate:float=0, versions:int=8, token_minutes:int=60, seed:int=0, geometry:str="point", vertices:int=50, pbf:bool=True, layers:int=1) -> None:
+    self.maxRecordCount = max_record_count
+    self.geometryType = {"point": "esriGeometryPoint", "polyline": "esriGeometryPolyline"}[geometry]
+    self.vertices = vertices
+    self.layers = layers
+    self.pbf = pbf in (True, "True", "true", "1", 1)
+    self.latency = latency / 1000
+    self.jitter = jitter / 1000
+    self.errorRate = error_rate
+    self.jsonErrorRate = json_error_rate
+    self.tokenMinutes = token_minutes
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self._tokens = {}
+    self._pbfCache = {}
+    self._globalIds = None
+    self.stats = {}
+    self.lastEditDate = int(time.time() * 1000)
+
+    rnd = random.Random(seed)
+    self._oids = []
+    self._rows = []
+    for oid in range(1, records + 1):
+      self._oids.append(oid)
+      self._rows.append(self._new_row(oid, rnd))
+
+    self._versions = {}
+    for name in ["sde.DEFAULT"] + [f"mock.version{n}" for n in range(1, versions + 1)]:
+      self._add_version(name)
+
+  def _new_row(self, oid:int, rnd:random.Random)->dict:
+    return {"attributes": {"objectid": oid,
+                           "globalid": "{" + str(uuid.UUID(int=rnd.getrandbits(128))).upper() + "}",
+                           "assetgroup": rnd.randrange(1, 6),
+                           "assettype": rnd.randrange(0, 10),
+                           "lifecyclestatus": rnd.randrange(0, 5),
+                           "name": f"Asset {oid}",
+                           "last_edited_date": self.lastEditDate - rnd.randrange(0, 365 * 86400) * 1000},
+            "geometry": self._new_geometry(rnd)}
+
+  def _new_geometry(self, rnd:random.Random)->dict:
+    x, y = rnd.uniform(-100, -80), rnd.uniform(30, 45)
+    if self.geometryType == "esriGeometryPoint":
+      return {"x": x, "y": y}
+    path = []
+    for _ in range(self.vertices):
+      path.append([x, y])
+      x, y = x + rnd.uniform(-0.0005, 0.0005), y + rnd.uniform(-0.0005, 0.0005)
+    return {"paths": [path]}
+
+  def _add_version(self, name:str)->dict:
+    version = {"versionName": name, "versionGuid": "{" + str(uuid.uuid4()).upper() + "}", "access": "public",
+               "creationDate": self.lastEditDate, "modifiedDate": self.lastEditDate}
+    self._versions[version["versionGuid"].strip("{}").upper()] = {"info": version, "reader": None, "editor": None, "reconciled": False}
+    return version
+
+  # ---- Faults
+
+  def count(self, endpoint:str):
+    with self._lock:
+      self.stats[endpoint] = self.stats.get(endpoint, 0) + 1
+
+  def delay(self)->float:
+    with self._lock:
+      return max(0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+  def fault(self)->str:
+    """
+    Returns `"http"`, `"json"` or `None`.
+    """
+    with self._lock:
+      value = self._random.random()
+    if value < self.errorRate:
+      return "http"
+    if value < self.errorRate + self.jsonErrorRate:
+      return "json"
+    return None
+
+  # ---- Portal
+
+  def generate_token(self, params:dict)->dict:
+    if not params.get("username") or not params.get("password"):
+      return {"error": {"code": 400, "message": "Unable to generate token.", "details": ["Invalid username or password."]}}
+    minutes = min(int(params.get("expiration") or self.tokenMinutes), self.tokenMinutes)
+    token = uuid.uuid4().hex
+    expires = int(time.time() * 1000) + minutes * 60000
+    with self._lock:
+      self._tokens[token] = expires
+    return {"token": token, "expires": expires, "ssl": False}
+
+  def valid_token(self, token:str)->bool:
+    with self._lock:
+      expires = self._tokens.get(token)
+    return expires is not None and expires > time.time() * 1000
+
+  # ---- FeatureServer
+
+  def service_info(self)->dict:
+    return {"currentVersion": 11.1, "maxRecordCount": self.maxRecordCount,
+            "layers": [{"id": layer, "name": self._layer_name(layer), "geometryType": self.geometryType} for layer in range(self.layers)], "tables": []}
+
+  @staticmethod
+  def _layer_name(layer:int)->str:
+    return "Assets" if layer == 0 else f"Assets {layer}"
+
+  def layer_info(self, layer:int=0)->dict:
+    coded = lambda names: [{"name": name, "code": code} for code, name in enumerate(names)]
+    status = {"type": "codedValue", "name": "LifecycleStatus", "codedValues": coded(["Proposed", "In Service", "Abandoned", "Removed", "Unknown"])}
+    return {
+      "currentVersion": 11.1, "id": layer, "name": self._layer_name(layer), "type": "Feature Layer", "geometryType": self.geometryType,
+      "objectIdField": "objectid", "globalIdField": "globalid", "subtypeField": "assetgroup", "defaultSubtypeCode": 1,
+      "maxRecordCount": self.maxRecordCount,
+      "supportedQueryFormats": "JSON, geoJSON, PBF" if self.pbf else "JSON, geoJSON",
+      "advancedQueryCapabilities": {"supportsPagination": True, "supportsOrderBy": True, "supportsStatistics": True, "supportsHavingClause": True,
+                                    "supportsPaginationOnAggregatedQueries": True},
+      "editFieldsInfo": {"editDateField": "last_edited_date"},
+      "editingInfo": {"lastEditDate": self.lastEditDate},
+      "serverGens": {"minServerGen": 1, "serverGen": self.lastEditDate},
+      "fields": [
+        {"name": "objectid", "type": "esriFieldTypeOID"},
+        {"name": "globalid", "type": "esriFieldTypeGlobalID"},
+        {"name": "assetgroup", "type": "esriFieldTypeInteger"},
+        {"name": "assettype", "type": "esriFieldTypeSmallInteger"},
+        {"name": "lifecyclestatus", "type": "esriFieldTypeSmallInteger", "domain": status},
+        {"name": "name", "type": "esriFieldTypeString", "length": 64},
+        {"name": "last_edited_date", "type": "esriFieldTypeDate"},
+      ],
+      "types": [{"id": group, "name": f"Group {group}", "domains": {
+        "lifecyclestatus": {"type": "inherited"},
+        "assettype": {"type": "codedValue", "name": f"AssetType{group}", "codedValues": coded([f"Type {group}.{t}" for t in range(10)])}}}
+        for group in range(1, 6)],
+    }
+
+  def query(self, params:dict, layer:int=0):
+    """
+    Returns the result `dict`, or the encoded bytes for `f=pbf`.
+    """
+    if params.get("f") == "pbf":
+      if not self.pbf:
+        return {"error": {"code": 400, "message": "Invalid or missing input parameters.", "details": ["'f' parameter is invalid"]}}
+      result = self._query(params, layer)
+      return result if "error" in result else encode_pbf(result, self.layer_info()["fields"], self.geometryType, self._pbfCache)
+    return self._query(params, layer)
+
+  def _query(self, params:dict, layer:int=0)->dict:
+    with self._lock:
+      oids, rows = self._oids, self._rows
+    if layer:
+      size = len(rows) >> layer
+      oids, rows = oids[:size], rows[:size]
+    try:
+      start, stop, predicates = self._parse_where(params.get("where") or "1=1", oids)
+    except ValueError as ex:
+      return {"error": {"code": 400, "message": "Unable to complete operation.", "details": [str(ex)]}}
+
+    selected = [row for row in rows[start:stop] if all(predicate(row["attributes"]) for predicate in predicates)]
+    if str(params.get("orderByFields", "")).strip().lower().endswith("desc"):
+      selected.reverse()
+
+    if params.get("outStatistics"):
+      return self._statistics(selected, params)
+    if self._is_true(params.get("returnCountOnly")):
+      return {"count": len(selected)}
+    if self._is_true(params.get("returnIdsOnly")):
+      return {"objectIdFieldName": "objectid", "objectIds": [row["attributes"]["objectid"] for row in selected]}
+
+    offset = int(params.get("resultOffset") or 0)
+    size = min(int(params.get("resultRecordCount") or self.maxRecordCount), self.maxRecordCount)
+    page = selected[offset:offset + size]
+    fields = [name.strip() for name in str(params.get("outFields") or "*").split(",")]
+    with_geometry = self._is_true(params.get("returnGeometry", "true"))
+    features = []
+    for row in page:
+      attributes = row["attributes"] if "*" in fields else {name: row["attributes"].get(name) for name in fields}
+      features.append({"attributes": attributes, "geometry": row["geometry"]} if with_geometry else {"attributes": attributes})
+
+    result = {"objectIdFieldName": "objectid", "geometryType": self.geometryType, "features": features}
+    if offset + size < len(selected):
+      result["exceededTransferLimit"] = True
+    return result
+
+  def _statistics(self, selected:list, params:dict)->dict:
+    """
+      `outStatistics` (`count`, `sum`, `min`, `max`, `avg`, `stddev`, `var`) per `groupByFieldsForStatistics`, with
+      `having` (`AND` joined `<STAT>(<field>) <op> <number>`), `orderByFields` and `resultOffset` / `resultRecordCount`.
+    """
+    try:
+      statistics = json.loads(params["outStatistics"]) if isinstance(params["outStatistics"], str) else params["outStatistics"]
+    except ValueError:
+      return {"error": {"code": 400, "message": "Unable to complete operation.", "details": ["Invalid outStatistics."]}}
+    group_by = [name.strip().lower() for name in str(params.get("groupByFieldsForStatistics") or "").split(",") if name.strip()]
+
+    def aggregate(kind:str, values:list):
+      values = [value for value in values if value is not None]
+      if kind == "count":
+        return len(values)
+      if not values:
+        return None
+      if kind in ("sum", "min", "max"):
+        return {"sum": sum, "min": min, "max": max}[kind](values)
+      mean = sum(values) / len(values)
+      if kind == "avg":
+        return mean
+      variance = sum((value - mean) ** 2 for value in values) / (len(values) - 1) if len(values) > 1 else 0.0
+      return variance if kind == "var" else variance ** 0.5
+
+    groups = {}
+    for row in selected:
+      groups.setdefault(tuple(row["attributes"].get(name) for name in group_by), []).append(row["attributes"])
+    if not group_by and not groups:
+      groups[()] = []
+
+    having = []
+    for condition in re.split(r"\s+AND\s+", str(params.get("having") or "").strip(), flags=re.IGNORECASE):
+      if not condition:
+        continue
+      match = re.fullmatch(r"(\w+)\s*\(\s*(\w+)\s*\)\s*(>=|<=|<>|>|<|=)\s*(-?\d+(?:\.\d+)?)", condition.strip())
+      if not match:
+        return {"error": {"code": 400, "message": "Unable to complete operation.", "details": [f"Unsupported having clause: {condition}"]}}
+      having.append((match.group(1).lower(), match.group(2).lower(), match.group(3), float(match.group(4))))
+    compare = {">": lambda a, b: a > b, ">=": lambda a, b: a >= b, "<": lambda a, b: a < b, "<=": lambda a, b: a <= b,
+               "=": lambda a, b: a == b, "<>": lambda a, b: a != b}
+
+    features = []
+    for key, rows in groups.items():
+      if not all((value := aggregate(kind, [r.get(field) for r in rows])) is not None and compare[op](value, number) for kind, field, op, number in having):
+        continue
+      attributes = dict(zip(group_by, key))
+      for statistic in statistics:
+        kind = str(statistic.get("statisticType", "")).lower()
+        if kind not in ("count", "sum", "min", "max", "avg", "stddev", "var"):
+          return {"error": {"code": 400, "message": "Unable to complete operation.", "details": [f"Invalid statisticType '{kind}'."]}}
+        field = str(statistic.get("onStatisticField", "")).lower()
+        attributes[statistic.get("outStatisticFieldName") or f"{kind}_{field}"] = aggregate(kind, [r.get(field) for r in rows])
+      features.append({"attributes": attributes})
+
+    for order in reversed([part.strip().split() for part in str(params.get("orderByFields") or "").split(",") if part.strip()]):
+      features.sort(key=lambda f, name=order[0]: (f["attributes"].get(name) is None, f["attributes"].get(name)), reverse=len(order) > 1 and order[1].lower() == "desc")
+
+    offset = int(params.get("resultOffset") or 0)
+    size = min(int(params.get("resultRecordCount") or self.maxRecordCount), self.maxRecordCount)
+    result = {"features": features[offset:offset + size],
+              "fields": [{"name": name} for name in list(group_by) + [s.get("outStatisticFieldName") for s in statistics]]}
+    if offset + size < len(features):
+      result["exceededTransferLimit"] = True
+    return result
+
+  def _parse_where(self, where:str, oids:list):
+    """
+      Returns `(start, stop, predicates)`: the slice of the OID sorted rows and the remaining conditions. Supports `1=1` and
+      `AND` joined `<field> <op> <number | 'text' | TIMESTAMP 'yyyy-mm-dd hh:mm:ss'>`.
+    """
+    start, stop, predicates = 0, len(oids), []
+    for condition in re.split(r"\s+AND\s+", where.strip(), flags=re.IGNORECASE):
+      condition = condition.strip()
+      while condition.startswith("(") and condition.endswith(")"):
+        condition = condition[1:-1].strip()
+      if condition.replace(" ", "") in ("1=1", ""):
+        continue
+      match = re.fullmatch(r"(\w+)\s*(>=|<=|<>|>|<|=)\s*(TIMESTAMP\s+'[^']*'|'[^']*'|-?\d+(?:\.\d+)?)", condition, flags=re.IGNORECASE)
+      if not match:
+        raise ValueError(f"Unsupported where clause: {condition}")
+      field, op, literal = match.group(1).lower(), match.group(2), match.group(3)
+      if literal.upper().startswith("TIMESTAMP"):
+        text = literal.split("'")[1]
+        value = int(datetime.datetime.strptime(text, "%Y-%m-%d %H:%M:%S").replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+      elif literal.startswith("'"):
+        value = literal[1:-1]
+      else:
+        value = float(literal) if "." in literal else int(literal)
+
+      if field == "objectid" and op in (">", ">=", "<", "<=", "="):
+        # Range on the sorted OIDs instead of a scan.
+        if op in (">", ">="):
+          start = max(start, (bisect.bisect_right if op == ">" else bisect.bisect_left)(oids, value))
+        elif op in ("<", "<="):
+          stop = min(stop, (bisect.bisect_left if op == "<" else bisect.bisect_right)(oids, value))
+        else:
+          start, stop = max(start, bisect.bisect_left(oids, value)), min(stop, bisect.bisect_right(oids, value))
+        continue
+      compare = {">": lambda a, b: a > b, ">=": lambda a, b: a >= b, "<": lambda a, b: a < b, "<=": lambda a, b: a <= b,
+                 "=": lambda a, b: a == b, "<>": lambda a, b: a != b}[op]
+      predicates.append(lambda attributes, field=field, value=value, compare=compare: attributes.get(field) is not None and compare(attributes.get(field), value))
+    return start, stop, predicates
+
+  def apply_edits(self, params:dict)->dict:
+    # Like the server, a value that does not fit its field fails the whole request and nothing is applied.
+    lengths = {field["name"]: field["length"] for field in self.layer_info()["fields"] if "length" in field}
+    for kind in ("adds", "updates"):
+      if params.get(kind):
+        for record in json.loads(params[kind]):
+          for name, value in record.get("attributes", {}).items():
+            if isinstance(value, str) and len(value) > lengths.get(name, len(value)):
+              return {"error": {"code": 400, "message": "Unable to complete operation.", "details": [f"Value of '{name}' exceeds the field length."]}}
+    result = {}
+    with self._lock:
+      rows = {row["attributes"]["objectid"]: row for row in self._rows}
+      next_oid = (self._oids[-1] if self._oids else 0) + 1
+      now = int(time.time() * 1000)
+      rnd = random.Random(next_oid)
+      for kind in ("adds", "updates", "deletes"):
+        if not params.get(kind):
+          continue
+        records = json.loads(params[kind]) if params[kind].lstrip().startswith("[") else [int(oid) for oid in params[kind].split(",")]
+        results = []
+        for record in records:
+          if kind == "adds":
+            row = self._new_row(next_oid, rnd)
+            row["attributes"].update({k: v for k, v in record.get("attributes", {}).items() if k != "objectid"})
+            row["attributes"]["last_edited_date"] = now
+            rows[next_oid] = row
+            results.append({"objectId": next_oid, "globalId": row["attributes"]["globalid"], "success": True})
+            next_oid += 1
+            continue
+          oid = record if kind == "deletes" else record.get("attributes", {}).get("objectid")
+          if oid not in rows:
+            results.append({"objectId": oid, "success": False, "error": {"code": 1019, "description": "Object is missing."}})
+          elif kind == "deletes":
+            del rows[oid]
+            results.append({"objectId": oid, "success": True})
+          else:
+            rows[oid]["attributes"].update(record["attributes"])
+            rows[oid]["attributes"]["last_edited_date"] = now
+            results.append({"objectId": oid, "success": True})
+        result[f"{kind[:-1]}Results"] = results
+      self._oids = sorted(rows)
+      self._rows = [rows[oid] for oid in self._oids]
+      self._pbfCache = {}
+      self._globalIds = None
+      self.lastEditDate = now
+      for version in self._versions.values():
+        if version["info"]["versionName"].lower() == str(params.get("gdbVersion") or "sde.DEFAULT").lower():
+          version["info"]["modifiedDate"] = now
+    return result
+
+  # ---- VersionManagementServer
+
+  def versions(self)->dict:
+    with self._lock:
+      return {"versions": [dict(version["info"]) for version in self._versions.values()]}
+
+  def version_info(self, guid:str)->dict:
+    with self._lock:
+      version = self._versions.get(guid.strip("{}").upper())
+      if version is None:
+        return {"error": {"code": 404, "message": "Version not found."}}
+      return dict(version["info"])
+
+  def create_version(self, params:dict)->dict:
+    name = params.get("versionName")
+    if not name:
+      return {"error": {"code": 400, "message": "versionName is required."}}
+    full_name = f"mock.{name}"
+    with self._lock:
+      if any(version["info"]["versionName"].lower() == full_name.lower() for version in self._versions.values()):
+        return {"success": False, "error": {"code": 400, "message": f"Version {full_name} already exists."}}
+      return {"success": True, "versionInfo": dict(self._add_version(full_name))}
+
+  def purge_lock(self, params:dict)->dict:
+    name = str(params.get("versionName", "")).lower()
+    with self._lock:
+      for version in self._versions.values():
+        if version["info"]["versionName"].lower() == name:
+          version["reader"] = version["editor"] = None
+          return {"success": True}
+    return {"success": False, "error": {"code": 400, "message": "Version not found."}}
+
+  def version_action(self, guid:str, action:str, params:dict)->dict:
+    session = params.get("sessionId")
+    with self._lock:
+      version = self._versions.get(guid.strip("{}").upper())
+      if version is None:
+        return {"success": False, "error": {"code": 404, "message": "Version not found."}}
+      if action == "startReading":
+        if version["reader"] not in (None, session):
+          return {"success": False, "error": {"code": 400, "message": "The version is locked by another session."}}
+        version["reader"] = session
+      elif action == "startEditing":
+        if version["reader"] != session or version["editor"] not in (None, session):
+          return {"success": False, "error": {"code": 400, "message": "The version is locked by another session."}}
+        version["editor"] = session
+        version["reconciled"] = False
+      elif action in ("stopEditing", "stopReading"):
+        version["editor"] = None
+        if action == "stopReading":
+          version["reader"] = None
+      elif action in ("reconcile", "post"):
+        if version["editor"] != session:
+          return {"success": False, "error": {"code": 400, "message": f"{action} requires an edit session."}}
+        if action == "post" and not version["reconciled"]:
+          return {"success": False, "error": {"code": 400, "message": "The version must be reconciled before post."}}
+        version["reconciled"] = True
+        version["info"]["modifiedDate"] = int(time.time() * 1000)
+        return {"success": True, "hasConflicts": False, "moment": version["info"]["modifiedDate"], "didPost": action == "post" or self._is_true(params.get("withPost"))}
+      else:
+        return {"success": False, "error": {"code": 400, "message": f"Unsupported operation {action}."}}
+    return {"success": True}
+
+  # ---- UtilityNetworkServer
+
+  def trace(self, params:dict)->dict:
+    """
+      `connected`, `subnetwork`, `upstream` and `downstream` traces. The network is a binary tree per block of
+      `NETWORK_COMPONENT` object ids (the parent of the n-th feature of a block is its n/2-th), barriers stop the traversal.
+    """
+    try:
+      locations = json.loads(params.get("traceLocations") or "[]")
+    except ValueError:
+      return {"success": False, "error": {"code": 400, "message": "Invalid traceLocations."}}
+    trace_type = str(params.get("traceType") or "").lower()
+    if trace_type not in ("connected", "subnetwork", "upstream", "downstream"):
+      return {"success": False, "error": {"code": 400, "message": f"Unsupported trace type '{trace_type}'."}}
+    with self._lock:
+      if self._globalIds is None:
+        self._globalIds = {row["attributes"]["globalid"]: row for row in self._rows}
+      by_global_id, oids, rows = self._globalIds, self._oids, self._rows
+
+    def row_of(oid:int):
+      index = bisect.bisect_left(oids, oid)
+      return rows[index] if index < len(oids) and oids[index] == oid else None
+
+    starts, barriers = [], set()
+    for location in locations:
+      row = by_global_id.get("{" + str(location.get("globalId", "")).strip("{}").upper() + "}")
+      if row is None:
+        continue
+      oid = row["attributes"]["objectid"]
+      if location.get("traceLocationType") == "barrier":
+        barriers.add(oid)
+      else:
+        starts.append(oid)
+    if not starts:
+      return {"success": False, "error": {"code": 400, "message": "No valid starting points were found."}}
+
+    def neighbors(oid:int):
+      block, local = divmod(oid - 1, NETWORK_COMPONENT)
+      local += 1
+      parent = [block * NETWORK_COMPONENT + local // 2] if local > 1 else []
+      children = [block * NETWORK_COMPONENT + child for child in (2 * local, 2 * local + 1) if child <= NETWORK_COMPONENT]
+      return {"upstream": parent, "downstream": children}.get(trace_type, parent + children)
+
+    seen = set(starts)
+    pending = list(starts)
+    while pending:
+      for neighbor in neighbors(pending.pop()):
+        if neighbor not in seen and neighbor not in barriers and row_of(neighbor) is not None:
+          seen.add(neighbor)
+          pending.append(neighbor)
+
+    elements = []
+    for oid in sorted(seen):
+      attributes = row_of(oid)["attributes"]
+      elements.append({"networkSourceId": 5, "globalId": attributes["globalid"], "objectId": oid, "terminalId": 1,
+                       "assetGroupCode": attributes["assetgroup"], "assetTypeCode": attributes["assettype"]})
+    return {"traceResults": {"elements": elements, "diagramName": "", "globalFunctionResults": [], "kFeaturesForKNNFound": False,
+                             "startingPointsIgnored": False, "warnings": []}, "success": True}
+
+  @staticmethod
+  def _is_true(value)->bool:
+    return str(value).lower() == "true"
+
+class mockArcGISHandler(BaseHTTPRequestHandler):
+  """
+    Routes the ArcGIS REST requests to `mockState` (`self.server.state`). GET and POST (form encoded) are accepted.
+  """
+  protocol_version = "HTTP/1.1"
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    self._handle(urllib.parse.urlsplit(self.path).query)
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length") or 0)
+    query = urllib.parse.urlsplit(self.path).query
+    body = self.rfile.read(length).decode("UTF-8") if length else ""
+    self._handle(f"{query}&{body}" if query else body)
+
+  def _handle(self, query:str):
+    state = self.server.state
+    path = urllib.parse.urlsplit(self.path).path.rstrip("/")
+    params = dict(urllib.parse.parse_qsl(query, keep_blank_values=True))
+    endpoint, call = self._route(state, path, params)
+    state.count(endpoint)
+
+    if endpoint == "stats":
+      return self._send(200, dict(state.stats))
+    time.sleep(state.delay())
+    if endpoint == "notFound":
+      return self._send(404, {"error": {"code": 404, "message": "Not Found"}})
+    fault = state.fault()
+    if fault == "http":
+      return self._send(503, {"error": {"code": 503, "message": "Service Unavailable"}})
+    if fault == "json":
+      return self._send(200, {"error": {"code": 500, "message": "Injected error.", "details": []}})
+    if endpoint != "token" and not state.valid_token(params.get("token")):
+      return self._send(200, {"error": {"code": 498, "message": "Invalid Token", "details": []}})
+    self._send(200, call())
+
+  def _route(self, state:mockState, path:str, params:dict):
+    if path == "/mock/stats":
+      return "stats", None
+    if path == f"{PORTAL_PATH}/sharing/rest/generateToken":
+      return "token", lambda: state.generate_token(params)
+    if path == f"{SERVICE_PATH}/FeatureServer":
+      return "service", state.service_info
+    match = re.fullmatch(rf"{SERVICE_PATH}/FeatureServer/(\d+)(/query)?", path)
+    if match and int(match.group(1)) < state.layers:
+      layer = int(match.group(1))
+      if match.group(2):
+        return "query", lambda: state.query(params, layer)
+      return "layer", lambda: state.layer_info(layer)
+    if path == f"{SERVICE_PATH}/FeatureServer/0/applyEdits":
+      return "applyEdits", lambda: state.apply_edits(params)
+    if path == f"{SERVICE_PATH}/VersionManagementServer/versions":
+      return "versions", state.versions
+    if path == f"{SERVICE_PATH}/VersionManagementServer/create":
+      return "version", lambda: state.create_version(params)
+    if path == f"{SERVICE_PATH}/VersionManagementServer/purgeLock":
+      return "version", lambda: state.purge_lock(params)
+    if path == f"{SERVICE_PATH}/UtilityNetworkServer/trace":
+      return "utilityNetwork", lambda: state.trace(params)
+    match = re.fullmatch(rf"{SERVICE_PATH}/VersionManagementServer/versions/([^/]+)", path)
+    if match:
+      return "version", lambda: state.version_info(urllib.parse.unquote(match.group(1)))
+    match = re.fullmatch(rf"{SERVICE_PATH}/VersionManagementServer/versions/([^/]+)/(\w+)", path)
+    if match:
+      return "version", lambda: state.version_action(urllib.parse.unquote(match.group(1)), match.group(2), params)
+    return "notFound", None
+
+  def _send(self, status:int, body):
+    payload = body if isinstance(body, bytes) else json.dumps(body).encode("UTF-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/x-protobuf" if isinstance(body, bytes) else "application/json")
+    self.send_header("Content-Length", str(len(payload)))
+    self.end_headers()
+    try:
+      self.wfile.write(payload)
+    except (BrokenPipeError, ConnectionResetError):
+      # The client timed out, e.g. the HTTP_READ_TIMEOUT tests.
+      pass
+
+  def log_message(self, format, *args):
+    pass
+
+class mockArcGISServer:
+  """
+    Runs the mock portal on `127.0.0.1` and exposes the URLs of its endpoints.
+
+    With `in_process=False` (default) the server runs in a separate Python process, so it does not compete with the
+    client for the GIL nor count towards its memory. Keyword arguments are the ones of `mockState`.
+
+    .. code-block:: python
+      >>> with mockArcGISServer(records=50000, latency=20) as server:
+            configs = server.configs()
+  """
+  def __init__(self, in_process:bool=False, **options) -> None:
+    self._inProcess = in_process
+    self._options = options
+    self._server = None
+    self._process = None
+    self.baseUrl = None
+
+  def __enter__(self):
+    if self._inProcess:
+      self._server = ThreadingHTTPServer(("127.0.0.1", 0), mockArcGISHandler)
+      self._server.daemon_threads = True
+      self._server.state = mockState(**self._options)
+      threading.Thread(target=self._server.serve_forever, daemon=True).start()
+      self.baseUrl = f"http://127.0.0.1:{self._server.server_address[1]}"
+    else:
+      args = [sys.executable, __file__, "--port", "0"]
+      for key, value in self._options.items():
+        args += [f"--{key.replace('_', '-')}", str(value).lower() if isinstance(value, bool) else str(value)]
+      self._process = subprocess.Popen(args, stdout=subprocess.PIPE, text=True)
+      line = self._process.stdout.readline().strip()
+      if not line.startswith("http"):
+        self._process.kill()
+        raise Exception(f"Mock server did not start: {line}")
+      self.baseUrl = line
+    return self
+
+  def __exit__(self, *args):
+    if self._server is not None:
+      self._server.shutdown()
+      self._server.server_close()
+    if self._process is not None:
+      self._process.terminate()
+      self._process.wait()
+
+  @property
+  def state(self)->mockState:
+    """
+      The `mockState` of an `in_process` server, e.g. to change `errorRate` or `latency` while it runs.
+    """
+    if self._server is None:
+      raise Exception("The state is only available with in_process=True.")
+    return self._server.state
+
+  @property
+  def portalUrl(self)->str:
+    return f"{self.baseUrl}{PORTAL_PATH}"
+
+  @property
+  def serviceUrl(self)->str:
+    return f"{self.baseUrl}{SERVICE_PATH}"
+
+  @property
+  def layerUrl(self)->str:
+    return f"{self.serviceUrl}/FeatureServer/0"
+
+  def configs(self, **extra)->dict:
+    """
+      Config `dict` for `restHelper` / `esriHelper` pointing to the mock portal.
+    """
+    configs = {"PORTAL_URL": self.portalUrl, "PORTAL_USER": "mock", "PORTAL_PASS": "mock",
+               "BASE_SERVICE_URL": self.serviceUrl, "VERSION_NAME": "version1", "VERSION_OWNER": "mock"}
+    configs.update(extra)
+    return configs
+
+  def stats(self)->dict:
+    """
+      Returns the number of requests per endpoint class since the server started.
+    """
+    import urllib.request
+    with urllib.request.urlopen(f"{self.baseUrl}/mock/stats") as response:
+      return json.loads(response.read())
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Mock ArcGIS REST server")
+  parser.add_argument("--port", type=int, default=8080)
+  parser.add_argument("--records", type=int, default=10000)
+  parser.add_argument("--max-record-count", type=int, default=1000)
+  parser.add_argument("--latency", type=float, default=0, help="milliseconds")
+  parser.add_argument("--jitter", type=float, default=0, help="milliseconds")
+  parser.add_argument("--error-rate", type=float, default=0, help="share of HTTP 503 responses")
+  parser.add_argument("--json-error-rate", type=float, default=0, help="share of ArcGIS JSON error responses")
+  parser.add_argument("--versions", type=int, default=8)
+  parser.add_argument("--token-minutes", type=int, default=60)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--geometry", choices=["point", "polyline"], default="point")
+  parser.add_argument("--vertices", type=int, default=50)
+  parser.add_argument("--pbf", choices=["true", "false"], default="true", help="PBF in supportedQueryFormats")
+  parser.add_argument("--layers", type=int, default=1)
+  args = parser.parse_args()
+
+  server = ThreadingHTTPServer(("127.0.0.1", args.port), mockArcGISHandler)
+  server.daemon_threads = True
+  server.state = mockState(records=args.records, max_record_count=args.max_record_count, latency=args.latency, jitter=args.jitter,
+                           error_rate=args.error_rate, json_error_rate=args.json_error_rate, versions=args.versions,
+                           token_minutes=args.token_minutes, seed=args.seed, geometry=args.geometry, vertices=args.vertices, pbf=args.pbf,
+                           layers=args.layers)
+  print(f"http://127.0.0.1:{server.server_address[1]}", flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    server.server_close()
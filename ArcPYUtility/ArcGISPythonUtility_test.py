@@ -0,0 +1,675 @@
+"""
+Behavioral tests of ArcGISPythonUtility.py against the mock portal (ArcGISPythonUtility_mockserver.py), no portal needed.
+
+  python -m unittest ArcGISPythonUtility_test
+  python -m unittest ArcGISPythonUtility_test.pagingTests
+"""
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from ArcGISPythonUtility import applyEditsWriter, esriHelper, featureColumns, featureServerExtractor, pbfFeatureCollection, restHelper, tokenManager
+from ArcGISPythonUtility_mockserver import PBF_SCALE, _pb_varint, _pb_zigzag, mockArcGISServer
+import ArcGISPythonUtility_worker
+from ArcGISPythonUtility_worker import run_script, workerState
+
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+#---- END of import
+
+def start_server(test_class, **options)->mockArcGISServer:
+  """
+    Starts an in-process mock server stopped after the tests of `test_class`.
+  """
+  server = mockArcGISServer(in_process=True, **options).__enter__()
+  test_class.addClassCleanup(server.__exit__, None, None, None)
+  return server
+
+def new_esri(server:mockArcGISServer, **configs)->esriHelper:
+  configs = server.configs(**configs)
+  return esriHelper(restHelper(configs), configs)
+
+class pagingTests(unittest.TestCase):
+  """
+    Offset, keyset and partitioned paging return the same features, whatever the page size and the layer's `maxRecordCount`.
+  """
+  @classmethod
+  def setUpClass(cls):
+    cls.server = start_server(cls, records=2345, max_record_count=500)
+    cls.esri = new_esri(cls.server)
+    cls.url = f"{cls.server.layerUrl}/query"
+
+  def query(self, **kwargs)->list:
+    return self.esri.query_arcgis_layer_rest_url(self.url, self.esri.token, batch_size=1000, **kwargs)
+
+  def test_modes_return_the_same_features(self):
+    for where_clause in ("1=1", "assetgroup = 2", "objectid > 1700"):
+      for outFields in ("*", "name,assetgroup"):
+        expected = self.query(where_clause=where_clause, outFields=outFields, paging="offset")
+        self.assertEqual(len(expected), self.esri.get_feature_count(self.url, self.esri.token, where_clause))
+        for paging, max_workers in (("offset", 3), ("keyset", 1), ("partitioned", 3), ("auto", 1), ("auto", 4)):
+          with self.subTest(where_clause=where_clause, outFields=outFields, paging=paging, max_workers=max_workers):
+            features = self.query(where_clause=where_clause, outFields=outFields, paging=paging, max_workers=max_workers)
+            self.assertEqual(sorted(map(json.dumps, features)), sorted(map(json.dumps, expected)))
+
+  def test_offset_is_the_default(self):
+    before = self.server.stats()
+    features = self.query(outFields="name")
+    after = self.server.stats()
+    self.assertEqual(len(features), 2345)
+    self.assertEqual(after.get("layer", 0), before.get("layer", 0), "offset paging needs no layer metadata")
+    self.assertEqual(list(features[0]["attributes"]), ["name"])
+
+  def test_keyset_pages_come_in_oid_order(self):
+    oids = [feature["attributes"]["objectid"] for feature in self.query(outFields="objectid,name", paging="keyset")]
+    self.assertEqual(oids, sorted(oids))
+    self.assertEqual(len(oids), len(set(oids)))
+
+  def test_keyset_drops_the_paging_oid(self):
+    # Checked while iterating: the features must not change once they are handed out.
+    for prefetch in (0, 2):
+      for paging, max_workers in (("keyset", 1), ("partitioned", 3)):
+        with self.subTest(prefetch=prefetch, paging=paging):
+          count = 0
+          for feature in self.esri.iter_features(self.url, self.esri.token, outFields="name", batch_size=500, prefetch=prefetch, paging=paging, max_workers=max_workers):
+            self.assertEqual(list(feature["attributes"]), ["name"])
+            count += 1
+          self.assertEqual(count, 2345)
+          for page in self.esri.iter_pages(self.url, self.esri.token, outFields="name", batch_size=500, prefetch=prefetch, paging=paging, max_workers=max_workers):
+            self.assertEqual({tuple(feature["attributes"]) for feature in page}, {("name",)})
+
+  def test_iter_pages_respects_max_record_count(self):
+    pages = list(self.esri.iter_pages(self.url, self.esri.token, batch_size=2000, paging="keyset"))
+    self.assertTrue(all(len(page) <= 500 for page in pages))
+    self.assertEqual(sum(map(len, pages)), 2345)
+
+class pbfTests(unittest.TestCase):
+  """
+    `f=pbf` queries decode to the JSON features, coordinates within the quantization of the server.
+  """
+  @classmethod
+  def setUpClass(cls):
+    cls.server = start_server(cls, records=300, max_record_count=100, geometry="polyline", vertices=5)
+    cls.esri = new_esri(cls.server)
+    cls.url = f"{cls.server.layerUrl}/query"
+
+  def test_pbf_matches_json(self):
+    token = self.esri.token
+    expected = self.esri.query_arcgis_layer_rest_url(self.url, token, returnGeometry=True, query_format="json")
+    features = self.esri.query_arcgis_layer_rest_url(self.url, token, returnGeometry=True, query_format="pbf")
+    self.assertEqual(len(features), len(expected))
+    for feature, other in zip(features, expected):
+      self.assertEqual(feature["attributes"], other["attributes"])
+      self.assertEqual(len(feature["geometry"]["paths"]), len(other["geometry"]["paths"]))
+      for path, other_path in zip(feature["geometry"]["paths"], other["geometry"]["paths"]):
+        self.assertEqual(len(path), len(other_path))
+        for point, other_point in zip(path, other_path):
+          self.assertAlmostEqual(point[0], other_point[0], delta=PBF_SCALE)
+          self.assertAlmostEqual(point[1], other_point[1], delta=PBF_SCALE)
+
+  def test_json_is_the_default(self):
+    token = self.esri.token
+    expected = self.esri.query_arcgis_layer_rest_url(self.url, token, returnGeometry=True, query_format="json")
+    self.assertEqual(self.esri.query_arcgis_layer_rest_url(self.url, token, returnGeometry=True), expected)
+    self.assertEqual(list(self.esri.query_to_columns(self.url, token, returnGeometry=True).iter_features()), expected)
+
+  def test_count_and_ids_in_pbf(self):
+    token = self.esri.token
+    response = self.esri.evaluate_url(self.url, {"f": "pbf", "token": token, "where": "objectid <= 42", "returnCountOnly": True})
+    self.assertEqual(response["count"], 42)
+    response = self.esri.evaluate_url(self.url, {"f": "pbf", "token": token, "where": "objectid <= 5", "returnIdsOnly": True})
+    self.assertEqual(response["objectIds"], [1, 2, 3, 4, 5])
+
+class pbfDecoderTests(unittest.TestCase):
+  """
+    The numpy and the pure Python coordinate decoders return the same vertices, empty geometries included.
+  """
+  SCALE = (0.5, 0.25, 0.1, 0.01)
+  TRANSLATE = (-100.0, 50.0, 0.0, 0.0)
+
+  def encode(self, geometries:list, dimensions:int)->tuple:
+    """
+      Returns the buffer and the spans of the delta and zigzag encoded `geometries` (lists of quantized vertices),
+      separated by bytes that are not coordinates.
+    """
+    buf, spans = bytearray(b"\x0a\x80"), []
+    for vertices in geometries:
+      previous = [0] * dimensions
+      start = len(buf)
+      for vertex in vertices:
+        for d in range(dimensions):
+          buf += _pb_varint(_pb_zigzag(vertex[d] - previous[d]))
+        previous = list(vertex)
+      spans.append((start, len(buf)))
+      buf += b"\xff\x01"
+    return bytes(buf), spans
+
+  def decode(self, geometries:list, has_z:bool=False, has_m:bool=False, upper_left:bool=True)->list:
+    buf, spans = self.encode(geometries, 2 + has_z + has_m)
+    result = pbfFeatureCollection._decode_coordinates(buf, spans, has_z, has_m, self.SCALE, self.TRANSLATE, upper_left, use_numpy=False)
+    try:
+      import numpy
+    except ImportError:
+      return result
+    self.assertEqual(pbfFeatureCollection._decode_coordinates(buf, spans, has_z, has_m, self.SCALE, self.TRANSLATE, upper_left), result)
+    return result
+
+  def test_only_empty_geometries(self):
+    self.assertEqual(self.decode([]), [])
+    self.assertEqual(self.decode([[], []]), [[], []])
+    self.assertEqual(self.decode([[], [], []], has_z=True, has_m=True), [[], [], []])
+
+  def test_mixed_geometries(self):
+    geometries = [[], [(1, 2), (3, -4), (300000, 5)], [], [(-7, 8)], []]
+    self.assertEqual(self.decode(geometries), [[], [[-99.5, 49.5], [-98.5, 51.0], [149900.0, 48.75]], [], [[-103.5, 48.0]], []])
+    self.assertEqual(self.decode(geometries, upper_left=False), [[], [[-99.5, 50.5], [-98.5, 49.0], [149900.0, 51.25]], [], [[-103.5, 52.0]], []])
+
+  def test_z_and_m(self):
+    geometries = [[(1, 2, 30, 400)], [], [(10, 20, -30, 0), (11, 19, 2**40, 5)]]
+    for has_z, has_m in ((True, False), (False, True), (True, True)):
+      with self.subTest(has_z=has_z, has_m=has_m):
+        dimensions = 2 + has_z + has_m
+        selected = [[[x, y] + ([z] if has_z else []) + ([m] if has_m else []) for x, y, z, m in geometry] for geometry in geometries]
+        vertices = self.decode(selected, has_z, has_m)
+        self.assertEqual([len(geometry) for geometry in vertices], [1, 0, 2])
+        self.assertTrue(all(len(vertex) == dimensions for geometry in vertices for vertex in geometry))
+        self.assertAlmostEqual(vertices[2][1][2], (2**40 if has_z else 5) * (0.1 if has_z else 0.01))
+
+class columnsTests(unittest.TestCase):
+  """
+    `featureColumns` gives back the features it was filled with, as rows, NDJSON, Arrow and Parquet.
+  """
+  FIELDS = [{"name": "objectid", "type": "esriFieldTypeOID"}, {"name": "small", "type": "esriFieldTypeSmallInteger"},
+            {"name": "count", "type": "esriFieldTypeInteger"}, {"name": "big", "type": "esriFieldTypeBigInteger"},
+            {"name": "ratio", "type": "esriFieldTypeSingle"}, {"name": "length", "type": "esriFieldTypeDouble"},
+            {"name": "installed", "type": "esriFieldTypeDate"}, {"name": "name", "type": "esriFieldTypeString"},
+            {"name": "globalid", "type": "esriFieldTypeGlobalID"}, {"name": "shape", "type": "esriFieldTypeGeometry"},
+            {"name": "photo", "type": "esriFieldTypeBlob"}]
+  ARROW_TYPES = {"objectid": "int64", "small": "int16", "count": "int32", "big": "int64", "ratio": "float", "length": "double",
+                 "installed": "timestamp[ms, tz=UTC]", "name": "large_string", "globalid": "large_string"}
+
+  def features(self, geometries:list)->list:
+    features = []
+    for index, geometry in enumerate(geometries):
+      null = index % 3 == 1
+      features.append({"attributes": {"objectid": index + 1, "small": None if null else -index, "count": None if null else index * 1000,
+                                      "big": None if null else 2**40 + index, "ratio": None if null else index / 4,
+                                      "length": None if null else index / 3, "installed": None if null else 1700000000000 + index,
+                                      "name": None if null else f"Näme {index}", "globalid": "{" + f"{index:08X}" + "-0000-0000-0000-000000000000}"},
+                       "geometry": geometry})
+    return features
+
+  def columns(self, features:list, geometry_type:str=None, has_z:bool=False, has_m:bool=False, pages:int=2)->featureColumns:
+    columns = featureColumns(self.FIELDS, geometry_type, has_z, has_m, {"wkid": 4326})
+    size = -(-len(features) // pages) or 1
+    for start in range(0, len(features), size):
+      columns.append(features[start:start + size])
+    return columns
+
+  def expected(self, features:list, geometry:bool=True)->list:
+    # Geometry, blob and raster fields are not stored; nor are the geometries without geometry type.
+    return [dict({"attributes": feature["attributes"]}, **({"geometry": feature["geometry"]} if geometry else {})) for feature in features]
+
+  GEOMETRIES = {
+    "esriGeometryPoint": [{"x": 1.5, "y": 2.5}, None, {"x": -3.0, "y": 4.0}, {"x": 0.0, "y": 0.0}],
+    "esriGeometryMultipoint": [{"points": [[1.0, 2.0], [3.0, 4.0]]}, None, {"points": []}, {"points": [[5.0, 6.0]]}],
+    "esriGeometryPolyline": [{"paths": [[[0.0, 0.0], [1.0, 1.0]], [[2.0, 2.0], [3.0, 3.0], [4.0, 5.0]]]}, None, {"paths": []}, {"paths": [[[9.0, 9.0], [8.0, 8.0]]]}],
+    "esriGeometryPolygon": [{"rings": [[[0.0, 0.0], [0.0, 1.0], [1.0, 1.0], [0.0, 0.0]]]}, {"rings": []}, None, {"rings": [[[5.0, 5.0], [5.0, 6.0], [6.0, 6.0], [5.0, 5.0]], [[5.2, 5.2], [5.4, 5.4], [5.2, 5.4], [5.2, 5.2]]]}],
+  }
+
+  def test_rows_round_trip(self):
+    for geometry_type, geometries in self.GEOMETRIES.items():
+      with self.subTest(geometry_type=geometry_type):
+        features = self.features(geometries)
+        columns = self.columns(features, geometry_type)
+        self.assertEqual(len(columns), len(features))
+        self.assertEqual(list(columns.iter_features()), self.expected(features))
+        self.assertEqual(list(columns.iter_features(1, 3)), self.expected(features)[1:3])
+    features = self.features([None] * 7)
+    columns = self.columns(features, pages=3)
+    self.assertEqual(list(columns.iter_features()), self.expected(features, geometry=False))
+    self.assertEqual(columns.names, ["objectid", "small", "count", "big", "ratio", "length", "installed", "name", "globalid"])
+    self.assertEqual(columns.column("NAME"), [feature["attributes"]["name"] for feature in features])
+
+  def test_z_and_m_round_trip(self):
+    points = [{"x": 1.0, "y": 2.0, "z": 3.0, "m": 4.0}, None, {"x": 5.0, "y": 6.0, "z": -7.0, "m": 8.0}]
+    features = self.features(points)
+    self.assertEqual(list(self.columns(features, "esriGeometryPoint", True, True).iter_features()), self.expected(features))
+    lines = [{"paths": [[[0.0, 0.0, 10.0], [1.0, 1.0, 11.0]]]}, {"paths": [[[2.0, 2.0, 12.0]]]}]
+    features = self.features(lines)
+    self.assertEqual(list(self.columns(features, "esriGeometryPolyline", has_z=True).iter_features()), self.expected(features))
+
+  def test_values_that_do_not_fit_the_field_type(self):
+    columns = featureColumns([{"name": "status", "type": "esriFieldTypeSmallInteger"}])
+    with self.assertRaises(Exception):
+      columns.append([{"attributes": {"status": "In Service"}}])
+    text = featureColumns.from_layer_info({"fields": [{"name": "status", "type": "esriFieldTypeSmallInteger"}]}, text_fields=["Status"])
+    text.append([{"attributes": {"status": "In Service"}}, {"attributes": {"status": None}}])
+    self.assertEqual(text.column("status"), ["In Service", None])
+
+  def test_ndjson_round_trip(self):
+    features = self.features(self.GEOMETRIES["esriGeometryPolygon"])
+    columns = self.columns(features, "esriGeometryPolygon")
+    output = io.StringIO()
+    self.assertEqual(columns.write_ndjson(output), len(features))
+    self.assertEqual([json.loads(line) for line in output.getvalue().splitlines()], self.expected(features))
+    output = io.StringIO()
+    columns.write_ndjson(output, geometry=False)
+    self.assertEqual([json.loads(line) for line in output.getvalue().splitlines()], self.expected(features, geometry=False))
+
+  def arrow_features(self, table)->list:
+    """
+      Features back from the Arrow rows: dates as epoch ms, geometries from the GeoArrow coordinates.
+    """
+    geometry_type = table.schema.metadata[b"esri:geometryType"].decode()
+    features = []
+    for row in table.to_pylist():
+      geometry = row.pop("geometry", None)
+      for name, value in row.items():
+        if isinstance(value, datetime.datetime):
+          row[name] = int(value.timestamp() * 1000)
+      feature = {"attributes": row}
+      if geometry_type:
+        if geometry is None:
+          feature["geometry"] = None
+        elif geometry_type == "esriGeometryPoint":
+          feature["geometry"] = {"x": geometry[0], "y": geometry[1]}
+        else:
+          feature["geometry"] = {{"esriGeometryMultipoint": "points", "esriGeometryPolyline": "paths", "esriGeometryPolygon": "rings"}[geometry_type]: geometry}
+      features.append(feature)
+    return features
+
+  @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+  def test_arrow_round_trip(self):
+    for geometry_type, geometries in self.GEOMETRIES.items():
+      with self.subTest(geometry_type=geometry_type):
+        features = self.features(geometries)
+        table = self.columns(features, geometry_type).to_arrow()
+        self.assertEqual({field.name: str(field.type) for field in table.schema if field.name != "geometry"}, self.ARROW_TYPES)
+        self.assertEqual(table.column("small").null_count, 1)
+        self.assertEqual(table.column("geometry").null_count, sum(geometry is None for geometry in geometries))
+        self.assertEqual(json.loads(table.schema.metadata[b"esri:spatialReference"]), {"wkid": 4326})
+        self.assertEqual(self.arrow_features(table), self.expected(features))
+    features = self.features([None] * 4)
+    table = self.columns(features).to_arrow()
+    self.assertNotIn("geometry", table.column_names)
+    self.assertEqual(self.arrow_features(table), self.expected(features, geometry=False))
+
+  @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+  def test_parquet_round_trip(self):
+    features = self.features(self.GEOMETRIES["esriGeometryPolyline"])
+    columns = self.columns(features, "esriGeometryPolyline")
+    folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, folder, True)
+    path = os.path.join(folder, "features.parquet")
+    columns.to_parquet(path)
+    table = pyarrow.parquet.read_table(path)
+    self.assertTrue(table.equals(columns.to_arrow()))
+    self.assertEqual(self.arrow_features(table), self.expected(features))
+
+class queryColumnsTests(unittest.TestCase):
+  """
+    `query_to_columns` holds the features of `query_arcgis_layer_rest_url`, domain codes decoded on request.
+  """
+  @classmethod
+  def setUpClass(cls):
+    cls.server = start_server(cls, records=1234, max_record_count=500)
+    cls.esri = new_esri(cls.server)
+    cls.url = f"{cls.server.layerUrl}/query"
+
+  def test_columns_match_the_features(self):
+    token = self.esri.token
+    for outFields, returnGeometry, paging in (("*", True, "offset"), ("name,lifecyclestatus", False, "keyset"), ("*", False, "partitioned")):
+      with self.subTest(outFields=outFields, returnGeometry=returnGeometry, paging=paging):
+        features = self.esri.query_arcgis_layer_rest_url(self.url, token, outFields=outFields, returnGeometry=returnGeometry)
+        columns = self.esri.query_to_columns(self.url, token, outFields=outFields, returnGeometry=returnGeometry, paging=paging, max_workers=2)
+        rows = list(columns.iter_features())
+        if paging == "partitioned":
+          rows, features = sorted(rows, key=json.dumps), sorted(features, key=json.dumps)
+        self.assertEqual(rows, features)
+
+  def test_decoded_domains(self):
+    token = self.esri.token
+    features = self.esri.decode_domains(self.esri.query_arcgis_layer_rest_url(self.url, token), self.server.layerUrl)
+    columns = self.esri.query_to_columns(self.url, token, decode_domains=True)
+    self.assertEqual(list(columns.iter_features()), features)
+    self.assertIn("In Service", columns.column("lifecyclestatus"))
+    self.assertTrue(all(name.startswith("Type ") for name in columns.column("assettype")))
+    if pyarrow:
+      table = columns.to_arrow()
+      self.assertEqual(str(table.schema.field("lifecyclestatus").type), "large_string")
+      self.assertEqual(str(table.schema.field("assetgroup").type), "int32")
+
+class extractorTests(unittest.TestCase):
+  """
+    `featureServerExtractor` limits its page queries with its own `rate_limit`, without touching the shared transport.
+  """
+  class countingLimiter:
+    def __init__(self):
+      self.count = 0
+
+    def acquire(self, url:str)->float:
+      self.count += 1
+      return 0.0
+
+  def setUp(self):
+    self.server = mockArcGISServer(in_process=True, records=450, max_record_count=100).__enter__()
+    self.addCleanup(self.server.__exit__, None, None, None)
+    self.esri = new_esri(self.server)
+    self.esri.token
+
+  def test_rate_limit_applies_to_the_run_only(self):
+    shared = self.esri.transport.rate_limiter = extractorTests.countingLimiter()
+    extractor = featureServerExtractor(self.esri, rate_limit=4)
+    extractor.plan()
+    # `run` plans again, with the layer metadata cached.
+    shared.count = 0
+    extractor.plan()
+    plan_requests = shared.count
+    limiters, pages = [], []
+    def sink(job, page):
+      limiters.append(self.esri.transport.rate_limiter)
+      pages.append(len(page))
+    shared.count = 0
+    start = time.perf_counter()
+    reports = extractor.run(sink=sink, run_id="limited")
+    elapsed = time.perf_counter() - start
+    self.assertEqual([report["status"] for report in reports], ["completed"])
+    self.assertEqual(sum(pages), 450)
+    self.assertEqual(len(pages), 5)
+    self.assertTrue(all(limiter is shared for limiter in limiters))
+    self.assertIs(self.esri.transport.rate_limiter, shared)
+    # The page queries waited for the run's limiter (4 per second, burst 4), not for the shared one.
+    self.assertEqual(shared.count, plan_requests)
+    self.assertGreater(elapsed, 0.2)
+
+class applyEditsTests(unittest.TestCase):
+  """
+    `applyEditsWriter` splits failed chunks to isolate bad records, resends rejected requests and never resends adds
+    the server may have applied.
+  """
+  def setUp(self):
+    self.server = mockArcGISServer(in_process=True, records=100).__enter__()
+    self.addCleanup(self.server.__exit__, None, None, None)
+    self.state = self.server.state
+
+  def count(self)->int:
+    return self.state.query({"where": "1=1", "returnCountOnly": "true"})["count"]
+
+  def test_bad_record_is_isolated(self):
+    esri = new_esri(self.server)
+    updates = [{"attributes": {"objectid": oid, "name": f"Renamed {oid}"}} for oid in range(1, 21)]
+    updates[13]["attributes"]["name"] = "x" * 100
+    results = []
+    summary = applyEditsWriter(esri, self.server.layerUrl, chunk_size=20, max_workers=1).write(updates=updates, on_result=lambda kind, result: results.append(result))
+    self.assertEqual(summary["updates"], {"success": 19, "failed": 1, "unknown": 0})
+    self.assertEqual([result["objectId"] for result in results if not result["success"]], [14])
+    self.assertEqual(self.state.query({"where": "objectid = 1", "outFields": "name"})["features"][0]["attributes"]["name"], "Renamed 1")
+
+  def test_rejected_adds_are_sent_again_once(self):
+    esri = new_esri(self.server, HTTP_RETRIES=0, HTTP_CIRCUIT_FAILURES=0)
+    esri.token
+    self.state.errorRate = 0.2
+    adds = [{"attributes": {"name": f"New {n}"}} for n in range(40)]
+    summary = applyEditsWriter(esri, self.server.layerUrl, chunk_size=10, max_workers=2, retries=4).write(adds=adds)
+    self.state.errorRate = 0
+    self.assertEqual(summary["adds"]["success"] + summary["adds"]["failed"], 40)
+    self.assertEqual(summary["adds"]["unknown"], 0)
+    self.assertGreater(summary["adds"]["success"], 0)
+    self.assertEqual(self.count(), 100 + summary["adds"]["success"])
+
+  def test_timed_out_adds_are_not_sent_again(self):
+    esri = new_esri(self.server, HTTP_READ_TIMEOUT=0.1)
+    esri.token
+    self.state.latency = 0.3
+    adds = [{"attributes": {"name": f"New {n}"}} for n in range(10)]
+    summary = applyEditsWriter(esri, self.server.layerUrl, chunk_size=10, max_workers=1).write(adds=adds)
+    self.state.latency = 0
+    time.sleep(0.4)
+    self.assertEqual(summary["adds"], {"success": 0, "failed": 0, "unknown": 10})
+    self.assertEqual(summary["requests"], 1)
+    self.assertEqual(self.count(), 110, "the server applied the timed out request once")
+
+  def test_timed_out_updates_are_sent_again(self):
+    esri = new_esri(self.server, HTTP_READ_TIMEOUT=0.2)
+    esri.token
+    self.state.latency = 0.3
+    updates = [{"attributes": {"objectid": oid, "name": "Updated"}} for oid in range(1, 5)]
+    writer = applyEditsWriter(esri, self.server.layerUrl, chunk_size=4, max_workers=1)
+    # The latency is removed once the first request timed out, the halves are then accepted.
+    threading.Timer(0.25, setattr, (self.state, "latency", 0)).start()
+    summary = writer.write(updates=updates)
+    self.assertEqual(summary["updates"], {"success": 4, "failed": 0, "unknown": 0})
+
+class cacheTests(unittest.TestCase):
+  """
+    The query result cache serves repeated queries, is scoped to the caller and is invalidated by edits.
+  """
+  def setUp(self):
+    self.server = mockArcGISServer(in_process=True, records=300).__enter__()
+    self.addCleanup(self.server.__exit__, None, None, None)
+    self.folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.folder, True)
+    self.esri = new_esri(self.server, QUERY_CACHE_PATH=os.path.join(self.folder, "query_cache.db"))
+    self.url = f"{self.server.layerUrl}/query"
+
+  def query(self, esri:esriHelper=None)->list:
+    esri = esri or self.esri
+    return esri.query_arcgis_layer_rest_url(self.url, esri.token, where_clause="objectid <= 50", outFields="objectid,name")
+
+  def queries(self)->int:
+    return self.server.stats().get("query", 0)
+
+  def hits(self, esri:esriHelper=None)->int:
+    return (esri or self.esri).metrics.snapshot()["counters"].get("query_cache_hits{endpoint=query}", 0)
+
+  def test_repeated_query_is_served_from_cache(self):
+    first = self.query()
+    queries = self.queries()
+    self.assertEqual(self.query(), first)
+    self.assertEqual(self.hits(), 1)
+    self.assertEqual(self.queries(), queries)
+
+  def test_warm_hit_makes_no_request(self):
+    self.query()
+    requests = lambda: {endpoint: count for endpoint, count in self.server.stats().items() if endpoint != "stats"}
+    before = requests()
+    self.query()
+    self.assertEqual(self.hits(), 1)
+    self.assertEqual(requests(), before, "no layer or query request on a warm hit")
+
+  def test_edit_by_another_client(self):
+    esri = new_esri(self.server, QUERY_CACHE_PATH=os.path.join(self.folder, "query_cache.db"), QUERY_CACHE_MAX_STALENESS=0)
+    self.query(esri)
+    applyEditsWriter(new_esri(self.server), self.server.layerUrl).write(updates=[{"attributes": {"objectid": 3, "name": "Edited elsewhere"}}])
+    features = self.query(esri)
+    self.assertEqual(self.hits(esri), 0)
+    self.assertEqual(features[2]["attributes"]["name"], "Edited elsewhere")
+
+  def test_edit_invalidates_results(self):
+    self.query()
+    applyEditsWriter(self.esri, self.server.layerUrl).write(updates=[{"attributes": {"objectid": 7, "name": "Edited"}}])
+    features = self.query()
+    self.assertEqual(self.hits(), 0)
+    self.assertEqual(features[6]["attributes"]["name"], "Edited")
+
+  def test_results_are_not_shared_between_callers(self):
+    self.query()
+    same_user = new_esri(self.server, QUERY_CACHE_PATH=os.path.join(self.folder, "query_cache.db"))
+    self.query(same_user)
+    self.assertEqual(self.hits(same_user), 1)
+    other_user = new_esri(self.server, QUERY_CACHE_PATH=os.path.join(self.folder, "query_cache.db"), PORTAL_USER="other")
+    self.query(other_user)
+    self.assertEqual(self.hits(other_user), 0)
+
+class tokenTests(unittest.TestCase):
+  """
+    The portal token is requested once for concurrent callers and refreshed before it expires. The mock tokens live 60 s,
+    less than the default `TOKEN_REFRESH_MARGIN`, so the tests set the margin.
+  """
+  @classmethod
+  def setUpClass(cls):
+    cls.server = start_server(cls, records=10, token_minutes=1)
+
+  def test_concurrent_callers_share_one_request(self):
+    esri = new_esri(self.server, TOKEN_REFRESH_MARGIN=30)
+    before = self.server.stats().get("token", 0)
+    barrier = threading.Barrier(8)
+    tokens = []
+    def get_token():
+      barrier.wait()
+      tokens.append(esri.token)
+    threads = [threading.Thread(target=get_token) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(set(tokens)), 1)
+    self.assertEqual(self.server.stats().get("token", 0) - before, 1)
+
+  def test_token_is_refreshed_before_it_expires(self):
+    # Tokens live 60 s, with a 59.7 s margin they are refreshed after 0.3 s.
+    esri = new_esri(self.server, TOKEN_REFRESH_MARGIN=59.7)
+    first = esri.token
+    self.assertEqual(esri.token, first)
+    time.sleep(0.5)
+    second = esri.token
+    self.assertNotEqual(second, first)
+    self.assertEqual(esri.get_feature_count(f"{self.server.layerUrl}/query", second), 10)
+
+  def test_invalidate_requests_a_new_token(self):
+    calls = []
+    def fetch():
+      calls.append(1)
+      return f"token{len(calls)}", datetime.datetime.now() + datetime.timedelta(hours=1)
+    manager = tokenManager(fetch, background=False)
+    self.assertEqual(manager.get(), "token1")
+    self.assertEqual(manager.get(), "token1")
+    manager.invalidate()
+    self.assertEqual(manager.get(), "token2")
+    self.assertTrue(manager.issued("token1") and manager.issued("token2"))
+
+class loggingTests(unittest.TestCase):
+  """
+    Requests are logged at DEBUG only, without the token or the password.
+  """
+  @classmethod
+  def setUpClass(cls):
+    cls.server = start_server(cls, records=10)
+
+  def test_secrets_are_not_logged(self):
+    with self.assertLogs("ArcGISPythonUtility", level="DEBUG") as logs:
+      esri = new_esri(self.server, PORTAL_PASS="p4ssw0rd")
+      token = esri.token
+      esri.get_feature_count(f"{self.server.layerUrl}/query", token)
+    output = "\n".join(logs.output)
+    self.assertNotIn(token, output)
+    self.assertNotIn("p4ssw0rd", output)
+    self.assertFalse([line for line in logs.output if line.startswith("INFO") and self.server.baseUrl in line])
+
+class editSessionTests(unittest.TestCase):
+  """
+    `edit_session` closes the version session after an error in its block and surfaces that error, not a cleanup failure.
+  """
+  def setUp(self):
+    self.server = mockArcGISServer(in_process=True, records=10).__enter__()
+    self.addCleanup(self.server.__exit__, None, None, None)
+    self.esri = new_esri(self.server, HTTP_RETRIES=0, HTTP_CIRCUIT_FAILURES=0)
+    self.guid = self.esri.get_version_catalog().get_guid("mock.version1")
+    self.version = self.server.state._versions[self.guid.strip("{}").upper()]
+
+  def test_block_error_closes_the_session(self):
+    with self.assertRaises(ValueError):
+      with self.esri.edit_session(self.guid) as session_id:
+        self.assertEqual(self.version["editor"], session_id)
+        raise ValueError("edit failed")
+    self.assertIsNone(self.version["editor"])
+    self.assertIsNone(self.version["reader"])
+
+  def test_cleanup_failures_do_not_replace_the_error(self):
+    token = self.esri.token
+    with self.assertLogs("ArcGISPythonUtility", level="WARNING") as logs:
+      with self.assertRaises(Exception) as raised:
+        with self.esri.edit_session(self.guid) as session_id:
+          # The service goes down: applyEdits, stopEditing and stopReading fail.
+          self.server.state.errorRate = 1
+          self.esri.evaluate_url(f"{self.server.layerUrl}/applyEdits", {"token": token, "sessionID": session_id, "updates": "[]"})
+    self.server.state.errorRate = 0
+    self.assertIn("/applyEdits failed with HTTP 503", str(raised.exception))
+    warnings = "\n".join(logs.output)
+    self.assertIn("stopEditing of version", warnings)
+    self.assertIn("stopReading of version", warnings)
+
+class workerTests(unittest.TestCase):
+  """
+    Worker jobs run like the cold script: the caller's working directory and environment, and their own output.
+  """
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.folder, True)
+
+  def script(self, source:str)->str:
+    path = os.path.join(self.folder, "job.py")
+    with open(path, "w", encoding="UTF-8") as file:
+      file.write(source)
+    return path
+
+  def test_run_uses_the_caller_cwd_and_environment(self):
+    script = self.script("import os, sys\nprint(os.getcwd())\nprint(os.environ.get('WORKER_TEST_VALUE'))\nprint(open('data.txt').read())\nsys.exit(3)\n")
+    with open(os.path.join(self.folder, "data.txt"), "w", encoding="UTF-8") as file:
+      file.write("relative")
+    cwd = os.getcwd()
+    result = run_script({}, script, [], cwd=self.folder, env=dict(os.environ, WORKER_TEST_VALUE="from caller"))
+    self.assertEqual(result["exitCode"], 3)
+    self.assertEqual(result["stdout"].splitlines(), [os.path.realpath(self.folder), "from caller", "relative"])
+    self.assertEqual(os.getcwd(), cwd)
+    self.assertNotIn("WORKER_TEST_VALUE", os.environ)
+
+  @unittest.skipIf(os.name == "nt", "POSIX file modes")
+  def test_secret_is_only_readable_by_the_owner(self):
+    path = os.path.join(self.folder, "secrets", "worker.secret")
+    umask = os.umask(0)
+    try:
+      with mock.patch.object(ArcGISPythonUtility_worker, "SECRET_PATH", path), mock.patch.dict(os.environ, {"ARCGIS_WORKER_SECRET": ""}):
+        secret = ArcGISPythonUtility_worker._write_secret()
+        self.assertEqual(ArcGISPythonUtility_worker.get_secret(), secret)
+        self.assertNotEqual(ArcGISPythonUtility_worker._write_secret(), secret)
+    finally:
+      os.umask(umask)
+    self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+    self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o777, 0o700)
+    self.assertEqual(os.listdir(os.path.dirname(path)), ["worker.secret"])
+
+  def test_call_waits_for_the_running_script(self):
+    with mockArcGISServer(in_process=True, records=10) as server:
+      state = workerState(server.configs(), "secret", warmup=False)
+      script = self.script("import time\nprint('start')\ntime.sleep(0.3)\nprint(time.perf_counter())\n")
+      finished = {}
+      def run():
+        finished["run"] = state.handle({"secret": "secret", "op": "run", "script": script})
+      thread = threading.Thread(target=run)
+      thread.start()
+      time.sleep(0.1)
+      response = state.handle({"secret": "secret", "op": "call", "method": "get_feature_count", "kwargs": {"url": f"{server.layerUrl}/query"}})
+      called_at = time.perf_counter()
+      thread.join()
+    self.assertEqual(response["result"], 10)
+    # The call ran after the script ended and printed nothing into its output.
+    lines = finished["run"]["stdout"].splitlines()
+    self.assertEqual(len(lines), 2)
+    self.assertEqual(lines[0], "start")
+    self.assertGreater(called_at, float(lines[1]))
+
+if __name__ == "__main__":
+  unittest.main()
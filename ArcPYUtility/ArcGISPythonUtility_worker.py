@@ -0,0 +1,290 @@
+"""
+Long-lived worker for ArcGISPythonUtility.py. It keeps one warm `esriHelper` (pooled connections, portal token, layer metadata,
+query and trace caches) and the modules imported by the jobs, and runs the jobs sent over a local TCP socket, so short
+scheduled jobs do not pay the interpreter start, the imports and the login on every run.
+
+  python ArcGISPythonUtility_worker.py --config ArcGISPythonUtility_Config.ini --port 8765 serve
+  python ArcGISPythonUtility_worker.py --port 8765 run C:\\temp\\test.py arg1 arg2
+  python ArcGISPythonUtility_worker.py --port 8765 call get_feature_count url=<layer url>/query where_clause="1=1"
+  python ArcGISPythonUtility_worker.py --port 8765 stats
+
+Options go before the command, everything after the script (or method) is passed to it.
+
+`run` executes the script inside the worker (`runpy`, as `__main__`) with `esri`, `rest` and `configs` already defined,
+in the caller's working directory and environment, prints its output and exits with its exit code. When no worker is listening the script runs in the current process instead,
+so the batch launcher works either way. `call` runs one public `esriHelper` method (the `token` argument is filled in).
+
+The worker only listens on 127.0.0.1 and every job must carry the shared secret: `--secret`, the `ARCGIS_WORKER_SECRET`
+environment variable, or the file `~/.ArcGISPythonUtility/worker.secret` written by `serve` when neither is given.
+The client side (`run`, `call`, `stats`) uses the standard library only.
+"""
+import argparse
+import configparser
+import contextlib
+import hmac
+import io
+import json
+import os
+import runpy
+import secrets
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+SECRET_PATH = os.path.join(os.path.expanduser("~"), ".ArcGISPythonUtility", "worker.secret")
+DEFAULT_PORT = 8765
+
+#---- END of import
+
+def load_configs(path:str)->dict:
+  """
+    Reads the `[configuration]` section of the ini file into a `dict`, without the quotes around the values.
+  """
+  parser = configparser.ConfigParser()
+  parser.optionxform = str
+  with open(path, encoding="UTF-8") as file:
+    parser.read_file(file)
+  return {key: value.strip().strip('"') for key, value in parser["configuration"].items()}
+
+def get_secret(secret:str=None)->str:
+  """
+    Returns the shared secret: `secret`, `ARCGIS_WORKER_SECRET`, or the one stored in `SECRET_PATH` (`None` when there is none).
+  """
+  if secret:
+    return secret
+  if os.environ.get("ARCGIS_WORKER_SECRET"):
+    return os.environ["ARCGIS_WORKER_SECRET"]
+  try:
+    with open(SECRET_PATH, encoding="UTF-8") as file:
+      return file.read().strip() or None
+  except OSError:
+    return None
+
+def _write_secret()->str:
+  secret = secrets.token_hex(32)
+  os.makedirs(os.path.dirname(SECRET_PATH), mode=0o700, exist_ok=True)
+  # Written to a file created with mode 0600, then moved in place: the secret is never readable by other users.
+  temp_path = f"{SECRET_PATH}.{os.getpid()}.tmp"
+  descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+  try:
+    with os.fdopen(descriptor, "w", encoding="UTF-8") as file:
+      file.write(secret)
+    os.replace(temp_path, SECRET_PATH)
+  except BaseException:
+    with contextlib.suppress(OSError):
+      os.remove(temp_path)
+    raise
+  return secret
+
+def build_helpers(configs:dict)->dict:
+  """
+    Returns the globals of the jobs: `configs`, `rest` (`restHelper`) and `esri` (`esriHelper`).
+  """
+  from ArcGISPythonUtility import esriHelper, restHelper
+  rest = restHelper(configs)
+  return {"configs": configs, "rest": rest, "esri": esriHelper(rest, configs)}
+
+def run_script(helpers:dict, script:str, args:list, cwd:str=None, env:dict=None)->dict:
+  """
+    Runs the script as `__main__` with the helpers in its globals and returns `{"exitCode", "stdout", "stderr", "error"}`.
+    `cwd` and `env` (the caller's working directory and environment) are applied for the run and restored afterwards.
+    Not thread safe (`sys.argv`, `sys.stdout`, working directory, `os.environ`): the worker runs one job at a time.
+  """
+  stdout, stderr = io.StringIO(), io.StringIO()
+  result = {"exitCode": 0, "error": None}
+  argv = sys.argv
+  previous_cwd = os.getcwd()
+  previous_env = dict(os.environ)
+  sys.argv = [script] + list(args)
+  try:
+    if cwd:
+      os.chdir(cwd)
+    if env is not None:
+      os.environ.clear()
+      os.environ.update(env)
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+      runpy.run_path(script, init_globals=dict(helpers), run_name="__main__")
+  except SystemExit as ex:
+    result["exitCode"] = ex.code if isinstance(ex.code, int) else (0 if ex.code is None else 1)
+    if ex.code is not None and not isinstance(ex.code, int):
+      stderr.write(f"{ex.code}\n")
+  except BaseException:
+    result["exitCode"] = 1
+    result["error"] = traceback.format_exc()
+  finally:
+    sys.argv = argv
+    os.chdir(previous_cwd)
+    if env is not None:
+      os.environ.clear()
+      os.environ.update(previous_env)
+  result.update(stdout=stdout.getvalue(), stderr=stderr.getvalue())
+  return result
+
+class workerState:
+  """
+    Warm helpers and counters of the worker, shared by the connection threads.
+
+    =====================        =====================================================================================
+    **Keys**                     **Description**
+    ---------------------        -------------------------------------------------------------------------------------
+    configs:dict                 Configs of `restHelper` / `esriHelper`.
+    ---------------------        -------------------------------------------------------------------------------------
+    secret:str                   Shared secret of the jobs.
+    ---------------------        -------------------------------------------------------------------------------------
+    warmup:bool=True             Request the portal token at start, so the first job does not wait for it.
+    =====================        =====================================================================================
+  """
+  def __init__(self, configs:dict, secret:str, warmup:bool=True) -> None:
+    self.secret = secret
+    self.helpers = build_helpers(configs)
+    self.startedAt = time.time()
+    self.jobs = 0
+    self.failures = 0
+    # `run` swaps process globals (stdout, stderr, argv, cwd, environment): `run` and `call` jobs hold this lock, so a
+    # `call` never prints into a running script's output nor sees its environment.
+    self._jobLock = threading.Lock()
+    self._lock = threading.Lock()
+    if warmup:
+      self.helpers["esri"].token
+
+  def handle(self, job:dict)->dict:
+    if not isinstance(job, dict) or not hmac.compare_digest(str(job.get("secret", "")), self.secret):
+      return {"ok": False, "error": "Invalid secret."}
+    start = time.perf_counter()
+    op = job.get("op")
+    try:
+      if op == "run":
+        with self._jobLock:
+          response = run_script(self.helpers, job["script"], job.get("args") or [], job.get("cwd"), job.get("env"))
+        response["ok"] = response["exitCode"] == 0
+      elif op == "call":
+        with self._jobLock:
+          response = {"ok": True, "result": self._call(job["method"], job.get("kwargs") or {})}
+      elif op == "stats":
+        with self._lock:
+          response = {"ok": True, "result": {"uptime": time.time() - self.startedAt, "jobs": self.jobs, "failures": self.failures,
+                                             "metrics": self.helpers["esri"].metrics.snapshot()}}
+      else:
+        response = {"ok": False, "error": f"Unknown op '{op}'."}
+    except Exception:
+      response = {"ok": False, "error": traceback.format_exc()}
+    response["id"] = job.get("id")
+    response["seconds"] = time.perf_counter() - start
+    with self._lock:
+      self.jobs += 1
+      self.failures += 0 if response["ok"] else 1
+    return response
+
+  def _call(self, method:str, kwargs:dict):
+    import inspect
+    esri = self.helpers["esri"]
+    if method.startswith("_") or not callable(getattr(esri, method, None)):
+      raise Exception(f"'{method}' is not a public esriHelper method.")
+    function = getattr(esri, method)
+    if "token" in inspect.signature(function).parameters and "token" not in kwargs:
+      kwargs = dict(kwargs, token=esri.token)
+    result = function(**kwargs)
+    return result.to_dict() if hasattr(result, "to_dict") else result
+
+class workerHandler(socketserver.StreamRequestHandler):
+  """
+    One JSON job per line, one JSON response per line; a connection may send several jobs.
+  """
+  def handle(self):
+    for line in self.rfile:
+      try:
+        response = self.server.state.handle(json.loads(line))
+      except ValueError:
+        response = {"ok": False, "error": "Invalid JSON."}
+      self.wfile.write((json.dumps(response, default=str) + "\n").encode("UTF-8"))
+      self.wfile.flush()
+
+class workerServer(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+def serve(configs:dict, port:int=DEFAULT_PORT, secret:str=None, warmup:bool=True):
+  """
+    Runs the worker on `127.0.0.1:port` until interrupted.
+  """
+  secret = get_secret(secret) or _write_secret()
+  server = workerServer(("127.0.0.1", port), workerHandler)
+  server.state = workerState(configs, secret, warmup)
+  print(f"ArcGISPythonUtility worker listening on 127.0.0.1:{server.server_address[1]}", flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+def submit(job:dict, port:int=DEFAULT_PORT, secret:str=None, timeout:float=None)->dict:
+  """
+    Sends one job to the worker and returns its response. Raises `ConnectionError` (`ConnectionRefusedError`) when no worker listens.
+  """
+  job = dict(job, secret=get_secret(secret) or "")
+  with socket.create_connection(("127.0.0.1", port), timeout=timeout) as connection:
+    connection.sendall((json.dumps(job) + "\n").encode("UTF-8"))
+    with connection.makefile("rb") as reader:
+      line = reader.readline()
+  if not line:
+    raise ConnectionError("The worker closed the connection.")
+  return json.loads(line)
+
+def _parse_kwargs(items:list)->dict:
+  kwargs = {}
+  for item in items:
+    key, _, value = item.partition("=")
+    try:
+      kwargs[key] = json.loads(value)
+    except ValueError:
+      kwargs[key] = value
+  return kwargs
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="ArcGISPythonUtility warm worker")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+  parser.add_argument("--secret")
+  parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ArcGISPythonUtility_Config.ini"),
+                      help="serve, run without worker: ini file")
+  parser.add_argument("--no-warmup", action="store_true", help="serve: do not request the token at start")
+  parser.add_argument("--no-fallback", action="store_true", help="run: fail when no worker is listening")
+  parser.add_argument("command", choices=["serve", "run", "call", "stats"])
+  parser.add_argument("target", nargs="?", help="run: script path, call: esriHelper method")
+  parser.add_argument("arguments", nargs=argparse.REMAINDER, help="run: script arguments, call: key=value (JSON values)")
+  args = parser.parse_args()
+
+  if args.command in ("run", "call") and not args.target:
+    parser.error(f"{args.command} needs a {'script' if args.command == 'run' else 'method'}")
+  if args.command == "serve":
+    serve(load_configs(args.config), args.port, args.secret, warmup=not args.no_warmup)
+    sys.exit(0)
+
+  if args.command == "run":
+    # The script runs in the caller's working directory and environment, as it would without the worker.
+    job = {"op": "run", "script": os.path.abspath(args.target), "args": args.arguments, "cwd": os.getcwd(), "env": dict(os.environ)}
+  elif args.command == "call":
+    job = {"op": "call", "method": args.target, "kwargs": _parse_kwargs(args.arguments)}
+  else:
+    job = {"op": "stats"}
+
+  try:
+    response = submit(job, args.port, args.secret)
+  except ConnectionRefusedError:
+    if args.command != "run" or args.no_fallback:
+      raise
+    # No worker: cold run in this process.
+    response = run_script(build_helpers(load_configs(args.config)), job["script"], job["args"])
+    response["ok"] = response["exitCode"] == 0
+
+  if args.command == "run":
+    sys.stdout.write(response.get("stdout") or "")
+    sys.stderr.write(response.get("stderr") or "")
+  elif response.get("ok"):
+    print(json.dumps(response.get("result"), indent=2, default=str))
+  if response.get("error"):
+    sys.stderr.write(response["error"] + "\n")
+  sys.exit(response.get("exitCode", 0 if response.get("ok") else 1))